@@ -5,12 +5,14 @@ Home page - Login and Registration
 import streamlit as st
 from src.authenticate import login_user, register_user, get_user_info
 from src.global_settings import APP_TITLE, APP_ICON
+from src import profiler
 
 st.set_page_config(
     page_title=APP_TITLE,
     page_icon=APP_ICON,
     layout="wide"
 )
+profiler.start_rerun("Home")
 
 # Initialize session state
 if 'logged_in' not in st.session_state:
@@ -28,7 +30,8 @@ def show_login():
         
         if submit:
             if username and password:
-                success, user_info = login_user(username, password)
+                with profiler.section("login"):
+                    success, user_info = login_user(username, password)
                 if success:
                     st.session_state.logged_in = True
                     st.session_state.username = username
@@ -65,7 +68,8 @@ def show_register():
             elif password != confirm_password:
                 st.error("Mật khẩu xác nhận không khớp!")
             else:
-                success, message = register_user(username, password, email, age, gender)
+                with profiler.section("register"):
+                    success, message = register_user(username, password, email, age, gender)
                 if success:
                     st.success(message)
                     st.info("Vui lòng đăng nhập để sử dụng hệ thống")
@@ -106,25 +110,26 @@ def show_home():
     with col1:
         st.metric("👤 Người dùng", st.session_state.username)
     
+    # Materialized counters, kept up to date by the chat and score writers
+    from src.user_stats import get_user_stats
+    with profiler.section("user_stats"):
+        stats = get_user_stats(st.session_state.username)
+    
     with col2:
-        # Count chat messages
-        from src.conversation_engine import get_chat_history
-        messages = get_chat_history(st.session_state.username)
-        st.metric("💬 Tin nhắn", len(messages))
+        st.metric(
+            "💬 Tin nhắn",
+            stats["messages"],
+            delta=f"+{stats['messages_7d']} trong 7 ngày" if stats["messages_7d"] else None
+        )
     
     with col3:
-        # Count assessments
-        import json
-        import os
-        from src.global_settings import SCORES_FILE
-        
-        try:
-            with open(SCORES_FILE, 'r', encoding='utf-8') as f:
-                scores = json.load(f)
-                user_scores = [s for s in scores if s['username'] == st.session_state.username]
-                st.metric("📋 Đánh giá", len(user_scores))
-        except:
-            st.metric("📋 Đánh giá", 0)
+        st.metric(
+            "📋 Đánh giá",
+            stats["assessments"],
+            delta=f"+{stats['assessments_7d']} trong 7 ngày" if stats["assessments_7d"] else None
+        )
+        if stats["last_score"]:
+            st.caption(f"Đánh giá gần nhất: {stats['last_score']}")
 
 
 # Main app logic
@@ -138,5 +143,8 @@ if not st.session_state.logged_in:
         show_register()
 else:
     from src.slide_bar import render_sidebar
-    render_sidebar()
-    show_home()
\ No newline at end of file
+    with profiler.section("sidebar"):
+        render_sidebar()
+    show_home()
+
+profiler.end_rerun()
@@ -0,0 +1,152 @@
+"""
+Chunking micro-benchmark
+
+Splits a corpus made of copies of the source documents with the stock
+TokenTextSplitter and with FastTokenTextSplitter (in-process and in a
+process pool) for several chunk sizes, and reports the time of each.
+
+The fast splitter must produce exactly the same chunks: every document
+and a set of edge cases (repeated spaces, words longer than a chunk, text
+without spaces, empty text) are compared chunk by chunk, both through
+split_text and through the metadata-aware get_nodes_from_documents. The
+run fails (exit code 1) on any difference or when the fast splitter is
+not at least --min-speedup times faster.
+
+Usage:
+    python -m benchmarks.chunking
+    python -m benchmarks.chunking --copies 50 --chunk-sizes 128 512 --workers 4
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from src.global_settings import CHUNK_OVERLAP, FILES_PATH
+
+EDGE_CASES = [
+    "",
+    "   ",
+    "ngắn",
+    "nhiều   khoảng    trắng   liên   tiếp " * 200,
+    "x" * 5000,
+    "dòng\n" * 2000,
+    ("từ " * 300) + ("a" * 3000) + (" từ" * 300),
+    " bắt đầu bằng khoảng trắng và kết thúc bằng khoảng trắng " * 100,
+]
+
+
+def load_corpus(copies):
+    """Source documents repeated copies times, each copy rotated differently"""
+    from llama_index.core import Document, SimpleDirectoryReader
+
+    documents = SimpleDirectoryReader(input_files=FILES_PATH, filename_as_id=True).load_data()
+    corpus = []
+    for copy in range(copies):
+        for document in documents:
+            paragraphs = document.text.split("\n")
+            shift = copy * 7 % max(len(paragraphs), 1)
+            corpus.append(Document(
+                text="\n".join(paragraphs[shift:] + paragraphs[:shift]),
+                id_=f"{document.doc_id}_{copy}",
+                metadata={"file_name": document.metadata.get("file_name", ""), "copy": copy}
+            ))
+    return corpus
+
+
+def check_equivalence(documents, chunk_size, tokenizer):
+    """
+    Compare both splitters on the documents and the edge cases
+
+    Returns:
+        list: Descriptions of the mismatches
+    """
+    from llama_index.core.node_parser import TokenTextSplitter
+    from src.token_chunker import FastTokenTextSplitter
+
+    reference = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=CHUNK_OVERLAP, tokenizer=tokenizer)
+    fast = FastTokenTextSplitter(chunk_size=chunk_size, chunk_overlap=CHUNK_OVERLAP, tokenizer=tokenizer)
+
+    mismatches = []
+    for i, text in enumerate([d.text for d in documents[:5]] + EDGE_CASES):
+        expected, actual = reference.split_text(text), fast.split_text(text)
+        if expected != actual:
+            mismatches.append(f"split_text #{i}: {len(expected)} vs {len(actual)} chunks")
+
+    expected = [n.text for n in reference.get_nodes_from_documents(documents[:5])]
+    actual = [n.text for n in fast.get_nodes_from_documents(documents[:5])]
+    if expected != actual:
+        mismatches.append(f"get_nodes_from_documents: {len(expected)} vs {len(actual)} nodes")
+    return mismatches
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    """Run the chunking micro-benchmark"""
+    from llama_index.core.node_parser import TokenTextSplitter
+    from src.token_chunker import split_documents
+    from benchmarks.retrieval import get_tokenizer
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--copies", type=int, default=20, help="Copies of each source document")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[128, 256, 512, 1024])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--min-speedup", type=float, default=2.0,
+                        help="Required in-process speedup at every chunk size")
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print("Chunking micro-benchmark")
+    print("=" * 50)
+
+    tokenizer, tokenizer_name = get_tokenizer()
+    documents = load_corpus(args.copies)
+    characters = sum(len(d.text) for d in documents)
+    print(f"Corpus:     {len(documents)} documents, {characters / 1e6:.1f}M characters")
+    print(f"Tokenizer:  {tokenizer_name}")
+    print(f"Workers:    {args.workers}\n")
+
+    print(f"{'Chunk size':<12}{'Chunks':>8}{'Stock':>10}{'Fast':>10}{'Pool':>10}{'Speedup':>10}  Match")
+    print("-" * 67)
+    failures = []
+    for chunk_size in args.chunk_sizes:
+        mismatches = check_equivalence(documents, chunk_size, tokenizer)
+
+        splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=CHUNK_OVERLAP, tokenizer=tokenizer)
+        stock_nodes, stock_s = timed(lambda: splitter.get_nodes_from_documents(documents))
+        fast_nodes, fast_s = timed(
+            lambda: split_documents(documents, chunk_size, CHUNK_OVERLAP, tokenizer, workers=1)
+        )
+        pool_nodes, pool_s = timed(
+            lambda: split_documents(documents, chunk_size, CHUNK_OVERLAP, tokenizer, workers=args.workers)
+        )
+
+        stock_texts = [n.text for n in stock_nodes]
+        if [n.text for n in fast_nodes] != stock_texts:
+            mismatches.append("corpus (in-process)")
+        if [n.text for n in pool_nodes] != stock_texts:
+            mismatches.append("corpus (process pool)")
+
+        speedup = stock_s / fast_s if fast_s else float("inf")
+        print(f"{chunk_size:<12}{len(stock_nodes):>8}{stock_s:>9.2f}s{fast_s:>9.2f}s{pool_s:>9.2f}s"
+              f"{speedup:>9.1f}x  {'✓' if not mismatches else '✗'}")
+
+        failures.extend(f"chunk size {chunk_size}: {m}" for m in mismatches)
+        if speedup < args.min_speedup:
+            failures.append(f"chunk size {chunk_size}: speedup {speedup:.1f}x < {args.min_speedup}x")
+
+    print("=" * 50)
+    if failures:
+        for failure in failures:
+            print(f"✗ {failure}")
+        sys.exit(1)
+    print("✓ Fast splitter matches TokenTextSplitter at every chunk size")
+
+
+if __name__ == "__main__":
+    main()
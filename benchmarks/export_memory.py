@@ -0,0 +1,160 @@
+"""
+Memory benchmark for streamed score exports
+
+Builds synthetic score histories of increasing size, each in its own data
+root (every store path is relative, so nothing under data/ is touched):
+the scores log is appended to in batches and the Parquet mirror synced
+after each one, as the app keeps it. Before each export a few more
+assessments are appended, and the history is exported in every format in
+a fresh interpreter through the app's own path (syncing those new
+assessments, then streaming the export), recording peak memory (Python heap via
+tracemalloc plus the Arrow memory pool). The run fails (exit code 1) when
+an export has the wrong number of rows, or when peak memory for the
+largest history grows more than --max-growth times the peak for the
+smallest one.
+
+Usage:
+    python -m benchmarks.export_memory
+    python -m benchmarks.export_memory --sizes 10000 100000 1000000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Assessments saved since the last sync, synced by each export
+NEW_ASSESSMENTS = 100
+
+_PROBE = """
+import json, sys, tracemalloc
+import pyarrow as pa
+from src import exporter
+
+tracemalloc.start()
+pool = pa.default_memory_pool()
+path, rows = exporter.export_scores({fmt!r}, path={output!r})
+_, python_peak = tracemalloc.get_traced_memory()
+print(json.dumps({{"rows": rows, "python_peak": python_peak, "arrow_peak": pool.max_memory()}}))
+"""
+
+
+def _entries(start, stop):
+    """Synthetic score entries numbered start to stop - 1"""
+    from datetime import datetime, timedelta
+    from src.cohort_analytics import SCORE_LEVELS
+
+    base = datetime(2025, 1, 1)
+    return [
+        {
+            "username": f"user{i % 5000}",
+            "Time": (base + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S"),
+            "Score": SCORE_LEVELS[i % len(SCORE_LEVELS)],
+            "Content": "Người dùng chia sẻ về giấc ngủ và công việc. " * 4,
+            "Total_guess": "Căng thẳng nhẹ",
+        }
+        for i in range(start, stop)
+    ]
+
+
+def append_assessments(root, start, count, sync=False):
+    """
+    Append synthetic assessments to the scores log under a data root
+
+    Args:
+        root: Working directory the app's relative data paths resolve in
+        start: Number of the first assessment
+        count: Number of assessments
+        sync: Mirror them into the Parquet dataset afterwards
+    """
+    from src import cohort_analytics, persistence
+    from src.global_settings import SCORES_LOG
+    from src.storage import get_storage
+
+    cwd = os.getcwd()
+    os.makedirs(root, exist_ok=True)
+    os.chdir(root)
+    try:
+        get_storage().append(SCORES_LOG, persistence._score_lines(_entries(start, start + count)))
+        if sync:
+            cohort_analytics.sync_columnar_store()
+    finally:
+        os.chdir(cwd)
+
+
+def build_history(root, size, batch_size=50000):
+    """Write and mirror a synthetic history of size assessments, batch by batch"""
+    for start in range(0, size, batch_size):
+        append_assessments(root, start, min(batch_size, size - start), sync=True)
+
+
+def measure_export(root, fmt, output):
+    """Run one export in a fresh interpreter and return its memory stats"""
+    result = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(fmt=fmt, output=output)],
+        cwd=root,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": ROOT_DIR, "PYTHONWARNINGS": "ignore"},
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    """Run the export memory benchmark"""
+    from src.exporter import EXPORT_FORMATS
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 500000])
+    parser.add_argument("--formats", nargs="+", default=list(EXPORT_FORMATS))
+    parser.add_argument("--max-growth", type=float, default=2.0)
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print("Export memory benchmark")
+    print("=" * 50)
+
+    sizes = sorted(args.sizes)
+    peaks = {fmt: {} for fmt in args.formats}
+
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            root = os.path.join(tmp_dir, f"history_{size}")
+            build_history(root, size)
+            saved = size
+
+            for fmt in args.formats:
+                append_assessments(root, saved, NEW_ASSESSMENTS)
+                saved += NEW_ASSESSMENTS
+                output = os.path.join(tmp_dir, f"export_{size}{EXPORT_FORMATS[fmt][1]}")
+                stats = measure_export(root, fmt, output)
+                if stats["rows"] != saved:
+                    failed.append(f"{fmt}: exported {stats['rows']:,} of {saved:,} rows")
+                peak = stats["python_peak"] + stats["arrow_peak"]
+                peaks[fmt][size] = peak
+                file_mb = os.path.getsize(output) / 2**20
+                print(f"{fmt:<8} {size:>9,} rows  peak {peak / 2**20:7.1f} MB  file {file_mb:8.1f} MB")
+                os.remove(output)
+
+    for fmt, by_size in peaks.items():
+        growth = by_size[sizes[-1]] / max(by_size[sizes[0]], 1)
+        if growth > args.max_growth:
+            failed.append(f"{fmt}: peak memory grew {growth:.1f}x from {sizes[0]:,} to {sizes[-1]:,} rows")
+
+    print("=" * 50)
+    if failed:
+        for failure in failed:
+            print(f"✗ {failure}")
+        sys.exit(1)
+    print(f"✓ Peak memory stayed within {args.max_growth:.1f}x across history sizes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Import-time benchmark for the modules loaded by the Streamlit pages
+
+Each module is imported in a fresh interpreter with ``python -X importtime``.
+The run fails (exit code 1) when a module's cumulative import time exceeds
+its budget or when it eagerly pulls in a heavy dependency.
+
+Usage:
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --repeat 7 --scale 1.5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Cumulative import time budget per module, in milliseconds
+IMPORT_BUDGETS_MS = {
+    "src.global_settings": 10,
+    "src.prompts": 10,
+    "src.authenticate": 80,
+    "src.ingest_pipeline": 20,
+    "src.index_builder": 20,
+    "src.conversation_engine": 20,
+    "src.slide_bar": 600,
+}
+
+# Dependencies that must only be imported on the code paths that use them
+HEAVY_MODULES = (
+    "llama_index",
+    "openai",
+    "pandas",
+    "plotly",
+    "transformers",
+    "chromadb",
+)
+
+# Heavy modules a budgeted module may load (Streamlit imports plotly itself)
+ALLOWED_HEAVY = {
+    "src.slide_bar": ("plotly",),
+}
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PROBE = (
+    "import json, sys\n"
+    "import {module}\n"
+    "heavy = sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r}))\n"
+    "print(json.dumps(heavy))\n"
+)
+
+
+def measure_import(module):
+    """
+    Import a module in a fresh interpreter
+
+    Args:
+        module: Dotted module name
+
+    Returns:
+        tuple: (cumulative import time in ms, list of heavy modules loaded)
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        last_line = result.stderr.strip().splitlines()[-1]
+        raise RuntimeError(f"Cannot import {module}: {last_line}")
+
+    cumulative_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            cumulative_us = int(parts[1])
+
+    heavy = json.loads(result.stdout.strip().splitlines()[-1])
+    return cumulative_us / 1000, heavy
+
+
+def run_benchmark(repeat=5, scale=1.0):
+    """
+    Measure every budgeted module and compare against its budget
+
+    Args:
+        repeat: Number of fresh interpreters per module (median is kept)
+        scale: Multiplier applied to every budget (slow CI machines)
+
+    Returns:
+        list: One dict per module with timing, budget and failures
+    """
+    rows = []
+    for module, budget_ms in IMPORT_BUDGETS_MS.items():
+        row = {"module": module, "budget_ms": budget_ms * scale, "failures": []}
+        try:
+            samples = [measure_import(module) for _ in range(repeat)]
+        except RuntimeError as e:
+            row["median_ms"] = None
+            row["failures"].append(str(e))
+            rows.append(row)
+            continue
+
+        row["median_ms"] = statistics.median(ms for ms, _ in samples)
+        heavy = [
+            name for name in samples[-1][1]
+            if name not in ALLOWED_HEAVY.get(module, ())
+        ]
+        if row["median_ms"] > row["budget_ms"]:
+            row["failures"].append(
+                f"{row['median_ms']:.1f} ms exceeds budget of {row['budget_ms']:.1f} ms"
+            )
+        if heavy:
+            row["failures"].append(f"eagerly imports {', '.join(heavy)}")
+        rows.append(row)
+    return rows
+
+
+def main():
+    """Run the import-time benchmark and exit non-zero on failure"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0)
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print("Import-time benchmark")
+    print("=" * 50)
+
+    rows = run_benchmark(repeat=args.repeat, scale=args.scale)
+    for row in rows:
+        status = "✗" if row["failures"] else "✓"
+        median = "n/a" if row["median_ms"] is None else f"{row['median_ms']:8.1f} ms"
+        print(f"{status} {row['module']:<28} {median:>11}  (budget {row['budget_ms']:.0f} ms)")
+        for failure in row["failures"]:
+            print(f"    - {failure}")
+
+    failed = [row for row in rows if row["failures"]]
+    print("=" * 50)
+    if failed:
+        print(f"{len(failed)} module(s) over budget")
+        sys.exit(1)
+    print("All modules within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Login latency benchmark for the user store
+
+Fills a temporary user database with an increasing number of users and
+measures login latency for random existing users, with a cold in-process
+cache. The run fails (exit code 1) when p50 latency for the largest store
+is more than --max-growth times the latency for the smallest one.
+
+Usage:
+    python -m benchmarks.login_latency
+    python -m benchmarks.login_latency --sizes 10 10000 1000000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from src import authenticate
+
+
+def fill_store(size, batch_size=50000):
+    """Insert synthetic users into the current user database"""
+    conn = authenticate._connect()
+    password = authenticate.hash_password("password")
+    for offset in range(0, size, batch_size):
+        with conn.transaction():
+            conn.executemany(
+                "INSERT INTO users (username, password) VALUES (?, ?)",
+                ((f"user{i}", password) for i in range(offset, min(size, offset + batch_size)))
+            )
+
+
+def measure_logins(size, samples):
+    """Login as random users and return latencies in microseconds"""
+    latencies = []
+    for _ in range(samples):
+        username = f"user{random.randrange(size)}"
+        authenticate._cache_invalidate(username)
+        start = time.perf_counter()
+        success, _ = authenticate.login_user(username, "password")
+        latencies.append((time.perf_counter() - start) * 1e6)
+        assert success
+    return latencies
+
+
+def main():
+    """Run the login latency benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 10000, 1000000])
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--max-growth", type=float, default=3.0)
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print("Login latency benchmark")
+    print("=" * 50)
+
+    sizes = sorted(args.sizes)
+    p50 = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            authenticate.USERS_DB = os.path.join(tmp_dir, f"users_{size}.db")
+            fill_store(size)
+            latencies = measure_logins(size, args.samples)
+            p50[size] = statistics.median(latencies)
+            p95 = statistics.quantiles(latencies, n=20)[-1]
+            print(f"{size:>10,} users  p50 {p50[size]:7.1f} µs  p95 {p95:7.1f} µs")
+
+    growth = p50[sizes[-1]] / p50[sizes[0]]
+    print("=" * 50)
+    if growth > args.max_growth:
+        print(f"✗ p50 login latency grew {growth:.1f}x from {sizes[0]:,} to {sizes[-1]:,} users")
+        sys.exit(1)
+    print(f"✓ p50 login latency grew {growth:.1f}x from {sizes[0]:,} to {sizes[-1]:,} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+Performance regression gate
+
+Measures the main stages of the app offline and compares them to a stored
+baseline:
+
+    ingest_s          stream dsm5.docx into chunks, skip near-duplicates,
+                      summarize and embed them (ingest_documents)
+    ingest_peak_mb    peak Python memory while ingesting
+    build_s           build and persist the vector index (build_indexes)
+    load_s            load the index and its metadata (load_retrieval)
+    retrieve_ms       one retrieval through the sharded corpus (ShardedRetriever)
+    query_ms          one DSM5 query: category classification, retrieval,
+                      context packing and synthesis (dsm5_engine)
+    agent_init_ms     create a user's agent (initialize_agent)
+    chat_turn_ms      one agent turn: dsm5 tool call and answer
+
+The app's own functions run against the fake OpenAI-compatible server of
+benchmarks/rag_service.py, which answers chat completions at once and
+embeds with the deterministic HashingEmbedding, so timings cover our code
+path rather than model latency. Everything runs inside a temporary working
+directory, so no index or user data under data/ is touched.
+
+Every run is appended to eval_results/perf_history.jsonl. A stage regresses
+when its median is slower than the baseline median by more than both the
+relative --tolerance and --mad-factor times the baseline's median absolute
+deviation, so run-to-run noise does not fail the gate. A baseline measuring
+other stages is replaced by the current run. The run fails (exit code 1) on
+any regression.
+
+Usage:
+    python -m benchmarks.perf_regression
+    python -m benchmarks.perf_regression --update-baseline
+    python -m benchmarks.perf_regression --repeats 10 --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from src.global_settings import FILES_PATH
+
+HISTORY_FILE = "eval_results/perf_history.jsonl"
+BASELINE_FILE = "eval_results/perf_baseline.json"
+
+# Stage -> unit; every stage is "lower is better"
+STAGES = {
+    "ingest_s": "s",
+    "ingest_peak_mb": "MB",
+    "build_s": "s",
+    "load_s": "s",
+    "retrieve_ms": "ms",
+    "query_ms": "ms",
+    "agent_init_ms": "ms",
+    "chat_turn_ms": "ms",
+}
+
+USERNAME = "perf"
+
+PROBE_QUERIES = [
+    "Tiêu chuẩn chẩn đoán rối loạn trầm cảm chủ yếu là gì?",
+    "Các triệu chứng của rối loạn lo âu lan tỏa?",
+    "Rối loạn lưỡng cực ở trẻ em được chẩn đoán như thế nào?",
+    "Sự khác biệt giữa rối loạn điều hòa khí sắc và rối loạn lưỡng cực?",
+    "Những yếu tố nguy cơ của rối loạn căng thẳng sau sang chấn?",
+]
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _per_query_ms(fn):
+    """Mean milliseconds of fn over PROBE_QUERIES"""
+    start = time.perf_counter()
+    for query in PROBE_QUERIES:
+        fn(query)
+    return (time.perf_counter() - start) * 1000 / len(PROBE_QUERIES)
+
+
+def _measure_once(samples, files, repeat):
+    """Run every stage once, in a working directory of its own"""
+    from llama_index.core import Settings
+    from src import conversation_engine, corpus
+    from src.global_settings import INDEX_STORAGE
+    from src.index_builder import build_indexes
+    from src.ingest_pipeline import ingest_documents
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    # A fresh ingestion cache, so every repeat summarizes and embeds
+    nodes = ingest_documents(
+        files,
+        cache_file=f"pipeline_cache_{repeat}.json",
+        embed_model=Settings.embed_model,
+        report_file=f"build_report_{repeat}.json"
+    )
+    samples["ingest_s"].append(time.perf_counter() - start)
+    samples["ingest_peak_mb"].append(tracemalloc.get_traced_memory()[1] / 2**20)
+    tracemalloc.stop()
+
+    shutil.rmtree(INDEX_STORAGE, ignore_errors=True)
+    start = time.perf_counter()
+    build_indexes(nodes)
+    samples["build_s"].append(time.perf_counter() - start)
+
+    # Single index until the corpus has shards
+    conversation_engine._retrieval["state"] = None
+    start = time.perf_counter()
+    conversation_engine.load_retrieval()
+    samples["load_s"].append(time.perf_counter() - start)
+
+    # Serve it as a corpus shard, like `python -m src.corpus import-index`
+    corpus.import_index("dsm5", files=files)
+    retriever = corpus.sharded_retriever()
+    samples["retrieve_ms"].append(_per_query_ms(retriever.retrieve))
+    samples["query_ms"].append(_per_query_ms(
+        lambda query: conversation_engine.dsm5_engine(USERNAME, query).query(query)
+    ))
+
+    start = time.perf_counter()
+    agent, _ = conversation_engine.initialize_agent(USERNAME)
+    samples["agent_init_ms"].append((time.perf_counter() - start) * 1000)
+    samples["chat_turn_ms"].append(_per_query_ms(agent.chat))
+    # The fake LLM calls the dsm5 tool for every new message
+    if not any(source.tool_name == "dsm5" for source in agent.chat(PROBE_QUERIES[0]).sources):
+        raise RuntimeError("The agent answered without calling the dsm5 tool")
+    corpus.remove_shard("dsm5")
+
+
+def measure(repeats):
+    """
+    Run every stage repeats times
+
+    Returns:
+        dict: {stage: [sample, ...]}
+    """
+    from llama_index.core import Settings
+    from benchmarks.rag_service import FakeLLM, ServerThread, drain_writers
+    from benchmarks.retrieval import get_tokenizer
+    from src import rag_service
+
+    files = [os.path.abspath(path) for path in FILES_PATH]
+    Settings.tokenizer = get_tokenizer()[0]
+    servers = ServerThread()
+    http_clients = rag_service.create_http_clients()
+    rag_service.initialize_settings("sk-fake", f"{servers.serve(FakeLLM().create_app())}/v1", *http_clients)
+
+    samples = {stage: [] for stage in STAGES}
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+    try:
+        # The first run pays for imports and lazy loading, so it is not counted
+        _measure_once({stage: [] for stage in STAGES}, files, "warmup")
+        for repeat in range(repeats):
+            _measure_once(samples, files, repeat)
+    finally:
+        drain_writers()
+        http_clients[0].close()
+        asyncio.run_coroutine_threadsafe(http_clients[1].aclose(), servers.loop).result()
+        servers.stop()
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return samples
+
+
+def summarize(samples):
+    """Median and median absolute deviation of each stage"""
+    summary = {}
+    for stage, values in samples.items():
+        median = statistics.median(values)
+        summary[stage] = {
+            "median": median,
+            "mad": statistics.median(abs(v - median) for v in values),
+            "samples": values,
+        }
+    return summary
+
+
+def compare(current, baseline, tolerance, mad_factor):
+    """
+    Compare a run to the baseline
+
+    Returns:
+        list: (stage, baseline median, current median, change, threshold, regressed)
+    """
+    rows = []
+    for stage in STAGES:
+        if stage not in baseline or stage not in current:
+            continue
+        base = baseline[stage]["median"]
+        # 1.4826 * MAD estimates the standard deviation for normal noise
+        threshold = base + max(tolerance * base, mad_factor * 1.4826 * baseline[stage]["mad"])
+        value = current[stage]["median"]
+        change = (value - base) / base if base else 0.0
+        rows.append((stage, base, value, change, threshold, value > threshold))
+    return rows
+
+
+def print_report(rows):
+    """Diff report of each stage against the baseline"""
+    print(f"{'Stage':<15}{'Baseline':>12}{'Current':>12}{'Change':>10}{'Limit':>12}")
+    print("-" * 61)
+    for stage, base, value, change, threshold, regressed in rows:
+        unit = STAGES[stage]
+        mark = "✗" if regressed else "✓"
+        print(f"{stage:<15}{base:>9.3f} {unit:<2}{value:>9.3f} {unit:<2}"
+              f"{change:>+9.1%} {threshold:>9.3f} {unit:<2} {mark}")
+
+
+def main():
+    """Run the performance regression gate"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed relative slowdown of the median")
+    parser.add_argument("--mad-factor", type=float, default=3.0,
+                        help="Allowed slowdown in baseline standard deviations")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store this run as the new baseline")
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print("Performance regression gate")
+    print("=" * 50)
+
+    current = summarize(measure(args.repeats))
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "stages": current,
+    }
+
+    os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+    with open(HISTORY_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"✓ Run appended to: {HISTORY_FILE}")
+
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if set(baseline["stages"]) != set(STAGES):
+            print("Baseline measured other stages, replacing it")
+            baseline = None
+
+    if args.update_baseline or baseline is None:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=2)
+        print(f"✓ Baseline saved to: {BASELINE_FILE}")
+        print_report(compare(current, current, args.tolerance, args.mad_factor))
+        return
+
+    print(f"Baseline: {baseline['timestamp']} (commit {baseline.get('commit') or 'unknown'})\n")
+
+    rows = compare(current, baseline["stages"], args.tolerance, args.mad_factor)
+    print_report(rows)
+
+    regressions = [row[0] for row in rows if row[5]]
+    print("=" * 50)
+    if regressions:
+        print(f"✗ Regression in: {', '.join(regressions)}")
+        sys.exit(1)
+    print("✓ No stage regressed beyond tolerance")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+End-to-end check of the RAG service against a fake OpenAI-compatible LLM
+
+Starts, in one process and inside a temporary working directory (every
+store path is relative, and the background writers are drained before
+leaving it, so nothing under data/ is touched):
+
+- a fake LLM server speaking the OpenAI chat completions API (streamed or
+  not, calling the dsm5 tool for new user messages) and embeddings API
+  (deterministic hashing vectors), counting requests per TCP connection
+- the RAG service (src.rag_service) over a small index embedded through
+  the fake server
+
+then drives the service with src.rag_client from concurrent users:
+streamed chats (agent -> dsm5 tool -> retrieval and synthesis -> streamed
+answer), history, scores, clearing history and a direct dsm5 query, each
+signed for its user, and requests with another user's token or none.
+Reports answer latency and time to first streamed piece, and how many LLM
+requests each pooled connection served. The run fails (exit code 1) on a
+wrong response, or when the LLM client opened more connections than
+LLM_MAX_CONNECTIONS or did not reuse them.
+
+Usage:
+    python -m benchmarks.rag_service
+    python -m benchmarks.rag_service --users 20 --messages 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from src.global_settings import LLM_MAX_CONNECTIONS
+
+SERVICE_TOKEN = "benchmark-secret"
+
+DOCUMENTS = [
+    "Rối loạn trầm cảm chủ yếu: khí sắc trầm buồn hầu như cả ngày, mất hứng thú, "
+    "mệt mỏi, mất ngủ hoặc ngủ nhiều, kéo dài ít nhất hai tuần.",
+    "Rối loạn lo âu lan tỏa: lo lắng quá mức, khó kiểm soát, bồn chồn, căng cơ, "
+    "khó tập trung, kéo dài ít nhất sáu tháng.",
+    "Rối loạn giấc ngủ: khó đi vào giấc ngủ hoặc duy trì giấc ngủ, ít nhất ba đêm "
+    "mỗi tuần trong ba tháng, gây suy giảm chức năng ban ngày.",
+    "Rối loạn stress sau sang chấn: hồi tưởng xâm nhập, né tránh, thay đổi tiêu cực "
+    "trong nhận thức và khí sắc sau một sự kiện sang chấn.",
+]
+
+
+class FakeLLM:
+    """OpenAI-compatible chat completions and embeddings, counting connections"""
+
+    def __init__(self):
+        from src.embeddings import HashingEmbedding
+
+        self._embedding = HashingEmbedding()
+        self.requests = Counter()
+        self.connections = Counter()  # client (host, port) -> requests served
+
+    def _count(self, request, kind):
+        self.requests[kind] += 1
+        self.connections[request.transport.get_extra_info("peername")] += 1
+
+    async def embeddings(self, request):
+        self._count(request, "embeddings")
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response({
+            "object": "list",
+            "model": body["model"],
+            "data": [
+                {"object": "embedding", "index": i, "embedding": self._embedding._get_text_embedding(t)}
+                for i, t in enumerate(texts)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        })
+
+    @staticmethod
+    def _reply(body):
+        """The assistant message: a dsm5 tool call for a new user message, else text"""
+        messages = body["messages"]
+        last = messages[-1]
+        if body.get("tools") and last["role"] == "user":
+            return {"tool_call": {"query": last["content"]}}
+        if last["role"] == "tool":
+            return {"content": f"Theo DSM5: {last['content'][:120]}"}
+        # Synthesis of retrieved context by the dsm5 query engine
+        return {"content": "Tóm tắt tài liệu về triệu chứng và thời gian kéo dài."}
+
+    async def chat_completions(self, request):
+        self._count(request, "chat")
+        body = await request.json()
+        reply = self._reply(body)
+        created = int(time.time())
+        base = {"id": "chatcmpl-fake", "created": created, "model": body["model"]}
+
+        if "tool_call" in reply:
+            tool_call = {
+                "id": f"call_{self.requests['chat']}",
+                "type": "function",
+                "function": {"name": "dsm5", "arguments": json.dumps(reply["tool_call"], ensure_ascii=False)},
+            }
+            message = {"role": "assistant", "content": None, "tool_calls": [tool_call]}
+            finish = "tool_calls"
+        else:
+            message = {"role": "assistant", "content": reply["content"]}
+            finish = "stop"
+        usage = {"prompt_tokens": 50, "completion_tokens": 20, "total_tokens": 70}
+
+        if not body.get("stream"):
+            return web.json_response({
+                **base, "object": "chat.completion", "usage": usage,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta, finish_reason=None):
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        if "tool_call" in reply:
+            call = message["tool_calls"][0]
+            await send({"role": "assistant", "tool_calls": [
+                {"index": 0, "id": call["id"], "type": "function",
+                 "function": {"name": "dsm5", "arguments": ""}}
+            ]})
+            await send({"tool_calls": [{"index": 0, "function": {"arguments": call["function"]["arguments"]}}]})
+        else:
+            await send({"role": "assistant", "content": ""})
+            words = reply["content"].split(" ")
+            for i, word in enumerate(words):
+                await send({"content": word if i == 0 else " " + word})
+        await send({}, finish)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def create_app(self):
+        app = web.Application()
+        app.add_routes([
+            web.post("/v1/chat/completions", self.chat_completions),
+            web.post("/v1/embeddings", self.embeddings),
+        ])
+        return app
+
+
+class ServerThread:
+    """Event loop in a background thread serving aiohttp applications"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._runners = []
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def serve(self, app):
+        """Serve an application on a free local port and return its URL"""
+        async def start():
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            self._runners.append(runner)
+            return runner.addresses[0][1]
+
+        port = asyncio.run_coroutine_threadsafe(start(), self.loop).result()
+        return f"http://127.0.0.1:{port}"
+
+    def stop(self):
+        async def cleanup():
+            for runner in reversed(self._runners):
+                await runner.cleanup()
+
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def build_index():
+    """Index DOCUMENTS with the configured (fake) embedding model"""
+    from llama_index.core.schema import TextNode
+    from src.index_builder import build_indexes
+
+    nodes = [TextNode(text=text, id_=f"doc_{i}") for i, text in enumerate(DOCUMENTS)]
+    build_indexes(nodes)
+
+
+def drain_writers(timeout=30):
+    """
+    Wait for the writes the run left to background workers
+
+    Chat persistence, user stats, user memory and token usage are written
+    off the request path; they must land in the temporary directory before
+    the working directory changes back.
+
+    Returns:
+        bool: False if a worker did not finish within the timeout
+    """
+    from src import metering, persistence, user_memory
+
+    drained = persistence.wait_until_flushed(timeout)
+    # Memory updates may queue more persistence work
+    drained = user_memory.wait_until_idle(timeout) and drained
+    drained = persistence.wait_until_flushed(timeout) and drained
+    metering.flush()
+    return drained
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_user(rag_client, username, messages):
+    """
+    Chat as one user and check the answers
+
+    Returns:
+        tuple: (answer latencies, first-piece latencies, failures)
+    """
+    latencies, first_pieces, failures = [], [], []
+    for i in range(messages):
+        start = time.perf_counter()
+        first = None
+        stream = rag_client.stream_chat(username, f"Tôi mất ngủ và lo âu kéo dài, lần {i}")
+        pieces = []
+        for piece in stream:
+            if first is None:
+                first = time.perf_counter() - start
+            pieces.append(piece)
+        latencies.append(time.perf_counter() - start)
+        first_pieces.append(first or latencies[-1])
+        answer = "".join(pieces).strip()
+        if not answer.startswith("Theo DSM5") or answer != stream.response:
+            failures.append(f"{username} message {i}: unexpected answer {answer[:60]!r}")
+
+    history = rag_client.get_history(username)
+    sent = [m for m in history if m.role == "user"]
+    answered = [m for m in history if m.role == "assistant" and m.content]
+    if len(sent) != messages or len(answered) != messages:
+        failures.append(f"{username}: history has {len(sent)} questions, {len(answered)} answers")
+    return latencies, first_pieces, failures
+
+
+def main():
+    """Run the RAG service end-to-end check"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=8, help="Concurrent users")
+    parser.add_argument("--messages", type=int, default=3, help="Messages per user")
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print("RAG service end-to-end check")
+    print("=" * 50)
+
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+    servers = ServerThread()
+    failures = []
+    try:
+        from llama_index.core import Settings
+        from benchmarks.retrieval import get_tokenizer
+        from src import rag_client, rag_service
+
+        Settings.tokenizer = get_tokenizer()[0]
+        fake = FakeLLM()
+        llm_url = servers.serve(fake.create_app())
+
+        http_clients = rag_service.create_http_clients()
+        rag_service.initialize_settings("sk-fake", f"{llm_url}/v1", *http_clients)
+        build_index()
+        print(f"✓ Index of {len(DOCUMENTS)} documents built through the fake LLM")
+
+        # Sign requests per user, as a service reachable from other hosts must
+        service = rag_service.RagService(token=SERVICE_TOKEN)
+        rag_client.RAG_SERVICE_TOKEN = SERVICE_TOKEN
+        rag_client.RAG_SERVICE_URL = servers.serve(service.create_app(http_clients))
+        print(f"✓ Service at {rag_client.RAG_SERVICE_URL}, fake LLM at {llm_url}")
+
+        start = time.perf_counter()
+        usernames = [f"user{i}" for i in range(args.users)]
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            results = list(pool.map(lambda u: run_user(rag_client, u, args.messages), usernames))
+        elapsed = time.perf_counter() - start
+
+        latencies = [x for r in results for x in r[0]]
+        first_pieces = [x for r in results for x in r[1]]
+        for r in results:
+            failures.extend(r[2])
+
+        # Scores, clearing history and a direct dsm5 query
+        rag_client.save_score("Bình thường", "Ngủ kém nhưng ổn định", "Theo dõi thêm", usernames[0])
+        version, scores = rag_client.get_scores(usernames[0])
+        if len(scores) != 1 or scores[0]["Score"] != "Bình thường":
+            failures.append(f"scores: expected the saved assessment, got {scores}")
+        rag_client.clear_history(usernames[0])
+        if rag_client.get_history(usernames[0]):
+            failures.append("history: not empty after clearing")
+        result = rag_client.query_dsm5("triệu chứng mất ngủ", username=usernames[0])
+        if not result["response"] or not result["sources"]:
+            failures.append("dsm5: no answer or no sources")
+
+        # A user's token must not reach another user's data
+        response = rag_client._get_client().get(f"/scores/{usernames[0]}", headers=rag_client._headers("intruder"))
+        if response.status_code != 403:
+            failures.append(f"auth: another user's token got {response.status_code} instead of 403")
+        response = rag_client._get_client().get(f"/history/{usernames[0]}")
+        if response.status_code != 401:
+            failures.append(f"auth: a request without a token got {response.status_code} instead of 401")
+
+        chats = len(latencies)
+        print(f"\nChats:              {chats} ({args.users} users x {args.messages} messages)")
+        print(f"Throughput:         {chats / elapsed:.1f} chats/s")
+        print(f"Answer latency:     p50 {statistics.median(latencies) * 1000:.0f} ms, "
+              f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms")
+        print(f"First piece:        p50 {statistics.median(first_pieces) * 1000:.0f} ms")
+        llm_requests = sum(fake.requests.values())
+        connections = len(fake.connections)
+        print(f"LLM requests:       {fake.requests['chat']} chat, {fake.requests['embeddings']} embeddings")
+        print(f"LLM connections:    {connections} ({llm_requests / max(connections, 1):.1f} requests each)")
+
+        if connections > LLM_MAX_CONNECTIONS:
+            failures.append(f"LLM connections: {connections} > LLM_MAX_CONNECTIONS ({LLM_MAX_CONNECTIONS})")
+        if connections >= llm_requests:
+            failures.append("LLM connections: no connection was reused")
+
+        sync_client, async_client = http_clients
+        sync_client.close()
+        asyncio.run_coroutine_threadsafe(async_client.aclose(), servers.loop).result()
+    finally:
+        if not drain_writers():
+            failures.append("background writers: still busy when the run ended")
+        servers.stop()
+        os.chdir(cwd)
+
+    print("=" * 50)
+    if failures:
+        for failure in failures:
+            print(f"✗ {failure}")
+        sys.exit(1)
+    print("✓ Streamed chats, history, scores and dsm5 queries answered correctly")
+
+
+if __name__ == "__main__":
+    main()
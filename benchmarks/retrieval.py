@@ -0,0 +1,318 @@
+"""
+Retrieval benchmark: quality and latency of the vector retriever
+
+Uses the question / reference-context pairs saved by evaluate.py to score
+the retriever behind as_query_engine() without any LLM calls: hit@k, MRR
+and nDCG@k, plus p50/p95 search latency and queries per second, for each
+combination of top-k, chunk size and vector store backend.
+
+A retrieved chunk counts as relevant when it shares at least half of its
+word 8-grams with a reference context (relative to the smaller of the two),
+so chunkings other than the one the questions were generated from can be
+compared. Query embeddings are computed once per configuration and reused,
+so latency measures the vector search alone.
+
+Runs fully offline with the deterministic HashingEmbedding by default. The
+run fails (exit code 1) when no question can be matched to a chunk, or when
+hit@k of the app's configuration is below --min-hit-rate.
+
+Usage:
+    python -m benchmarks.retrieval
+    python -m benchmarks.retrieval --top-k 1 3 5 10 --chunk-sizes 256 512 1024
+    python -m benchmarks.retrieval --backends simple chroma faiss --embedding openai
+    python -m benchmarks.retrieval --embedding local
+"""
+
+import argparse
+import ast
+import math
+import os
+import re
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from src.global_settings import CHUNK_SIZE, CHUNK_OVERLAP, FILES_PATH, SIMILARITY_TOP_K
+from src.embeddings import EMBEDDING_BACKENDS, get_embed_model
+from src.eval_results import latest_questions_file
+
+SHINGLE_SIZE = 8
+MIN_OVERLAP = 0.5
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def load_questions(path):
+    """
+    Load question / reference-context pairs
+
+    Returns:
+        list: (query, [reference context, ...]) tuples
+    """
+    import pandas as pd
+
+    df = pd.read_csv(path, encoding="utf-8-sig")
+    questions = []
+    for query, contexts in zip(df["query"], df["reference_contexts"]):
+        contexts = ast.literal_eval(contexts) if isinstance(contexts, str) else []
+        questions.append((query, contexts))
+    return questions
+
+
+def get_tokenizer():
+    """
+    Tokenizer for chunking: tiktoken's cl100k_base if it is available
+    locally, otherwise a word/punctuation splitter of similar granularity
+
+    Returns:
+        tuple: (tokenizer callable, name)
+    """
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base").encode, "cl100k_base"
+    except Exception:
+        return _WORD_RE.findall, "words (tiktoken encoding unavailable offline)"
+
+
+def chunk_documents(documents, chunk_size, tokenizer):
+    """Split documents the way TokenTextSplitter does, in a process pool"""
+    from src.token_chunker import split_documents
+
+    return split_documents(documents, chunk_size, CHUNK_OVERLAP, tokenizer)
+
+
+def shingles(text):
+    """Set of word n-grams used to match chunks to reference contexts"""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def relevant_ids(nodes, questions):
+    """
+    Chunks relevant to each question
+
+    Returns:
+        list: Set of relevant node ids per question
+    """
+    node_shingles = [(node.node_id, shingles(node.get_content())) for node in nodes]
+    relevant = []
+    for _, contexts in questions:
+        ids = set()
+        for context in contexts:
+            reference = shingles(context)
+            if not reference:
+                continue
+            for node_id, chunk in node_shingles:
+                if chunk and len(chunk & reference) / min(len(chunk), len(reference)) >= MIN_OVERLAP:
+                    ids.add(node_id)
+        relevant.append(ids)
+    return relevant
+
+
+def _simple_store(dim):
+    from llama_index.core.vector_stores import SimpleVectorStore
+
+    return SimpleVectorStore()
+
+
+def _faiss_store(dim):
+    import faiss
+    from llama_index.vector_stores.faiss import FaissVectorStore
+
+    # Embeddings are L2-normalized, so inner product is cosine similarity
+    return FaissVectorStore(faiss_index=faiss.IndexFlatIP(dim))
+
+
+def _chroma_store(dim):
+    import chromadb
+    from llama_index.vector_stores.chroma import ChromaVectorStore
+
+    client = chromadb.EphemeralClient()
+    name = f"bench_{time.time_ns()}"
+    collection = client.create_collection(name, metadata={"hnsw:space": "cosine"})
+    return ChromaVectorStore(chroma_collection=collection)
+
+
+# Backend name -> vector store factory; optional backends are skipped when
+# their packages are not installed
+BACKENDS = {
+    "simple": _simple_store,
+    "faiss": _faiss_store,
+    "chroma": _chroma_store,
+}
+
+
+def build_index(nodes, backend, embed_model):
+    """
+    Build a vector index over nodes in the given backend
+
+    Returns:
+        tuple: (VectorStoreIndex, build seconds)
+    """
+    from llama_index.core import StorageContext, VectorStoreIndex
+
+    dim = len(embed_model.get_text_embedding("dim"))
+    vector_store = BACKENDS[backend](dim)
+    start = time.perf_counter()
+    index = VectorStoreIndex(
+        nodes,
+        storage_context=StorageContext.from_defaults(vector_store=vector_store),
+        embed_model=embed_model
+    )
+    return index, time.perf_counter() - start
+
+
+def score_rankings(retrieved, relevant, top_k):
+    """
+    Quality metrics for one question
+
+    Args:
+        retrieved: Retrieved node ids in rank order
+        relevant: Set of relevant node ids
+        top_k: Cutoff
+
+    Returns:
+        tuple: (hit, reciprocal rank, nDCG)
+    """
+    retrieved = retrieved[:top_k]
+    gains = [1.0 if node_id in relevant else 0.0 for node_id in retrieved]
+    hit = 1.0 if any(gains) else 0.0
+    reciprocal_rank = next((1.0 / (rank + 1) for rank, gain in enumerate(gains) if gain), 0.0)
+    dcg = sum(gain / math.log2(rank + 2) for rank, gain in enumerate(gains))
+    ideal = sum(1.0 / math.log2(rank + 2) for rank in range(min(top_k, len(relevant))))
+    return hit, reciprocal_rank, dcg / ideal if ideal else 0.0
+
+
+def run_config(index, query_bundles, relevant, top_k, repeats):
+    """
+    Measure one (index, top-k) configuration
+
+    Returns:
+        dict: hit_rate, mrr, ndcg, p50_ms, p95_ms, qps
+    """
+    retriever = index.as_retriever(similarity_top_k=top_k)
+    hits, reciprocal_ranks, ndcgs, latencies = [], [], [], []
+
+    for bundle, relevant_set in zip(query_bundles, relevant):
+        for repeat in range(repeats):
+            start = time.perf_counter()
+            results = retriever.retrieve(bundle)
+            latencies.append(time.perf_counter() - start)
+        hit, reciprocal_rank, ndcg = score_rankings(
+            [result.node.node_id for result in results], relevant_set, top_k
+        )
+        hits.append(hit)
+        reciprocal_ranks.append(reciprocal_rank)
+        ndcgs.append(ndcg)
+
+    latencies.sort()
+    return {
+        "hit_rate": statistics.mean(hits),
+        "mrr": statistics.mean(reciprocal_ranks),
+        "ndcg": statistics.mean(ndcgs),
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        "qps": len(latencies) / sum(latencies),
+    }
+
+
+def main():
+    """Run the retrieval benchmark"""
+    import pandas as pd
+    from llama_index.core import QueryBundle, SimpleDirectoryReader
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--questions", help="Question CSV (newest in eval_results/ by default)")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, SIMILARITY_TOP_K, 5, 10])
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[256, CHUNK_SIZE, 1024])
+    parser.add_argument("--backends", nargs="+", default=["simple", "chroma"], choices=list(BACKENDS))
+    parser.add_argument("--embedding", choices=EMBEDDING_BACKENDS, default="hashing")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed searches per question")
+    parser.add_argument("--min-hit-rate", type=float, default=0.0,
+                        help=f"Fail if hit@{SIMILARITY_TOP_K} at chunk size {CHUNK_SIZE} is lower")
+    args = parser.parse_args()
+
+    questions_path = args.questions or latest_questions_file()
+    if not questions_path:
+        print("✗ No question set found, run evaluate.py first or pass --questions")
+        sys.exit(1)
+
+    print("=" * 50)
+    print("Retrieval benchmark")
+    print("=" * 50)
+
+    questions = load_questions(questions_path)
+    documents = SimpleDirectoryReader(input_files=FILES_PATH, filename_as_id=True).load_data()
+    tokenizer, tokenizer_name = get_tokenizer()
+    embed_model = get_embed_model(args.embedding)
+    print(f"Questions:  {len(questions)} from {questions_path}")
+    print(f"Tokenizer:  {tokenizer_name}")
+    print(f"Embedding:  {type(embed_model).__name__}")
+
+    rows = []
+    for chunk_size in sorted(set(args.chunk_sizes)):
+        nodes = chunk_documents(documents, chunk_size, tokenizer)
+        relevant = relevant_ids(nodes, questions)
+        matched = [i for i, ids in enumerate(relevant) if ids]
+        if not matched:
+            print(f"✗ chunk size {chunk_size}: no question matches any chunk")
+            sys.exit(1)
+
+        start = time.perf_counter()
+        query_bundles = [
+            QueryBundle(questions[i][0], embedding=embed_model.get_query_embedding(questions[i][0]))
+            for i in matched
+        ]
+        embed_ms = (time.perf_counter() - start) * 1000 / len(matched)
+        relevant = [relevant[i] for i in matched]
+        print(f"\nchunk size {chunk_size}: {len(nodes)} chunks, "
+              f"{len(matched)}/{len(questions)} questions matched, "
+              f"query embedding {embed_ms:.2f} ms")
+
+        for backend in args.backends:
+            try:
+                index, build_s = build_index(nodes, backend, embed_model)
+            except ImportError as e:
+                print(f"  {backend:<7} skipped ({e.name} not installed)")
+                continue
+
+            for top_k in sorted(set(args.top_k)):
+                metrics = run_config(index, query_bundles, relevant, top_k, args.repeats)
+                rows.append({
+                    "chunk_size": chunk_size,
+                    "backend": backend,
+                    "top_k": top_k,
+                    **metrics,
+                    "build_s": build_s,
+                    "embed_ms": embed_ms,
+                })
+                print(f"  {backend:<7} k={top_k:<3} hit {metrics['hit_rate']:.3f}  "
+                      f"MRR {metrics['mrr']:.3f}  nDCG {metrics['ndcg']:.3f}  "
+                      f"p50 {metrics['p50_ms']:.2f} ms  p95 {metrics['p95_ms']:.2f} ms  "
+                      f"{metrics['qps']:,.0f} q/s")
+
+    os.makedirs("eval_results", exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output = f"eval_results/retrieval_benchmark_{timestamp}.csv"
+    pd.DataFrame(rows).to_csv(output, index=False, encoding="utf-8-sig")
+
+    print("\n" + "=" * 50)
+    print(f"✓ Results saved to: {output}")
+
+    app_config = [
+        row for row in rows
+        if row["chunk_size"] == CHUNK_SIZE and row["top_k"] == SIMILARITY_TOP_K
+        and row["backend"] == "simple"
+    ]
+    if app_config and app_config[0]["hit_rate"] < args.min_hit_rate:
+        print(f"✗ hit@{SIMILARITY_TOP_K} {app_config[0]['hit_rate']:.3f} "
+              f"is below {args.min_hit_rate:.3f}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,12 @@ Evaluation script for the Mental Health Care System
 
 import sys
 import os
+import json
+import time
 import asyncio
+import random
+import argparse
+import functools
 import pandas as pd
 import nest_asyncio
 from datetime import datetime
@@ -15,7 +20,6 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from llama_index.core import Settings
 from llama_index.llms.openai import OpenAI
 from llama_index.core.evaluation import (
-    BatchEvalRunner,
     CorrectnessEvaluator,
     FaithfulnessEvaluator,
     RelevancyEvaluator
@@ -23,9 +27,22 @@ from llama_index.core.evaluation import (
 from llama_index.core.llama_dataset.generator import RagDatasetGenerator
 import openai
 
+from src import judge_cache, metering
+from src.credentials import get_api_key
+from src.eval_results import latest_questions_file
+from src.embeddings import get_embed_model
 from src.ingest_pipeline import ingest_documents
-from src.index_builder import build_indexes
-from src.global_settings import DEFAULT_MODEL, DEFAULT_TEMPERATURE, SIMILARITY_TOP_K
+from src.index_builder import build_indexes, load_index
+from src.global_settings import (
+    SECRETS_FILE,
+    DEFAULT_MODEL,
+    DEFAULT_TEMPERATURE,
+    SIMILARITY_TOP_K,
+    CONTEXT_TOKEN_BUDGET,
+    EVAL_WORKERS,
+    EVAL_REQUESTS_PER_MINUTE,
+    EVAL_MAX_RETRIES
+)
 
 # Apply nested asyncio
 nest_asyncio.apply()
@@ -33,8 +50,10 @@ nest_asyncio.apply()
 
 def initialize_settings(api_key):
     """Initialize OpenAI settings"""
+    metering.install()
     openai.api_key = api_key
     Settings.llm = OpenAI(model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE)
+    Settings.embed_model = get_embed_model()
 
 
 def generate_questions(nodes, num_questions_per_chunk=1):
@@ -44,69 +63,275 @@ def generate_questions(nodes, num_questions_per_chunk=1):
         nodes, 
         num_questions_per_chunk=num_questions_per_chunk
     )
-    eval_questions = dataset_generator.generate_questions_from_nodes()
+    with metering.attribute(feature="evaluation", stage="questions"):
+        eval_questions = dataset_generator.generate_questions_from_nodes()
     df = eval_questions.to_pandas()
     print(f"✓ Generated {len(df)} questions")
     return df
 
 
-async def evaluate_async(query_engine, df):
-    """Run async evaluation"""
+def sample_questions(df, n, stratify_by=None, seed=0):
+    """
+    Draw a stratified sample of questions
+
+    Each stratum gets a share of the sample proportional to its size. Without
+    a stratify column the questions are split into contiguous blocks; they are
+    generated in document order, so the sample covers the whole document.
+
+    Args:
+        df: Questions DataFrame
+        n: Number of questions to keep
+        stratify_by: Column to stratify on
+        seed: Random seed, so a sample can be reproduced
+
+    Returns:
+        DataFrame: Sampled questions with their original row labels
+    """
+    if n >= len(df):
+        return df
+
+    if stratify_by:
+        strata = df[stratify_by].fillna("").astype(str)
+    else:
+        strata = pd.Series([i * n // len(df) for i in range(len(df))], index=df.index)
+    groups = df.groupby(strata, sort=False).groups
+
+    # Largest remainder allocation of n across strata
+    quotas = {key: n * len(labels) / len(df) for key, labels in groups.items()}
+    allocation = {key: int(quota) for key, quota in quotas.items()}
+    remainders = sorted(quotas, key=lambda key: quotas[key] - allocation[key], reverse=True)
+    for key in remainders[:n - sum(allocation.values())]:
+        allocation[key] += 1
+
+    rng = random.Random(seed)
+    picked = []
+    for key, labels in groups.items():
+        picked.extend(rng.sample(list(labels), allocation[key]))
+    return df.loc[sorted(picked)]
+
+
+def load_run_questions(header):
+    """
+    Load the questions of a run described by a checkpoint header
+
+    Returns:
+        DataFrame: Questions in the order they were evaluated
+    """
+    df = pd.read_csv(header["questions"], encoding='utf-8-sig')
+    if header.get("sample") is not None:
+        df = df.loc[header["sample"]]
+    return df.reset_index(drop=True)
+
+
+METRICS = ("correctness", "faithfulness", "relevancy")
+
+
+class RateLimiter:
+    """Async limiter spacing calls evenly to at most N per minute"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    Load a run's checkpoint file
+
+    The first line is a header with the run metadata, every other line is
+    the result for one question.
+
+    Returns:
+        tuple: (header dict, dict of records keyed by question index)
+    """
+    header, records = {}, {}
+    if not os.path.exists(checkpoint_path):
+        return header, records
+
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave the last line half written
+                continue
+            if "Index" in item:
+                records[item["Index"]] = item
+            else:
+                header = item
+    return header, records
+
+
+def iter_checkpoint(checkpoint_path):
+    """Stream result records from a checkpoint file"""
+    _, records = load_checkpoint(checkpoint_path)
+    yield from records.values()
+
+
+def _result_record(index, question, results):
+    """Flatten the evaluator results for one question"""
+    record = {"Index": index, "Query": question}
+    for metric in METRICS:
+        result = results[metric]
+        name = metric.capitalize()
+        record[f"{name}_response"] = result.response
+        record[f"{name}_passing"] = result.passing
+        record[f"{name}_feedback"] = result.feedback
+        record[f"{name}_score"] = result.score
+    return record
+
+
+async def evaluate_async(query_engine, df, checkpoint_path, workers=EVAL_WORKERS,
+                         requests_per_minute=EVAL_REQUESTS_PER_MINUTE, use_cache=True):
+    """
+    Run async evaluation with bounded concurrency and checkpointing
+
+    Each question's results are appended to the checkpoint as soon as they
+    complete; questions already in the checkpoint are skipped, so an
+    interrupted run resumes where it stopped.
+
+    Args:
+        query_engine: Query engine under evaluation
+        df: Questions DataFrame with a 'query' column
+        checkpoint_path: JSONL checkpoint file
+        workers: Maximum questions evaluated concurrently
+        requests_per_minute: Rate limit shared by all LLM calls (0 = none)
+        use_cache: Reuse cached judgments for unchanged (query, response, contexts)
+
+    Returns:
+        tuple: (number of questions evaluated now, number failed)
+    """
     print("\nRunning evaluation...")
-    
-    correctness_evaluator = CorrectnessEvaluator()
-    faithfulness_evaluator = FaithfulnessEvaluator()
-    relevancy_evaluator = RelevancyEvaluator()
-    
-    runner = BatchEvalRunner(
-        {
-            "correctness": correctness_evaluator,
-            "faithfulness": faithfulness_evaluator,
-            "relevancy": relevancy_evaluator
-        },
-        show_progress=True
-    )
-    
-    eval_result = await runner.aevaluate_queries(
-        query_engine=query_engine,
-        queries=[question for question in df['query']],
-    )
-    
-    return eval_result
 
+    evaluators = {
+        "correctness": CorrectnessEvaluator(),
+        "faithfulness": FaithfulnessEvaluator(),
+        "relevancy": RelevancyEvaluator()
+    }
+
+    _, done = load_checkpoint(checkpoint_path)
+    pending = [(i, q) for i, q in enumerate(df['query']) if i not in done]
+    print(f"{len(done)} questions already in checkpoint, {len(pending)} to evaluate")
+
+    semaphore = asyncio.Semaphore(workers)
+    limiter = RateLimiter(requests_per_minute)
+    write_lock = asyncio.Lock()
+    progress = {"done": 0, "failed": 0}
+
+    async def call(fn, **kwargs):
+        """Rate-limited call with exponential backoff"""
+        for attempt in range(EVAL_MAX_RETRIES + 1):
+            await limiter.acquire()
+            try:
+                return await fn(**kwargs)
+            except Exception:
+                if attempt == EVAL_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    async def judge(metric, question, response, contexts):
+        """Run one evaluator, through the judge cache unless disabled"""
+        evaluator = evaluators[metric]
+        evaluate_fn = functools.partial(call, evaluator.aevaluate)
+        with metering.attribute(feature="evaluation", stage=f"judge_{metric}"):
+            if not use_cache:
+                return await evaluate_fn(query=question, response=response, contexts=contexts)
+            return await judge_cache.aevaluate(
+                metric, evaluator, question, response, contexts, evaluate_fn=evaluate_fn
+            )
+
+    async def evaluate_question(index, question):
+        async with semaphore:
+            try:
+                with metering.attribute(feature="evaluation", stage="query"):
+                    response = await call(query_engine.aquery, str_or_query_bundle=question)
+                contexts = [node.get_content() for node in response.source_nodes]
+                results = await asyncio.gather(*[
+                    judge(metric, question, response.response, contexts)
+                    for metric in METRICS
+                ])
+            except Exception as e:
+                progress["failed"] += 1
+                print(f"✗ Question {index} failed: {e!r}")
+                return
+
+            record = _result_record(index, question, dict(zip(METRICS, results)))
+            async with write_lock:
+                with open(checkpoint_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                progress["done"] += 1
+                print(f"✓ [{len(done) + progress['done']}/{len(df)}] question {index}")
+
+    await asyncio.gather(*[evaluate_question(i, q) for i, q in pending])
+    return progress["done"], progress["failed"]
 
-def aggregate_results(df, eval_result):
-    """Aggregate evaluation results"""
+
+def aggregate_results(df, records):
+    """
+    Aggregate evaluation results
+
+    Args:
+        df: Questions DataFrame, used for ordering
+        records: Result records or a checkpoint file path
+
+    Returns:
+        DataFrame: One row per evaluated question
+    """
     print("\nAggregating results...")
-    data = []
-    
-    for i, question in enumerate(df['query']):
-        correctness_result = eval_result['correctness'][i]
-        faithfulness_result = eval_result['faithfulness'][i]
-        relevancy_result = eval_result['relevancy'][i]
-        
-        data.append({
-            'Query': question,
-            'Correctness_response': correctness_result.response,
-            'Correctness_passing': correctness_result.passing,
-            'Correctness_feedback': correctness_result.feedback,
-            'Correctness_score': correctness_result.score,
-            'Faithfulness_response': faithfulness_result.response,
-            'Faithfulness_passing': faithfulness_result.passing,
-            'Faithfulness_feedback': faithfulness_result.feedback,
-            'Faithfulness_score': faithfulness_result.score,
-            'Relevancy_response': relevancy_result.response,
-            'Relevancy_passing': relevancy_result.passing,
-            'Relevancy_feedback': relevancy_result.feedback,
-            'Relevancy_score': relevancy_result.score,
-        })
-    
-    df_result = pd.DataFrame(data)
-    return df_result
+    if isinstance(records, str):
+        records = iter_checkpoint(records)
+
+    by_index = {record["Index"]: record for record in records}
+    data = [by_index[i] for i in range(len(df)) if i in by_index]
+
+    columns = ["Query"] + [
+        f"{metric.capitalize()}_{field}"
+        for metric in METRICS
+        for field in ("response", "passing", "feedback", "score")
+    ]
+    return pd.DataFrame(data, columns=columns)
 
 
-def print_and_save_scores(df_result):
-    """Print and save average scores"""
+def format_cache_stats(cache_stats):
+    """Summary lines with the judge cache hit rate per metric"""
+    lines = []
+    for metric, stats in cache_stats.items():
+        total = stats["hits"] + stats["misses"]
+        lines.append(
+            f"{metric.capitalize() + ' cache:':<21}{stats['hits']}/{total} hits "
+            f"({stats['hit_rate']:.0%})"
+        )
+    return lines
+
+
+def format_packing_stats(packing_stats):
+    """Summary line with the context tokens saved by packing"""
+    if not packing_stats or not packing_stats["calls"]:
+        return []
+    return [
+        f"{'Context tokens:':<21}{packing_stats['tokens_in'] / packing_stats['calls']:.0f} -> "
+        f"{packing_stats['tokens_out'] / packing_stats['calls']:.0f} per query "
+        f"(-{packing_stats['saved']:.0%})"
+    ]
+
+
+def print_and_save_scores(df_result, cache_stats=None, packing_stats=None):
+    """Print and save average scores, with judge cache and packing stats if given"""
     correctness_scores = df_result['Correctness_score'].mean()
     faithfulness_scores = df_result['Faithfulness_score'].mean()
     relevancy_scores = df_result['Relevancy_score'].mean()
@@ -117,6 +342,11 @@ def print_and_save_scores(df_result):
     print(f"Correctness scores:  {correctness_scores:.4f}")
     print(f"Faithfulness scores: {faithfulness_scores:.4f}")
     print(f"Relevancy scores:    {relevancy_scores:.4f}")
+    cache_lines = format_cache_stats(cache_stats or {}) + format_packing_stats(packing_stats)
+    if cache_lines:
+        print("-" * 50)
+        for line in cache_lines:
+            print(line)
     print("=" * 50)
     
     # Save results
@@ -139,6 +369,8 @@ def print_and_save_scores(df_result):
         f.write(f"Correctness scores:  {correctness_scores:.4f}\n")
         f.write(f"Faithfulness scores: {faithfulness_scores:.4f}\n")
         f.write(f"Relevancy scores:    {relevancy_scores:.4f}\n")
+        for line in cache_lines:
+            f.write(line + "\n")
     print(f"✓ Summary saved to: eval_results/average_scores_{timestamp}.txt")
     
     return correctness_scores, faithfulness_scores, relevancy_scores
@@ -146,58 +378,167 @@ def print_and_save_scores(df_result):
 
 def main():
     """Main evaluation function"""
+    parser = argparse.ArgumentParser(description="Evaluate the Mental Health Care System")
+    parser.add_argument("--questions", metavar="CSV",
+                        help="Reuse a saved question set ('latest' for the newest one) "
+                             "instead of generating questions")
+    parser.add_argument("--sample", type=int, metavar="N",
+                        help="Evaluate a stratified sample of N questions")
+    parser.add_argument("--stratify-by", metavar="COLUMN",
+                        help="Question column to stratify the sample on")
+    parser.add_argument("--seed", type=int, default=0, help="Sampling seed")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Re-ingest documents and rebuild the index first")
+    parser.add_argument("--workers", type=int, default=EVAL_WORKERS,
+                        help="Questions evaluated concurrently")
+    parser.add_argument("--rpm", type=int, default=EVAL_REQUESTS_PER_MINUTE,
+                        help="Maximum LLM requests per minute (0 = unlimited)")
+    parser.add_argument("--context-budget", type=int, default=None,
+                        help=f"Token budget of the packed context (0 = no context packing, "
+                             f"default {CONTEXT_TOKEN_BUDGET}, or the resumed run's)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Re-judge every item instead of reusing cached judgments")
+    parser.add_argument("--resume", metavar="CHECKPOINT",
+                        help="Resume an interrupted run from its checkpoint file")
+    parser.add_argument("--summarize", metavar="CHECKPOINT",
+                        help="Only aggregate and save scores from a checkpoint")
+    args = parser.parse_args()
+
     print("=" * 50)
     print("Mental Health Care System - Evaluation")
     print("=" * 50)
+
+    if args.summarize:
+        header, _ = load_checkpoint(args.summarize)
+        df_questions = load_run_questions(header)
+        df_result = aggregate_results(df_questions, args.summarize)
+        print(f"✓ {len(df_result)}/{len(df_questions)} questions evaluated so far")
+        print_and_save_scores(df_result)
+        return
+
+    if args.resume:
+        # Every row of a run is judged with the same context budget
+        header, _ = load_checkpoint(args.resume)
+        run_budget = header.get("context_budget", args.context_budget)
+        if args.context_budget is not None and run_budget is not None and args.context_budget != run_budget:
+            print(f"Error: {args.resume} was run with --context-budget {run_budget}, "
+                  f"not {args.context_budget}; resume it without the option")
+            sys.exit(1)
+        args.context_budget = run_budget
+    if args.context_budget is None:
+        args.context_budget = CONTEXT_TOKEN_BUDGET
     
     # Get API key
-    api_key = input("\nEnter your OpenAI API key: ").strip()
+    api_key = get_api_key()
     if not api_key:
-        print("Error: API key is required!")
-        return
+        print(f"Error: set OPENAI_API_KEY or add it to {SECRETS_FILE}")
+        sys.exit(1)
     
     # Initialize
-    print("\n[1/5] Initializing settings...")
+    print("\n[1/4] Initializing settings...")
     initialize_settings(api_key)
     print("✓ Settings initialized")
     
-    # Load nodes
-    print("\n[2/5] Loading documents and creating nodes...")
-    nodes = ingest_documents()
-    print(f"✓ Loaded {len(nodes)} nodes")
-    
-    # Build index
-    print("\n[3/5] Building index...")
-    index = build_indexes(nodes)
-    query_engine = index.as_query_engine(similarity_top_k=SIMILARITY_TOP_K)
-    print("✓ Index and query engine created")
-    
-    # Generate questions
-    print("\n[4/5] Generating evaluation questions...")
-    df_questions = generate_questions(nodes, num_questions_per_chunk=1)
+    # Load the persisted index, ingesting only if there is none
+    print("\n[2/4] Loading index...")
+    try:
+        if args.rebuild:
+            raise FileNotFoundError("rebuild requested")
+        index = load_index()
+        print("✓ Index loaded from storage")
+    except FileNotFoundError as e:
+        print(f"{e}, ingesting documents...")
+        nodes = ingest_documents()
+        index = build_indexes(nodes)
+        print(f"✓ Index built from {len(nodes)} nodes")
+    # Pack retrieved context the way the chat agent does, unless disabled
+    node_postprocessors = []
+    if args.context_budget:
+        from src.context_packing import ContextPacker
+        node_postprocessors.append(ContextPacker(token_budget=args.context_budget))
+    query_engine = index.as_query_engine(
+        similarity_top_k=SIMILARITY_TOP_K,
+        node_postprocessors=node_postprocessors
+    )
     
-    # Save questions
     os.makedirs("eval_results", exist_ok=True)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    df_questions.to_csv(
-        f"eval_results/evaluation_questions_{timestamp}.csv",
-        index=False,
-        encoding='utf-8-sig'
-    )
-    print(f"✓ Questions saved to: eval_results/evaluation_questions_{timestamp}.csv")
+    
+    print("\n[3/4] Loading evaluation questions...")
+    if args.resume:
+        # Reuse the questions of the interrupted run
+        checkpoint_path = args.resume
+        header, _ = load_checkpoint(checkpoint_path)
+        df_questions = load_run_questions(header)
+        print(f"✓ Loaded {len(df_questions)} questions of the interrupted run")
+    else:
+        if args.questions:
+            questions_path = latest_questions_file() if args.questions == "latest" else args.questions
+            if not questions_path:
+                print("Error: no saved question set in eval_results/")
+                sys.exit(1)
+            df_questions = pd.read_csv(questions_path, encoding='utf-8-sig')
+            print(f"✓ Loaded {len(df_questions)} questions from: {questions_path}")
+        else:
+            # Generate questions from the indexed nodes
+            nodes = list(index.docstore.docs.values())
+            df_questions = generate_questions(nodes, num_questions_per_chunk=1)
+            
+            # Save questions
+            questions_path = f"eval_results/evaluation_questions_{timestamp}.csv"
+            df_questions.to_csv(
+                questions_path,
+                index=False,
+                encoding='utf-8-sig'
+            )
+            print(f"✓ Questions saved to: {questions_path}")
+        
+        sample = None
+        if args.sample:
+            df_questions = sample_questions(df_questions, args.sample, args.stratify_by, args.seed)
+            sample = df_questions.index.tolist()
+            df_questions = df_questions.reset_index(drop=True)
+            print(f"✓ Sampled {len(df_questions)} questions")
+        
+        checkpoint_path = f"eval_results/checkpoint_{timestamp}.jsonl"
+        with open(checkpoint_path, "w", encoding="utf-8") as f:
+            header = {
+                "questions": questions_path,
+                "sample": sample,
+                "model": DEFAULT_MODEL,
+                "context_budget": args.context_budget,
+                "started": timestamp
+            }
+            f.write(json.dumps(header) + "\n")
     
     # Run evaluation
-    print("\n[5/5] Running evaluation...")
-    eval_result = asyncio.run(evaluate_async(query_engine, df_questions))
-    df_result = aggregate_results(df_questions, eval_result)
+    print(f"\n[4/4] Running evaluation (checkpoint: {checkpoint_path})...")
+    evaluated, failed = asyncio.run(evaluate_async(
+        query_engine,
+        df_questions,
+        checkpoint_path,
+        workers=args.workers,
+        requests_per_minute=args.rpm,
+        use_cache=not args.no_cache
+    ))
+    df_result = aggregate_results(df_questions, checkpoint_path)
+    judge_cache.evict()
     
     # Print and save scores
-    print_and_save_scores(df_result)
+    packing_stats = None
+    if args.context_budget:
+        from src.context_packing import get_stats as get_packing_stats
+        packing_stats = get_packing_stats()
+    print_and_save_scores(df_result, judge_cache.get_stats(), packing_stats)
     
     print("\n" + "=" * 50)
-    print("Evaluation completed successfully!")
+    if failed:
+        print(f"Evaluation incomplete: {failed} questions failed.")
+        print(f"Resume with: python evaluate.py --resume {checkpoint_path}")
+    else:
+        print("Evaluation completed successfully!")
     print("=" * 50)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
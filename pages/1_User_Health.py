@@ -3,20 +3,27 @@ User Health page - View health statistics and history
 """
 
 import streamlit as st
-import json
-import os
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+import math
 from datetime import datetime, timedelta
-from src.slide_bar import render_sidebar
-from src.global_settings import APP_TITLE, APP_ICON, SCORES_FILE
+from src.slide_bar import render_sidebar, render_export_download, discard_export
+from src.global_settings import APP_TITLE, APP_ICON, HISTORY_PAGE_SIZE
+from src.health_analytics import (
+    load_user_scores,
+    build_score_frame,
+    summarize_scores,
+    build_figures,
+    filter_scores
+)
+from src.user_stats import get_score_version
+from src.exporter import EXPORT_FORMATS, export_scores, export_chat
+from src import profiler, rag_client
 
 st.set_page_config(
     page_title=f"Sức khỏe của tôi - {APP_TITLE}",
     page_icon=APP_ICON,
     layout="wide"
 )
+profiler.start_rerun("User_Health")
 
 # Check login
 if 'logged_in' not in st.session_state or not st.session_state.logged_in:
@@ -24,48 +31,44 @@ if 'logged_in' not in st.session_state or not st.session_state.logged_in:
     st.stop()
 
 # Render sidebar
-render_sidebar()
+with profiler.section("sidebar"):
+    render_sidebar()
 
 # Page title
 st.title("📊 Sức khỏe Tinh thần của Tôi")
 
-# Load user scores
+# Cached analytics, keyed on the user's score-store version so widget
+# interactions reuse the DataFrame and figures until a new score is saved
 
 
-def load_user_scores(username):
-    """Load scores for specific user"""
-    try:
-        with open(SCORES_FILE, 'r', encoding='utf-8') as f:
-            all_scores = json.load(f)
-            user_scores = [s for s in all_scores if s['username'] == username]
-            return user_scores
-    except FileNotFoundError:
-        return []
-    except json.JSONDecodeError:
-        return []
+@st.cache_data(max_entries=256, show_spinner=False)
+def get_score_data(username, version, today):
+    """Load the user's scores and compute the overview metrics"""
+    if rag_client.enabled():
+        _, user_scores = rag_client.get_scores(username)
+    else:
+        user_scores = load_user_scores(username)
+    if not user_scores:
+        return None, None
+    df = build_score_frame(user_scores)
+    return df, summarize_scores(df)
 
 
-# Get user scores
-user_scores = load_user_scores(st.session_state.username)
+@st.cache_resource(max_entries=256, show_spinner=False)
+def get_score_figures(username, version):
+    """Build the dashboard figures once per data version"""
+    df, _ = get_score_data(username, version, datetime.now().date())
+    return build_figures(df)
 
-if not user_scores:
-    st.info("📝 Chưa có dữ liệu đánh giá. Hãy bắt đầu trò chuyện để nhận đánh giá sức khỏe tinh thần!")
-    st.stop()
 
-# Convert to DataFrame
-df = pd.DataFrame(user_scores)
-df['Time'] = pd.to_datetime(df['Time'])
-df = df.sort_values('Time', ascending=False)
+username = st.session_state.username
+with profiler.section("score_data"):
+    version = rag_client.get_score_version(username) if rag_client.enabled() else get_score_version(username)
+    df, summary = get_score_data(username, version, datetime.now().date())
 
-# Score mapping for visualization
-score_mapping = {
-    'tốt': 4,
-    'bình thường': 3,
-    'trung bình': 2,
-    'kém': 1
-}
-
-df['Score_Numeric'] = df['Score'].str.lower().map(score_mapping)
+if df is None:
+    st.info("📝 Chưa có dữ liệu đánh giá. Hãy bắt đầu trò chuyện để nhận đánh giá sức khỏe tinh thần!")
+    st.stop()
 
 # Statistics Section
 st.markdown("## 📈 Thống kê tổng quan")
@@ -73,88 +76,36 @@ st.markdown("## 📈 Thống kê tổng quan")
 col1, col2, col3, col4 = st.columns(4)
 
 with col1:
-    st.metric("📋 Tổng số đánh giá", len(df))
+    st.metric("📋 Tổng số đánh giá", summary['total'])
 
 with col2:
-    latest_score = df.iloc[0]['Score']
-    st.metric("🎯 Đánh giá gần nhất", latest_score)
+    st.metric("🎯 Đánh giá gần nhất", summary['latest_score'])
 
 with col3:
-    avg_score = df['Score_Numeric'].mean()
-    score_labels = {4: 'Tốt', 3: 'Bình thường', 2: 'Trung bình', 1: 'Kém'}
-    avg_label = score_labels[round(avg_score)]
-    st.metric("📊 Điểm trung bình", avg_label)
+    st.metric("📊 Điểm trung bình", summary['avg_label'])
 
 with col4:
-    # Get last 7 days data
-    seven_days_ago = datetime.now() - timedelta(days=7)
-    recent_scores = df[df['Time'] >= seven_days_ago]
-    st.metric("📅 Đánh giá 7 ngày", len(recent_scores))
+    st.metric("📅 Đánh giá 7 ngày", summary['recent_count'])
 
 st.markdown("---")
 
 # Chart Section
 st.markdown("## 📉 Biểu đồ theo dõi")
 
-# Time series chart
-fig_timeline = go.Figure()
-
-fig_timeline.add_trace(go.Scatter(
-    x=df['Time'].iloc[::-1],
-    y=df['Score_Numeric'].iloc[::-1],
-    mode='lines+markers',
-    name='Điểm sức khỏe',
-    line=dict(color='#1f77b4', width=3),
-    marker=dict(size=10, color='#1f77b4', symbol='circle')
-))
-
-fig_timeline.update_layout(
-    title='Biểu đồ theo dõi sức khỏe tinh thần theo thời gian',
-    xaxis_title='Thời gian',
-    yaxis_title='Điểm số',
-    yaxis=dict(
-        tickmode='array',
-        tickvals=[1, 2, 3, 4],
-        ticktext=['Kém', 'Trung bình', 'Bình thường', 'Tốt']
-    ),
-    height=400,
-    hovermode='x unified'
-)
+with profiler.section("figures"):
+    fig_timeline, fig_pie, fig_bar = get_score_figures(username, version)
 
-st.plotly_chart(fig_timeline, use_container_width=True)
+with profiler.section("charts"):
+    st.plotly_chart(fig_timeline, use_container_width=True)
 
-# Score distribution
-col1, col2 = st.columns(2)
+    # Score distribution
+    col1, col2 = st.columns(2)
 
-with col1:
-    score_counts = df['Score'].value_counts()
+    with col1:
+        st.plotly_chart(fig_pie, use_container_width=True)
 
-    fig_pie = px.pie(
-        values=score_counts.values,
-        names=score_counts.index,
-        title='Phân bố điểm đánh giá',
-        color_discrete_sequence=px.colors.qualitative.Set3
-    )
-    fig_pie.update_traces(textposition='inside', textinfo='percent+label')
-    st.plotly_chart(fig_pie, use_container_width=True)
-
-with col2:
-    # Bar chart of scores over time
-    fig_bar = px.bar(
-        df.iloc[:10][::-1],
-        x='Time',
-        y='Score_Numeric',
-        color='Score',
-        title='10 đánh giá gần nhất',
-        labels={'Score_Numeric': 'Điểm số', 'Time': 'Thời gian'},
-        color_discrete_sequence=px.colors.qualitative.Pastel
-    )
-    fig_bar.update_yaxes(
-        tickmode='array',
-        tickvals=[1, 2, 3, 4],
-        ticktext=['Kém', 'Trung bình', 'Bình thường', 'Tốt']
-    )
-    st.plotly_chart(fig_bar, use_container_width=True)
+    with col2:
+        st.plotly_chart(fig_bar, use_container_width=True)
 
 st.markdown("---")
 
@@ -179,64 +130,82 @@ with col2:
     )
 
 # Apply filters
-filtered_df = df.copy()
+with profiler.section("filter"):
+    if len(date_range) == 2:
+        filtered_df = filter_scores(df, date_range[0], date_range[1], score_filter)
+    else:
+        filtered_df = filter_scores(df, scores=score_filter)
+
+# Display filtered results one page at a time
+total_pages = max(1, math.ceil(len(filtered_df) / HISTORY_PAGE_SIZE))
 
-if len(date_range) == 2:
-    start_date, end_date = date_range
-    filtered_df = filtered_df[
-        (filtered_df['Time'].dt.date >= start_date) &
-        (filtered_df['Time'].dt.date <= end_date)
-    ]
+col1, col2 = st.columns([3, 1])
 
-filtered_df = filtered_df[filtered_df['Score'].isin(score_filter)]
+with col1:
+    st.markdown(f"**Hiển thị {len(filtered_df)} kết quả**")
+
+with col2:
+    page = st.number_input(
+        f"Trang (1-{total_pages})",
+        min_value=1,
+        max_value=total_pages,
+        value=1,
+        step=1
+    )
 
-# Display filtered results
-st.markdown(f"**Hiển thị {len(filtered_df)} kết quả**")
+page_start = (page - 1) * HISTORY_PAGE_SIZE
+page_df = filtered_df.iloc[page_start:page_start + HISTORY_PAGE_SIZE]
 
-for idx, row in filtered_df.iterrows():
-    with st.expander(f"📅 {row['Time'].strftime('%d/%m/%Y %H:%M:%S')} - Điểm: {row['Score']}"):
-        st.markdown(f"**🎯 Điểm đánh giá:** {row['Score']}")
-        st.markdown(f"**📝 Tổng đoán:** {row.get('Total_guess', 'N/A')}")
-        st.markdown(f"**📄 Chi tiết:**")
-        st.write(row.get('Content', 'Không có nội dung'))
+with profiler.section("history"):
+    for row in page_df.itertuples(index=False):
+        with st.expander(f"📅 {row.Time.strftime('%d/%m/%Y %H:%M:%S')} - Điểm: {row.Score}"):
+            st.markdown(f"**🎯 Điểm đánh giá:** {row.Score}")
+            st.markdown(f"**📝 Tổng đoán:** {getattr(row, 'Total_guess', 'N/A')}")
+            st.markdown(f"**📄 Chi tiết:**")
+            st.write(getattr(row, 'Content', 'Không có nội dung'))
 
 st.markdown("---")
 
-# Export data
+# Export data, produced only when requested and streamed to a file
 st.markdown("## 💾 Xuất dữ liệu")
 
-col1, col2 = st.columns(2)
+col1, col2, col3 = st.columns([1, 1, 2])
 
 with col1:
-    # Export to CSV
-    csv = filtered_df.to_csv(index=False, encoding='utf-8-sig')
-    st.download_button(
-        label="📥 Tải xuống CSV",
-        data=csv,
-        file_name=f"mental_health_{st.session_state.username}_{datetime.now().strftime('%Y%m%d')}.csv",
-        mime="text/csv",
-        use_container_width=True
-    )
+    export_kind = st.radio("Dữ liệu", ["Đánh giá", "Trò chuyện"], horizontal=True)
 
 with col2:
-    # Export to JSON
-    json_str = filtered_df.to_json(
-        orient='records', force_ascii=False, indent=2)
-    st.download_button(
-        label="📥 Tải xuống JSON",
-        data=json_str,
-        file_name=f"mental_health_{st.session_state.username}_{datetime.now().strftime('%Y%m%d')}.json",
-        mime="application/json",
-        use_container_width=True
-    )
+    export_format = st.selectbox("Định dạng", list(EXPORT_FORMATS), format_func=str.upper)
+
+with col3:
+    if st.button("📦 Chuẩn bị tệp xuất", use_container_width=True):
+        discard_export("health_export")
+        with st.spinner("Đang xuất dữ liệu..."), profiler.section("export"):
+            if export_kind == "Đánh giá":
+                start, end = None, None
+                if len(date_range) == 2:
+                    start = datetime.combine(date_range[0], datetime.min.time())
+                    end = datetime.combine(date_range[1] + timedelta(days=1), datetime.min.time())
+                path, rows = export_scores(
+                    export_format,
+                    usernames=[username],
+                    start=start,
+                    end=end,
+                    scores=score_filter
+                )
+            else:
+                path, rows = export_chat(username, export_format)
+        st.session_state.health_export = (path, export_format, rows)
+
+render_export_download("health_export")
 
 # Recommendations
 st.markdown("---")
 st.markdown("## 💡 Khuyến nghị")
 
 # Analyze recent trend
-if len(recent_scores) >= 2:
-    recent_avg = recent_scores['Score_Numeric'].mean()
+if summary['recent_count'] >= 2:
+    recent_avg = summary['recent_avg']
 
     if recent_avg >= 3.5:
         st.success("""
@@ -271,3 +240,5 @@ if len(recent_scores) >= 2:
 else:
     st.info(
         "Cần thêm dữ liệu để đưa ra khuyến nghị chi tiết. Hãy tiếp tục sử dụng ứng dụng!")
+
+profiler.end_rerun()
@@ -3,58 +3,62 @@ Chat page - Conversation with AI psychologist
 """
 
 import streamlit as st
-from src.conversation_engine import initialize_agent, save_chat_store, get_chat_history
+from types import SimpleNamespace
+from src.conversation_engine import initialize_agent, save_chat_store
 from src.slide_bar import render_sidebar
 from src.global_settings import APP_TITLE, APP_ICON
 from src.ingest_pipeline import initialize_settings
+from src import metering, profiler, rag_client
 
 st.set_page_config(
     page_title=f"Trò chuyện - {APP_TITLE}",
     page_icon=APP_ICON,
     layout="wide"
 )
+profiler.start_rerun("Chat")
 
 # Check login
 if 'logged_in' not in st.session_state or not st.session_state.logged_in:
     st.warning("Vui lòng đăng nhập để sử dụng tính năng này!")
     st.stop()
 
+# With RAG_SERVICE_URL set, the agent runs in the RAG service and this page
+# only renders; otherwise the agent runs in this process
+remote = rag_client.enabled()
+username = st.session_state.username
+
 # Initialize settings
-initialize_settings()
+if not remote:
+    with profiler.section("settings"):
+        initialize_settings()
 
 # Render sidebar
-render_sidebar()
+with profiler.section("sidebar"):
+    render_sidebar()
 
 # Page title
 st.title("💬 Trò chuyện với Chuyên gia AI")
 
+user_info_str = ""
+if 'user_info' in st.session_state:
+    user_info = st.session_state.user_info
+    info_parts = []
+    if user_info.get('age'):
+        info_parts.append(f"Tuổi: {user_info['age']}")
+    if user_info.get('gender'):
+        info_parts.append(f"Giới tính: {user_info['gender']}")
+    user_info_str = ", ".join(info_parts)
+
 # Initialize agent
-if 'agent' not in st.session_state:
-    with st.spinner("Đang khởi tạo chuyên gia AI..."):
-        user_info_str = ""
-        if 'user_info' in st.session_state:
-            user_info = st.session_state.user_info
-            info_parts = []
-            if user_info.get('age'):
-                info_parts.append(f"Tuổi: {user_info['age']}")
-            if user_info.get('gender'):
-                info_parts.append(f"Giới tính: {user_info['gender']}")
-            user_info_str = ", ".join(info_parts)
-        
-        agent, chat_store = initialize_agent(
-            st.session_state.username,
-            user_info_str
-        )
+if not remote and 'agent' not in st.session_state:
+    with st.spinner("Đang khởi tạo chuyên gia AI..."), profiler.section("agent_init"):
+        agent, chat_store = initialize_agent(username, user_info_str)
         st.session_state.agent = agent
         st.session_state.chat_store = chat_store
 
-# Display chat history
-messages = get_chat_history(st.session_state.username)
-
-# Create chat container
-chat_container = st.container()
 
-with chat_container:
+def render_messages(messages):
+    """Render user and assistant messages, skipping tool calls"""
     for message in messages:
         role = message.role
         content = message.content
@@ -66,31 +70,102 @@ with chat_container:
             with st.chat_message("assistant"):
                 st.write(content)
 
-# Chat input
-user_input = st.chat_input("Nhập tin nhắn của bạn...")
 
-if user_input:
-    # Display user message
-    with chat_container:
-        with st.chat_message("user"):
-            st.write(user_input)
+# Display chat history, rendered by full page runs only; the chat fragment
+# renders the messages sent since. In process, the agent's chat store
+# already holds the history (loaded, with any queued writes, when the agent
+# was created), so nothing is read from disk on reruns.
+with profiler.section("messages"):
+    if remote:
+        messages = rag_client.get_history(username)
+    else:
+        messages = st.session_state.chat_store.get_messages(username)
+    render_messages(messages)
+    st.session_state.chat_new = []
+
+
+def ask_agent(user_input):
+    """
+    Answer a message with the in-process agent
+
+    Returns:
+        str or None: The answer, None if the daily budget is used up
+    """
+    status, _ = metering.budget_status(username)
+    if status == metering.BUDGET_EXHAUSTED:
+        return None
+    if status == metering.BUDGET_DEGRADED:
+        st.caption("Bạn sắp dùng hết lượt trò chuyện của hôm nay, câu trả lời có thể ngắn gọn hơn.")
     
-    # Get response from agent
     with st.spinner("Đang suy nghĩ..."):
+        with metering.attribute(username=username, feature="chat"), \
+                profiler.section("agent_chat"):
+            response = str(st.session_state.agent.chat(user_input))
+        
+        # Display assistant response
+        with st.chat_message("assistant"):
+            st.write(response)
+        
+        # Save chat history
+        with profiler.section("save_chat"):
+            save_chat_store(st.session_state.chat_store, username)
+    return response
+
+
+def ask_service(user_input):
+    """
+    Answer a message through the RAG service, streaming the answer
+
+    Returns:
+        str or None: The answer, None if the daily budget is used up
+    """
+    stream = rag_client.stream_chat(username, user_input, user_info_str)
+    try:
+        with st.chat_message("assistant"), profiler.section("agent_chat"):
+            st.write_stream(stream)
+    except rag_client.BudgetExhausted:
+        return None
+    if stream.degraded:
+        st.caption("Bạn sắp dùng hết lượt trò chuyện của hôm nay, câu trả lời có thể ngắn gọn hơn.")
+    return stream.response
+
+
+@st.fragment
+def chat():
+    """
+    Chat input, agent call and the messages sent since the last full run
+
+    Sending a message reruns only this fragment: settings, sidebar, history
+    and the rest of the page are left as they are.
+    """
+    with profiler.fragment("Chat", "chat"):
+        render_messages(st.session_state.chat_new)
+        
+        user_input = st.chat_input("Nhập tin nhắn của bạn...")
+        if not user_input:
+            return
+        
+        # Display user message
+        with st.chat_message("user"):
+            st.write(user_input)
+        
         try:
-            response = st.session_state.agent.chat(user_input)
-            
-            # Display assistant response
-            with chat_container:
-                with st.chat_message("assistant"):
-                    st.write(str(response))
-            
-            # Save chat history
-            save_chat_store(st.session_state.chat_store)
-            
+            response = ask_service(user_input) if remote else ask_agent(user_input)
         except Exception as e:
             st.error(f"Đã xảy ra lỗi: {str(e)}")
             st.info("Vui lòng thử lại hoặc liên hệ quản trị viên nếu lỗi vẫn tiếp tục.")
+            return
+        
+        if response is None:
+            st.warning("Bạn đã dùng hết lượt trò chuyện của hôm nay. Vui lòng quay lại vào ngày mai!")
+            return
+        st.session_state.chat_new += [
+            SimpleNamespace(role="user", content=user_input),
+            SimpleNamespace(role="assistant", content=response),
+        ]
+
+
+chat()
 
 # Sidebar options
 with st.sidebar:
@@ -98,13 +173,17 @@ with st.sidebar:
     st.markdown("### ⚙️ Tùy chọn")
     
     if st.button("🗑️ Xóa lịch sử trò chuyện", use_container_width=True):
-        if st.session_state.chat_store:
-            st.session_state.chat_store.delete_messages(st.session_state.username)
-            save_chat_store(st.session_state.chat_store)
+        if remote:
+            rag_client.clear_history(username)
+            st.success("Đã xóa lịch sử trò chuyện!")
+            st.rerun()
+        elif st.session_state.chat_store:
+            st.session_state.chat_store.delete_messages(username)
+            save_chat_store(st.session_state.chat_store, username)
             st.success("Đã xóa lịch sử trò chuyện!")
             st.rerun()
     
-    if st.button("🔄 Làm mới Agent", use_container_width=True):
+    if not remote and st.button("🔄 Làm mới Agent", use_container_width=True):
         if 'agent' in st.session_state:
             del st.session_state.agent
         st.success("Đã làm mới Agent!")
@@ -132,4 +211,6 @@ with st.expander("⚠️ Lưu ý quan trọng"):
     - Nếu bạn có ý định tự gây hại, vui lòng gọi **1800 6567** (Đường dây nóng tâm lý)
     - Với các vấn đề nghiêm trọng, hãy tìm kiếm sự giúp đỡ từ chuyên gia y tế
     - Thông tin của bạn được bảo mật tuyệt đối
-    """)
\ No newline at end of file
+    """)
+
+profiler.end_rerun()
@@ -0,0 +1,210 @@
+"""
+Admin page - Cross-user score analytics
+"""
+
+import streamlit as st
+from datetime import datetime, timedelta
+from src.slide_bar import render_sidebar, render_export_download, discard_export
+from src.exporter import EXPORT_FORMATS, export_scores
+from src.authenticate import is_admin
+from src.persistence import get_metrics as get_persistence_metrics, dead_letters
+from src.metering import usage_summary
+from src import profiler
+from src.global_settings import APP_TITLE, APP_ICON, DAILY_TOKEN_BUDGET
+from src.cohort_analytics import (
+    SCORE_LEVELS,
+    sync_columnar_store,
+    load_manifest,
+    load_scores,
+    bucket_counts,
+    transition_matrix,
+    users_with_transition,
+    cohort_retention
+)
+
+st.set_page_config(
+    page_title=f"Quản trị - {APP_TITLE}",
+    page_icon=APP_ICON,
+    layout="wide"
+)
+profiler.start_rerun("Admin")
+
+# Check login
+if 'logged_in' not in st.session_state or not st.session_state.logged_in:
+    st.warning("Vui lòng đăng nhập để sử dụng tính năng này!")
+    st.stop()
+
+if not is_admin(st.session_state.username):
+    st.error("Bạn không có quyền truy cập trang này!")
+    st.stop()
+
+# Render sidebar
+render_sidebar()
+
+# Page title
+st.title("🛠️ Thống kê toàn hệ thống")
+
+FREQ_LABELS = {"day": "Ngày", "week": "Tuần", "month": "Tháng"}
+
+with st.expander("⚙️ Hàng đợi ghi dữ liệu"):
+    metrics = get_persistence_metrics()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Độ sâu hàng đợi", metrics["queue_depth"])
+    col2.metric("Đang chờ ghi", metrics["pending"])
+    col3.metric("Thời gian ghi TB", f"{metrics['avg_flush_ms']:.1f} ms")
+    col4.metric("Thời gian ghi tối đa", f"{metrics['max_flush_ms']:.1f} ms")
+    st.caption(
+        f"{metrics['flushes']} lần ghi · {metrics['chat_coalesced']} lần ghi trò chuyện được gộp · "
+        f"{metrics['errors']} lỗi"
+    )
+    failed_writes = dead_letters()
+    if failed_writes:
+        st.warning(f"{len(failed_writes)} lần ghi gần nhất đã thất bại sau nhiều lần thử lại và được lưu riêng để xử lý thủ công.")
+        st.dataframe(
+            [{k: w[k] for k in ("time", "kind", "username", "error")} for w in failed_writes],
+            use_container_width=True,
+            hide_index=True
+        )
+
+USAGE_PERIODS = {1: "Hôm nay", 7: "7 ngày qua", 30: "30 ngày qua"}
+
+with st.expander("💰 Mức sử dụng token"):
+    days = st.radio("Khoảng thời gian", list(USAGE_PERIODS), format_func=USAGE_PERIODS.get, horizontal=True)
+    today = datetime.now().date()
+    by_user = usage_summary(today - timedelta(days=days - 1), today, by=("username",))
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Tổng số token", f"{sum(u['total_tokens'] for u in by_user):,}")
+    col2.metric("Chi phí ước tính", f"${sum(u['cost_usd'] for u in by_user):.2f}")
+    if DAILY_TOKEN_BUDGET:
+        over = [u["username"] for u in usage_summary(today, today) if u["budget_tokens"] >= DAILY_TOKEN_BUDGET]
+        col3.metric("Hết hạn mức hôm nay", len(over))
+
+    if by_user:
+        st.markdown("**Theo người dùng**")
+        st.dataframe(by_user, use_container_width=True)
+        st.markdown("**Theo tính năng**")
+        st.dataframe(
+            usage_summary(today - timedelta(days=days - 1), today, by=("feature", "stage", "model")),
+            use_container_width=True
+        )
+    else:
+        st.info("Chưa có dữ liệu sử dụng token trong khoảng thời gian này.")
+
+
+@st.cache_data(max_entries=32, show_spinner="Đang tải dữ liệu...")
+def get_scores(version, start, end):
+    """Load all users' assessments in the date range"""
+    return load_scores(start=start, end=end)
+
+
+# Mirror new assessments into the columnar store, then key caches on it
+with profiler.section("sync"):
+    sync_columnar_store()
+    manifest = load_manifest()
+version = (manifest["rows"], manifest["offset"])
+
+col1, col2, col3 = st.columns(3)
+
+with col1:
+    date_range = st.date_input(
+        "Chọn khoảng thời gian",
+        value=(datetime.now().date() - timedelta(days=90), datetime.now().date()),
+        max_value=datetime.now().date()
+    )
+
+with col2:
+    freq = st.selectbox(
+        "Đơn vị thời gian",
+        options=list(FREQ_LABELS),
+        index=1,
+        format_func=FREQ_LABELS.get
+    )
+
+if len(date_range) != 2:
+    st.info("Vui lòng chọn ngày bắt đầu và ngày kết thúc.")
+    st.stop()
+
+start = datetime.combine(date_range[0], datetime.min.time())
+end = datetime.combine(date_range[1] + timedelta(days=1), datetime.min.time())
+with profiler.section("scores"):
+    df = get_scores(version, start, end)
+
+with col3:
+    st.metric("📋 Số đánh giá", f"{len(df):,}")
+    st.caption(f"👤 {df['username'].nunique():,} người dùng")
+
+if df.empty:
+    st.info("Không có đánh giá nào trong khoảng thời gian này.")
+    st.stop()
+
+import plotly.express as px
+
+tab1, tab2, tab3, tab4 = st.tabs([
+    "📈 Xu hướng",
+    "🔀 Chuyển đổi mức độ",
+    "👥 Giữ chân người dùng",
+    "💾 Xuất dữ liệu"
+])
+
+with tab1:
+    buckets = bucket_counts(df, freq)
+    fig = px.bar(
+        buckets[SCORE_LEVELS],
+        title=f"Số đánh giá theo {FREQ_LABELS[freq].lower()}",
+        labels={'value': 'Số đánh giá', 'variable': 'Mức độ'},
+        color_discrete_sequence=px.colors.qualitative.Set3
+    )
+    st.plotly_chart(fig, use_container_width=True)
+    st.dataframe(buckets, use_container_width=True)
+
+with tab2:
+    normalize = st.toggle("Hiển thị tỷ lệ", value=False)
+    matrix = transition_matrix(df, normalize=normalize)
+    fig = px.imshow(
+        matrix,
+        text_auto=".2f" if normalize else True,
+        labels={'x': 'Đánh giá sau', 'y': 'Đánh giá trước', 'color': 'Tỷ lệ' if normalize else 'Số lần'},
+        color_continuous_scale="Blues",
+        title="Ma trận chuyển đổi giữa các lần đánh giá liên tiếp"
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        from_level = st.selectbox("Từ mức", SCORE_LEVELS, index=2)
+    with col2:
+        to_level = st.selectbox("Sang mức", SCORE_LEVELS, index=0)
+
+    users = users_with_transition(df, from_level, to_level)
+    st.metric(f"👤 Người dùng chuyển từ '{from_level}' sang '{to_level}'", len(users))
+    if users:
+        with st.expander("Danh sách người dùng"):
+            st.write(", ".join(users))
+
+with tab3:
+    periods = st.slider("Số kỳ theo dõi", min_value=1, max_value=12, value=6)
+    retention = cohort_retention(df, freq, periods)
+    st.dataframe(
+        retention.style.format({col: "{:.0%}" for col in range(periods + 1)}),
+        use_container_width=True
+    )
+    st.caption("Mỗi hàng là nhóm người dùng có lần đánh giá đầu tiên trong kỳ; "
+               "các cột là tỷ lệ người dùng còn đánh giá sau N kỳ.")
+
+with tab4:
+    st.markdown("Xuất toàn bộ đánh giá của mọi người dùng trong khoảng thời gian đã chọn.")
+    col1, col2 = st.columns([1, 2])
+
+    with col1:
+        export_format = st.selectbox("Định dạng", list(EXPORT_FORMATS), format_func=str.upper)
+
+    with col2:
+        if st.button("📦 Chuẩn bị tệp xuất", use_container_width=True):
+            discard_export("admin_export")
+            with st.spinner("Đang xuất dữ liệu..."):
+                path, rows = export_scores(export_format, start=start, end=end)
+            st.session_state.admin_export = (path, export_format, rows)
+
+    render_export_download("admin_export")
+
+profiler.end_rerun()
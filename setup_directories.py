@@ -23,19 +23,7 @@ def setup_directories():
         os.makedirs(directory, exist_ok=True)
         print(f"✓ Created: {directory}")
 
-    # Create empty JSON files
-    empty_files = {
-        "data/user_storage/scores.json": "[]",
-        "data/user_storage/users.yaml": ""
-    }
-
-    for filepath, content in empty_files.items():
-        if not os.path.exists(filepath):
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(content)
-            print(f"✓ Created: {filepath}")
-
-    print("\n✓ All directories and files created successfully!")
+    print("\n✓ All directories created successfully!")
     print("\nNext steps:")
     print("1. Add your DSM-5 document to: data/ingestion_storage/")
     print("2. Update .streamlit/secrets.toml with your OpenAI API key")
@@ -1,11 +1,30 @@
 """
 User authentication module
+
+Users are stored in a database table keyed by username, so login and
+lookup cost one indexed query regardless of how many users exist. The
+database is the SQLite file USERS_DB, or the shared storage database (SQLite
+or PostgreSQL) when replicas share storage (src/storage.py). Recently read
+users are kept in an in-process cache that is invalidated on write.
+
+Migrate an existing users.yaml (also done automatically on first use):
+    python -m src.authenticate migrate
 """
 
-import yaml
 import os
+import sys
 import hashlib
-from src.global_settings import USERS_FILE
+import threading
+from collections import OrderedDict
+from src.global_settings import USERS_FILE, USERS_DB, USER_CACHE_SIZE, ADMIN_USERS
+from src.storage import get_storage
+
+USER_FIELDS = ('email', 'age', 'gender')
+
+_local = threading.local()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_init_lock = threading.Lock()
 
 
 def hash_password(password):
@@ -13,82 +32,206 @@ def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 
+def _connect():
+    """Get this thread's connection to the user database"""
+    storage = get_storage()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'key', None) == (storage, USERS_DB):
+        return conn
+
+    with _init_lock:
+        conn = storage.connect(USERS_DB)
+        conn.create_table("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                password TEXT NOT NULL,
+                email TEXT NOT NULL DEFAULT '',
+                age TEXT NOT NULL DEFAULT '',
+                gender TEXT NOT NULL DEFAULT ''
+            )
+        """, without_rowid=True)
+        is_empty = conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+        if is_empty and os.path.exists(USERS_FILE):
+            migrate_from_yaml(conn=conn)
+
+    _local.conn = conn
+    _local.key = (storage, USERS_DB)
+    return conn
+
+
+def _cache_get(username):
+    with _cache_lock:
+        if username in _cache:
+            _cache.move_to_end(username)
+            return _cache[username]
+    return None
+
+
+def _cache_put(username, user):
+    with _cache_lock:
+        _cache[username] = user
+        _cache.move_to_end(username)
+        while len(_cache) > USER_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _cache_invalidate(username):
+    with _cache_lock:
+        _cache.pop(username, None)
+
+
+def _get_user(username):
+    """
+    Look up one user record, including the password hash
+
+    Only existing users are cached, so a user registered by another process
+    is visible immediately.
+
+    Returns:
+        dict or None: User record
+    """
+    user = _cache_get(username)
+    if user is not None:
+        return user
+
+    row = _connect().execute(
+        "SELECT password, email, age, gender FROM users WHERE username = ?",
+        (username,)
+    ).fetchone()
+    if row is None:
+        return None
+
+    user = dict(row)
+    _cache_put(username, user)
+    return user
+
+
 def load_users():
-    """Load users from YAML file"""
-    if not os.path.exists(USERS_FILE):
-        return {}
-    
-    with open(USERS_FILE, 'r', encoding='utf-8') as file:
-        users = yaml.safe_load(file) or {}
-    return users
+    """
+    Load all users
 
+    Returns:
+        dict: User records (without password hashes) keyed by username
+    """
+    rows = _connect().execute("SELECT username, email, age, gender FROM users")
+    return {row['username']: {field: row[field] for field in USER_FIELDS} for row in rows}
+
+
+def migrate_from_yaml(path=USERS_FILE, conn=None):
+    """
+    Import users from the legacy YAML file
+
+    Existing usernames in the database are left untouched.
+
+    Args:
+        path: Path to users.yaml
+        conn: Connection to use (this thread's connection if omitted)
+
+    Returns:
+        int: Number of users imported
+    """
+    import yaml
+
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'r', encoding='utf-8') as file:
+        users = yaml.safe_load(file) or {}
 
-def save_users(users):
-    """Save users to YAML file"""
-    os.makedirs(os.path.dirname(USERS_FILE), exist_ok=True)
-    with open(USERS_FILE, 'w', encoding='utf-8') as file:
-        yaml.dump(users, file, allow_unicode=True)
+    conn = conn or _connect()
+    with conn.transaction():
+        cursor = conn.executemany(
+            "INSERT INTO users (username, password, email, age, gender) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (username) DO NOTHING",
+            [
+                (
+                    str(username),
+                    info['password'],
+                    str(info.get('email') or ''),
+                    str(info.get('age') or ''),
+                    str(info.get('gender') or ''),
+                )
+                for username, info in users.items()
+            ]
+        )
+    return cursor.rowcount
 
 
 def register_user(username, password, email="", age="", gender=""):
     """
     Register a new user
-    
+
     Args:
         username: Username
         password: Password
         email: Email address
         age: Age
         gender: Gender
-        
+
     Returns:
         tuple: (success, message)
     """
-    users = load_users()
-    
-    if username in users:
+    conn = _connect()
+    try:
+        # The primary key makes the insert fail if the username exists,
+        # so two simultaneous registrations cannot both succeed
+        conn.execute(
+            "INSERT INTO users (username, password, email, age, gender) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (username, hash_password(password), email, str(age), gender)
+        )
+    except conn.integrity_error:
         return False, "Tên đăng nhập đã tồn tại!"
-    
-    users[username] = {
-        'password': hash_password(password),
-        'email': email,
-        'age': age,
-        'gender': gender
-    }
-    
-    save_users(users)
+    finally:
+        _cache_invalidate(username)
+
     return True, "Đăng ký thành công!"
 
 
 def login_user(username, password):
     """
     Login user
-    
+
     Args:
         username: Username
         password: Password
-        
+
     Returns:
         tuple: (success, user_info)
     """
-    users = load_users()
-    
-    if username not in users:
+    user = _get_user(username)
+
+    if user is None:
         return False, None
-    
-    if users[username]['password'] == hash_password(password):
-        user_info = users[username].copy()
+
+    if user['password'] == hash_password(password):
+        user_info = user.copy()
         user_info.pop('password')
         return True, user_info
-    
+
     return False, None
 
 
 def get_user_info(username):
     """Get user information"""
-    users = load_users()
-    if username in users:
-        user_info = users[username].copy()
+    user = _get_user(username)
+    if user is not None:
+        user_info = user.copy()
         user_info.pop('password', None)
         return user_info
-    return None
\ No newline at end of file
+    return None
+
+
+def is_admin(username):
+    """Check whether a user may access the admin pages"""
+    return username in ADMIN_USERS
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["migrate"]:
+        _connect()
+        imported = migrate_from_yaml()
+        print(f"✓ Imported {imported} users from {USERS_FILE} into {USERS_DB}")
+    else:
+        print("Usage: python -m src.authenticate migrate")
+        sys.exit(1)
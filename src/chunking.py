@@ -0,0 +1,160 @@
+"""
+Streaming, structure-aware chunking of source documents
+
+.docx files are read paragraph by paragraph (sections.iter_paragraphs) and
+packed into chunks of at most CHUNK_SIZE tokens. A heading always starts a
+new chunk, so chunks never straddle two sections, and consecutive chunks of
+a section share up to CHUNK_OVERLAP tokens of trailing paragraphs. Chunks
+are yielded as soon as they are complete, so the ingestion pipeline can
+summarize and embed the first chunks while the rest of the file is still
+being parsed, and only one chunk's worth of text is held at a time.
+
+Nodes point to their section (f"{path}_section_{i}") as source document and
+carry character offsets within it, like TokenTextSplitter output does.
+"""
+
+from src.global_settings import CHUNK_SIZE, CHUNK_OVERLAP
+from src.sections import iter_paragraphs, section_metadata
+
+
+def _make_node(path, section_index, chunk_index, metadata, text, start):
+    from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+
+    section_id = f"{path}_section_{section_index}"
+    return TextNode(
+        id_=f"{section_id}_chunk_{chunk_index}",
+        text=text,
+        metadata=dict(metadata),
+        # The category is for filtering only, chapter and section help retrieval
+        excluded_embed_metadata_keys=["category"],
+        excluded_llm_metadata_keys=["category"],
+        start_char_idx=start,
+        end_char_idx=start + len(text) if start is not None else None,
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=section_id)},
+    )
+
+
+def iter_docx_chunks(path, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, tokenizer=None):
+    """
+    Stream a .docx file as chunk nodes
+
+    Args:
+        path: Path to the .docx file
+        chunk_size: Maximum tokens per chunk
+        chunk_overlap: Tokens of trailing paragraphs repeated in the next chunk
+        tokenizer: Callable text -> tokens (Settings.tokenizer if omitted)
+
+    Yields:
+        TextNode: Chunks in document order
+    """
+    if tokenizer is None:
+        from llama_index.core import Settings
+        tokenizer = Settings.tokenizer
+
+    splitter = None
+    chapter, section = "", ""
+    metadata = section_metadata(path, chapter, section)
+    section_index, chunk_index = 0, 0
+    section_chars = 0  # length of the section text so far
+    buffer = []  # (offset in section, text, tokens)
+
+    def buffered_tokens():
+        # +1 per line for the newline joining it
+        return sum(tokens + 1 for _, _, tokens in buffer)
+
+    def emit():
+        nonlocal chunk_index
+        text = "\n".join(line for _, line, _ in buffer)
+        node = _make_node(path, section_index, chunk_index, metadata, text, buffer[0][0])
+        chunk_index += 1
+        return node
+
+    def keep_overlap():
+        # Trailing lines that fit the overlap, never the whole chunk again
+        kept, total = [], 0
+        for item in reversed(buffer[1:]):
+            if total + item[2] + 1 > chunk_overlap:
+                break
+            kept.insert(0, item)
+            total += item[2] + 1
+        return kept
+
+    for level, text in iter_paragraphs(path):
+        if not text.strip():
+            continue
+
+        if level is not None:
+            # Headings close the current chunk
+            if buffer:
+                yield emit()
+                buffer = []
+            if level in (1, 2):
+                if section_chars:
+                    section_index += 1
+                    chunk_index = 0
+                    section_chars = 0
+                if level == 1:
+                    chapter, section = text.strip(), ""
+                else:
+                    section = text.strip()
+                metadata = section_metadata(path, chapter, section)
+
+        offset = section_chars + 1 if section_chars else 0
+        section_chars = offset + len(text)
+        tokens = len(tokenizer(text))
+
+        if tokens > chunk_size:
+            # A paragraph longer than a chunk is split on its own
+            if buffer:
+                yield emit()
+                buffer = []
+            if splitter is None:
+                from src.token_chunker import FastTokenTextSplitter
+                splitter = FastTokenTextSplitter(
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                    tokenizer=tokenizer
+                )
+            cursor = 0
+            for piece in splitter.split_text(text):
+                position = text.find(piece, cursor)
+                start = offset + position if position >= 0 else None
+                if position >= 0:
+                    cursor = position + 1
+                yield _make_node(path, section_index, chunk_index, metadata, piece, start)
+                chunk_index += 1
+            continue
+
+        if buffer and buffered_tokens() + tokens > chunk_size:
+            yield emit()
+            buffer = keep_overlap()
+            if buffered_tokens() + tokens > chunk_size:
+                buffer = []
+        buffer.append((offset, text, tokens))
+
+    if buffer:
+        yield emit()
+
+
+def iter_chunks(files, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """
+    Stream chunk nodes of several source files
+
+    .docx files are streamed with iter_docx_chunks, other formats are read
+    whole with SimpleDirectoryReader and split with FastTokenTextSplitter.
+
+    Yields:
+        TextNode: Chunks, file by file
+    """
+    for path in files:
+        print(f"Streaming {path}")
+        if path.endswith(".docx"):
+            yield from iter_docx_chunks(path, chunk_size, chunk_overlap)
+            continue
+
+        from llama_index.core import SimpleDirectoryReader
+        from src.token_chunker import FastTokenTextSplitter
+
+        documents = SimpleDirectoryReader(input_files=[path], filename_as_id=True).load_data()
+        splitter = FastTokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        yield from splitter.get_nodes_from_documents(documents)
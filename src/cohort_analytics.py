@@ -0,0 +1,472 @@
+"""
+Cross-user cohort analytics over the score store
+
+Assessments are mirrored from the scores log into a Parquet dataset
+partitioned by month; each sync adds a part file, and a month's parts are
+merged into one, sorted by user and time, once there are more than
+SCORES_DATASET_MAX_PARTS of them. Queries read only the columns they need and push time and user
+predicates down to the partitions/row groups, then compute time buckets,
+score-level transitions and cohort retention with vectorized NumPy/pandas.
+
+Usage:
+    python -m src.cohort_analytics sync
+    python -m src.cohort_analytics buckets --freq week --since 2026-01-01
+    python -m src.cohort_analytics transitions --since 2026-10-01
+    python -m src.cohort_analytics retention --freq month
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+from datetime import datetime
+from src.global_settings import SCORES_DATASET, SCORES_DATASET_MAX_PARTS, PERSIST_READ_TIMEOUT
+from src import persistence
+
+# Ordered score levels, index = numeric level
+SCORE_LEVELS = ['kém', 'trung bình', 'bình thường', 'tốt']
+LEVEL_CODES = {level: i + 1 for i, level in enumerate(SCORE_LEVELS)}
+
+FREQUENCIES = ('day', 'week', 'month')
+
+MANIFEST_FILE = "_manifest.json"
+ROW_GROUP_SIZE = 128 * 1024
+
+# Bump when the dataset columns or manifest change so existing mirrors are rebuilt
+SCHEMA_VERSION = 3
+
+_sync_lock = threading.Lock()
+
+
+def _manifest_path():
+    return os.path.join(SCORES_DATASET, MANIFEST_FILE)
+
+
+def load_manifest():
+    """
+    Load the columnar dataset manifest
+
+    Returns:
+        dict: rows mirrored so far, number of part files and byte offset
+            in the scores log mirrored up to
+    """
+    try:
+        with open(_manifest_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"rows": 0, "parts": 0, "offset": 0, "schema": SCHEMA_VERSION}
+
+
+def _to_table(entries):
+    """Convert score entries to an Arrow table"""
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+
+    df = pd.DataFrame(entries, columns=["username", "Time", "Score", "Content", "Total_guess"])
+    time = pd.to_datetime(df["Time"])
+    levels = df["Score"].str.lower().map(LEVEL_CODES).fillna(0)
+    return pa.table({
+        "username": pa.array(df["username"].astype(str), pa.string()),
+        "time": pa.array(time.values.astype("datetime64[us]")),
+        "level": pa.array(levels.to_numpy(np.int8)),
+        "score": pa.array(df["Score"], pa.string()),
+        "content": pa.array(df["Content"], pa.string()),
+        "total_guess": pa.array(df["Total_guess"], pa.string()),
+        "month": pa.array(time.dt.strftime("%Y-%m"), pa.string()),
+    })
+
+
+def _write_manifest(manifest):
+    os.makedirs(SCORES_DATASET, exist_ok=True)
+    tmp_path = f"{_manifest_path()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, _manifest_path())
+
+
+def _compact(months):
+    """
+    Merge the part files of months that have more than SCORES_DATASET_MAX_PARTS
+
+    The merged month is written next to the dataset under a hidden name
+    and swapped in with two renames, so readers never see its rows twice.
+
+    Returns:
+        int: Number of months compacted
+    """
+    import pyarrow.dataset as ds
+
+    compacted = 0
+    for month in months:
+        directory = os.path.join(SCORES_DATASET, f"month={month}")
+        parts = [name for name in os.listdir(directory) if name.endswith(".parquet")]
+        if len(parts) <= SCORES_DATASET_MAX_PARTS:
+            continue
+
+        table = ds.dataset(directory, format="parquet").to_table()
+        merged = os.path.join(SCORES_DATASET, f".month={month}.merged")
+        replaced = os.path.join(SCORES_DATASET, f".month={month}.replaced")
+        shutil.rmtree(merged, ignore_errors=True)
+        shutil.rmtree(replaced, ignore_errors=True)
+        ds.write_dataset(
+            table.sort_by([("username", "ascending"), ("time", "ascending")]),
+            merged,
+            format="parquet",
+            basename_template="merged-{i}.parquet",
+            max_rows_per_group=ROW_GROUP_SIZE,
+        )
+        os.replace(directory, replaced)
+        os.replace(merged, directory)
+        shutil.rmtree(replaced, ignore_errors=True)
+        compacted += 1
+    return compacted
+
+
+def sync_columnar_store(force=False, usernames=None):
+    """
+    Mirror new assessments from the scores log into the Parquet dataset
+
+    The log is append-only, so only the entries past the byte offset
+    mirrored last time are read, parsed and written as a new part file;
+    months the new file pushes over SCORES_DATASET_MAX_PARTS parts are then
+    compacted. The dataset is rebuilt from scratch if the log shrank or
+    force is set.
+
+    Args:
+        force: Rebuild the whole dataset
+        usernames: Users whose pending assessments must be included first
+            (other users' still queued ones are picked up by a later sync)
+
+    Returns:
+        int: Number of rows written
+    """
+    import pyarrow.dataset as ds
+
+    deadline = time.monotonic() + PERSIST_READ_TIMEOUT
+    for username in usernames or ():
+        persistence.wait_until_flushed(max(0, deadline - time.monotonic()), username)
+    with _sync_lock:
+        manifest = load_manifest()
+        rebuild = force or manifest.get("schema") != SCHEMA_VERSION
+        offset = 0 if rebuild else manifest.get("offset", 0)
+        entries, end = persistence.read_scores(offset)
+        if end < offset:
+            # The log was truncated or replaced
+            rebuild = True
+            entries, end = persistence.read_scores(0)
+        if not rebuild and not entries:
+            return 0
+
+        if rebuild:
+            shutil.rmtree(SCORES_DATASET, ignore_errors=True)
+            manifest = {"rows": 0, "parts": 0, "offset": 0, "schema": SCHEMA_VERSION}
+
+        if entries:
+            table = _to_table(entries)
+            ds.write_dataset(
+                table,
+                SCORES_DATASET,
+                format="parquet",
+                partitioning=["month"],
+                partitioning_flavor="hive",
+                basename_template=f"part-{manifest['parts']:06d}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore",
+                max_rows_per_group=ROW_GROUP_SIZE,
+            )
+            manifest["parts"] += 1
+            _compact(set(table.column("month").to_pylist()))
+
+        manifest["rows"] += len(entries)
+        manifest["offset"] = end
+        _write_manifest(manifest)
+        return len(entries)
+
+
+def open_dataset():
+    """Open the Parquet mirror as a pyarrow dataset"""
+    import pyarrow.dataset as ds
+
+    return ds.dataset(SCORES_DATASET, format="parquet", partitioning="hive")
+
+
+def build_filter(start=None, end=None, usernames=None, levels=None):
+    """
+    Build a pushdown filter expression for the Parquet mirror
+
+    Args:
+        start: Keep assessments at or after this datetime
+        end: Keep assessments before this datetime
+        usernames: Keep only these users
+        levels: Keep only these score labels
+
+    Returns:
+        Expression or None: Filter for Dataset.to_table / to_batches
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field("month") >= start.strftime("%Y-%m"))
+        conditions.append(ds.field("time") >= pa.scalar(start, pa.timestamp("us")))
+    if end is not None:
+        conditions.append(ds.field("month") <= end.strftime("%Y-%m"))
+        conditions.append(ds.field("time") < pa.scalar(end, pa.timestamp("us")))
+    if usernames is not None:
+        conditions.append(ds.field("username").isin(list(usernames)))
+    if levels is not None:
+        codes = [LEVEL_CODES[level.lower()] for level in levels if level.lower() in LEVEL_CODES]
+        conditions.append(ds.field("level").isin(codes))
+
+    predicate = None
+    for condition in conditions:
+        predicate = condition if predicate is None else predicate & condition
+    return predicate
+
+
+def load_scores(start=None, end=None, usernames=None):
+    """
+    Load assessments as a columnar DataFrame
+
+    Args:
+        start: Keep assessments at or after this datetime
+        end: Keep assessments before this datetime
+        usernames: Keep only these users
+
+    Returns:
+        DataFrame: username, time, level columns sorted by user and time
+    """
+    import pandas as pd
+
+    sync_columnar_store(usernames=usernames)
+    if not os.path.exists(SCORES_DATASET) or not load_manifest()["rows"]:
+        return pd.DataFrame({
+            "username": pd.Series(dtype=str),
+            "time": pd.Series(dtype="datetime64[us]"),
+            "level": pd.Series(dtype="int8"),
+        })
+
+    table = open_dataset().to_table(
+        columns=["username", "time", "level"],
+        filter=build_filter(start, end, usernames)
+    )
+    df = table.to_pandas()
+    return df.sort_values(["username", "time"], kind="stable").reset_index(drop=True)
+
+
+def _period_codes(times, freq):
+    """Integer period index for each timestamp (days, weeks or months)"""
+    import numpy as np
+
+    if freq not in FREQUENCIES:
+        raise ValueError(f"Unknown frequency: {freq}")
+
+    values = times.to_numpy(dtype="datetime64[D]")
+    if freq == "month":
+        return values.astype("datetime64[M]").astype(np.int64)
+    days = values.astype(np.int64)
+    if freq == "week":
+        # 1970-01-01 was a Thursday, shift so weeks start on Monday
+        return (days + 3) // 7
+    return days
+
+
+def _period_labels(codes, freq):
+    """Human-readable labels for period codes"""
+    import numpy as np
+
+    if freq == "month":
+        return np.asarray(codes, dtype="datetime64[M]").astype(str)
+    if freq == "week":
+        return (np.asarray(codes) * 7 - 3).astype("datetime64[D]").astype(str)
+    return np.asarray(codes, dtype="datetime64[D]").astype(str)
+
+
+def bucket_counts(df, freq="week"):
+    """
+    Count assessments per time bucket and score level
+
+    Args:
+        df: DataFrame from load_scores
+        freq: 'day', 'week' or 'month'
+
+    Returns:
+        DataFrame: One row per bucket, one column per score level plus
+            'users' (distinct users assessed in the bucket)
+    """
+    import numpy as np
+    import pandas as pd
+
+    columns = SCORE_LEVELS + ["users"]
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+
+    codes = _period_codes(df["time"], freq)
+    buckets, bucket_idx = np.unique(codes, return_inverse=True)
+    levels = df["level"].to_numpy(np.int64)
+
+    counts = np.zeros((len(buckets), len(SCORE_LEVELS) + 1), dtype=np.int64)
+    np.add.at(counts, (bucket_idx, levels), 1)
+
+    user_idx = pd.factorize(df["username"])[0]
+    pairs = np.unique(bucket_idx.astype(np.int64) * (user_idx.max() + 1) + user_idx)
+    users = np.bincount(pairs // (user_idx.max() + 1), minlength=len(buckets))
+
+    result = pd.DataFrame(counts[:, 1:], columns=SCORE_LEVELS, index=_period_labels(buckets, freq))
+    result["users"] = users
+    result.index.name = freq
+    return result
+
+
+def transition_matrix(df, normalize=False):
+    """
+    Count transitions between consecutive assessments of the same user
+
+    Args:
+        df: DataFrame from load_scores (sorted by user and time)
+        normalize: Return row-normalized probabilities instead of counts
+
+    Returns:
+        DataFrame: Rows are the previous level, columns the next level
+    """
+    import numpy as np
+    import pandas as pd
+
+    size = len(SCORE_LEVELS) + 1
+    counts = np.zeros((size, size), dtype=np.int64)
+
+    if len(df) > 1:
+        users = df["username"].to_numpy()
+        levels = df["level"].to_numpy(np.int64)
+        same_user = users[1:] == users[:-1]
+        np.add.at(counts, (levels[:-1][same_user], levels[1:][same_user]), 1)
+
+    matrix = pd.DataFrame(counts[1:, 1:], index=SCORE_LEVELS, columns=SCORE_LEVELS)
+    matrix.index.name = "from"
+    matrix.columns.name = "to"
+    if normalize:
+        totals = matrix.sum(axis=1).replace(0, 1)
+        matrix = matrix.div(totals, axis=0)
+    return matrix
+
+
+def users_with_transition(df, from_level, to_level):
+    """
+    Users with at least one consecutive from_level -> to_level assessment
+
+    Args:
+        df: DataFrame from load_scores (sorted by user and time)
+        from_level: Score label before
+        to_level: Score label after
+
+    Returns:
+        list: Usernames
+    """
+    import numpy as np
+
+    if len(df) < 2:
+        return []
+
+    users = df["username"].to_numpy()
+    levels = df["level"].to_numpy(np.int64)
+    mask = (
+        (users[1:] == users[:-1])
+        & (levels[:-1] == LEVEL_CODES[from_level])
+        & (levels[1:] == LEVEL_CODES[to_level])
+    )
+    return sorted(set(users[1:][mask]))
+
+
+def cohort_retention(df, freq="month", periods=6):
+    """
+    Share of each cohort still assessed N periods after their first one
+
+    Users are grouped into cohorts by the period of their first assessment
+    within df.
+
+    Args:
+        df: DataFrame from load_scores
+        freq: 'day', 'week' or 'month'
+        periods: Number of periods to report after the cohort period
+
+    Returns:
+        DataFrame: One row per cohort with 'size' and retention columns 0..periods
+    """
+    import numpy as np
+    import pandas as pd
+
+    columns = ["size"] + list(range(periods + 1))
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+
+    user_idx = pd.factorize(df["username"])[0]
+    codes = _period_codes(df["time"], freq)
+
+    first = np.full(user_idx.max() + 1, np.iinfo(np.int64).max)
+    np.minimum.at(first, user_idx, codes)
+    offset = codes - first[user_idx]
+
+    keep = offset <= periods
+    cohorts, cohort_idx = np.unique(first, return_inverse=True)
+
+    active_users = np.zeros((user_idx.max() + 1, periods + 1), dtype=bool)
+    active_users[user_idx[keep], offset[keep]] = True
+
+    counts = np.zeros((len(cohorts), periods + 1), dtype=np.int64)
+    np.add.at(counts, cohort_idx, active_users.astype(np.int64))
+    sizes = np.bincount(cohort_idx, minlength=len(cohorts))
+
+    result = pd.DataFrame(counts / sizes[:, None], columns=list(range(periods + 1)),
+                          index=_period_labels(cohorts, freq))
+    result.insert(0, "size", sizes)
+    result.index.name = "cohort"
+    return result
+
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def main(argv=None):
+    """Command line interface"""
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Cross-user score analytics")
+    parser.add_argument("command", choices=["sync", "buckets", "transitions", "retention"])
+    parser.add_argument("--freq", choices=FREQUENCIES, default="week")
+    parser.add_argument("--since", type=_parse_date, help="YYYY-MM-DD")
+    parser.add_argument("--until", type=_parse_date, help="YYYY-MM-DD (exclusive)")
+    parser.add_argument("--from-level", choices=SCORE_LEVELS)
+    parser.add_argument("--to-level", choices=SCORE_LEVELS)
+    parser.add_argument("--normalize", action="store_true")
+    parser.add_argument("--periods", type=int, default=6)
+    parser.add_argument("--force", action="store_true", help="Rebuild the dataset on sync")
+    args = parser.parse_args(argv)
+
+    if args.command == "sync":
+        written = sync_columnar_store(force=args.force)
+        print(f"✓ Mirrored {written} new assessments ({load_manifest()['rows']} total)")
+        return
+
+    df = load_scores(start=args.since, end=args.until)
+    print(f"Loaded {len(df)} assessments from {df['username'].nunique()} users\n")
+
+    with pd.option_context("display.max_rows", 200, "display.width", 160):
+        if args.command == "buckets":
+            print(bucket_counts(df, args.freq))
+        elif args.command == "transitions":
+            if args.from_level and args.to_level:
+                users = users_with_transition(df, args.from_level, args.to_level)
+                print(f"{len(users)} users went from '{args.from_level}' to '{args.to_level}'")
+            else:
+                print(transition_matrix(df, normalize=args.normalize))
+        elif args.command == "retention":
+            print(cohort_retention(df, args.freq, args.periods))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,224 @@
+"""
+Token-budgeted context packing between retrieval and answer synthesis
+
+ContextPacker is a node postprocessor for the dsm5 query engines. It:
+
+- trims the text that adjacent chunks of the same document share
+  (CHUNK_OVERLAP), using the chunks' character offsets, and drops sentences
+  that already appear in a higher-ranked chunk (whole sentences, or runs of
+  at least five words inside an earlier sentence)
+- hides bulky metadata (the SummaryExtractor summary, file properties) from
+  the LLM text, keeping only short fields such as chapter and section
+- when the context still exceeds CONTEXT_TOKEN_BUDGET, keeps the sentences
+  most similar to the query (TF-IDF weighted term overlap, boosted by the
+  chunk's retrieval score) and restores them to document order
+
+Similarity is computed locally rather than by embedding every sentence, so
+packing adds no model calls to a tool call.
+"""
+
+import re
+import math
+import threading
+from collections import Counter
+from typing import List, Optional
+
+from llama_index.core import Settings
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from src.global_settings import CONTEXT_TOKEN_BUDGET, CONTEXT_MAX_METADATA_CHARS
+
+# Metadata never worth sending to the LLM
+EXCLUDED_LLM_METADATA = [
+    "section_summary",
+    "category",
+    "shard",
+    "duplicate_of",
+    "file_path",
+    "file_type",
+    "file_size",
+    "creation_date",
+    "last_modified_date",
+    "last_accessed_date",
+]
+
+# Sentences shorter than this (in words) are only dropped when repeated whole
+_MIN_CONTAINED_TERMS = 5
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?;:])\s+|\n+")
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+_stats_lock = threading.Lock()
+_stats = {"calls": 0, "tokens_in": 0, "tokens_out": 0, "sentences_dropped": 0}
+
+
+def get_stats():
+    """
+    Packing totals since start (or the last reset)
+
+    Returns:
+        dict: calls, tokens_in, tokens_out, sentences_dropped and saved ratio
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["saved"] = 1 - stats["tokens_out"] / stats["tokens_in"] if stats["tokens_in"] else 0.0
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def _terms(text):
+    return _TERM_RE.findall(text.lower())
+
+
+def _split_sentences(text):
+    return [sentence.strip() for sentence in _SENTENCE_RE.split(text) if sentence.strip()]
+
+
+class ContextPacker(BaseNodePostprocessor):
+    """Deduplicate, strip and fit retrieved chunks to a token budget"""
+
+    token_budget: int = Field(default=CONTEXT_TOKEN_BUDGET, description="Max context tokens, 0 = no limit")
+    max_metadata_chars: int = Field(default=CONTEXT_MAX_METADATA_CHARS)
+    score_weight: float = Field(default=0.5, description="Weight of the chunk score in sentence ranking")
+
+    @classmethod
+    def class_name(cls):
+        return "ContextPacker"
+
+    def _count_tokens(self, text):
+        return len(Settings.tokenizer(text))
+
+    def _excluded_keys(self, node):
+        keys = set(node.excluded_llm_metadata_keys) | set(EXCLUDED_LLM_METADATA)
+        for key, value in node.metadata.items():
+            if len(str(value)) > self.max_metadata_chars:
+                keys.add(key)
+        return sorted(keys)
+
+    def _header(self, node):
+        """Metadata header of a node as the LLM will see it once packed"""
+        return node.model_copy(
+            update={"excluded_llm_metadata_keys": self._excluded_keys(node)}
+        ).get_metadata_str(MetadataMode.LLM)
+
+    def _trim_overlaps(self, nodes):
+        """Cut the prefix a chunk shares with an earlier chunk of the same document"""
+        texts = {}
+        spans = {}
+        ordered = sorted(
+            nodes,
+            key=lambda n: (n.node.ref_doc_id or "", n.node.start_char_idx if n.node.start_char_idx is not None else -1)
+        )
+        for item in ordered:
+            node = item.node
+            text = node.get_content()
+            start, end = node.start_char_idx, node.end_char_idx
+            doc = node.ref_doc_id
+            if start is not None and end is not None and end - start == len(text):
+                covered = spans.get(doc)
+                if covered is not None and start < covered:
+                    text = text[min(covered - start, len(text)):]
+                spans[doc] = max(spans.get(doc, 0), end)
+            texts[node.node_id] = text
+        return texts
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        if not nodes:
+            return nodes
+
+        tokens_in = sum(
+            self._count_tokens(n.node.get_content(metadata_mode=MetadataMode.LLM)) for n in nodes
+        )
+        texts = self._trim_overlaps(nodes)
+
+        # Sentences per node in rank order, skipping ones already seen: a
+        # repeated sentence, or a long enough run of words of an earlier one
+        seen = set()
+        sentences = []  # (node index, position, sentence)
+        dropped = 0
+        for i, item in enumerate(nodes):
+            for position, sentence in enumerate(_split_sentences(texts[item.node.node_id])):
+                terms = _terms(sentence)
+                normalized = f" {' '.join(terms)} "
+                if not terms or normalized in seen or (
+                    len(terms) >= _MIN_CONTAINED_TERMS and any(normalized in other for other in seen)
+                ):
+                    dropped += 1
+                    continue
+                seen.add(normalized)
+                sentences.append((i, position, sentence))
+
+        keep = set(range(len(sentences)))
+        if self.token_budget:
+            keep, budget_dropped = self._fit_budget(nodes, sentences, query_bundle)
+            dropped += budget_dropped
+
+        packed = []
+        tokens_out = 0
+        for i, item in enumerate(nodes):
+            text = " ".join(
+                sentence for index, (node_index, _, sentence) in enumerate(sentences)
+                if node_index == i and index in keep
+            )
+            if not text:
+                continue
+            node = item.node.model_copy(update={
+                "text": text,
+                "excluded_llm_metadata_keys": self._excluded_keys(item.node),
+            })
+            tokens_out += self._count_tokens(node.get_content(metadata_mode=MetadataMode.LLM))
+            packed.append(NodeWithScore(node=node, score=item.score))
+
+        with _stats_lock:
+            _stats["calls"] += 1
+            _stats["tokens_in"] += tokens_in
+            _stats["tokens_out"] += tokens_out
+            _stats["sentences_dropped"] += dropped
+        return packed
+
+    def _fit_budget(self, nodes, sentences, query_bundle):
+        """
+        Pick the highest-ranked sentences that fit the token budget
+
+        Returns:
+            tuple: (set of kept sentence indexes, number dropped)
+        """
+        lengths = [self._count_tokens(sentence) for _, _, sentence in sentences]
+        # Metadata headers of the nodes count against the budget too
+        header_tokens = sum(self._count_tokens(self._header(item.node)) for item in nodes)
+        if header_tokens + sum(lengths) <= self.token_budget:
+            return set(range(len(sentences))), 0
+
+        query_terms = Counter(_terms(query_bundle.query_str)) if query_bundle else Counter()
+        sentence_terms = [Counter(_terms(sentence)) for _, _, sentence in sentences]
+        document_frequency = Counter(term for terms in sentence_terms for term in terms)
+        total = len(sentences)
+
+        def idf(term):
+            return math.log(1 + total / (1 + document_frequency[term]))
+
+        query_norm = math.sqrt(sum((count * idf(t)) ** 2 for t, count in query_terms.items())) or 1.0
+        max_score = max((item.score or 0.0) for item in nodes) or 1.0
+
+        ranked = []
+        for index, terms in enumerate(sentence_terms):
+            dot = sum(count * query_terms[t] * idf(t) ** 2 for t, count in terms.items() if t in query_terms)
+            norm = math.sqrt(sum((count * idf(t)) ** 2 for t, count in terms.items())) or 1.0
+            node_score = (nodes[sentences[index][0]].score or 0.0) / max_score
+            ranked.append((dot / (norm * query_norm) + self.score_weight * node_score, index))
+        ranked.sort(reverse=True)
+
+        keep = set()
+        used = header_tokens
+        for _, index in ranked:
+            if used + lengths[index] <= self.token_budget:
+                keep.add(index)
+                used += lengths[index]
+        return keep, len(sentences) - len(keep)
@@ -1,48 +1,134 @@
 """
 Conversation engine with agent for mental health chat
+
+LlamaIndex is imported lazily inside each function so that pages which only
+read history or scores do not load the agent and index stack.
 """
 
 import os
 import json
+import threading
 from datetime import datetime
-from llama_index.core import load_index_from_storage
-from llama_index.core import StorageContext
-from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.core.tools import QueryEngineTool, ToolMetadata
-from llama_index.agent.openai import OpenAIAgent
-from llama_index.core.storage.chat_store import SimpleChatStore
-from llama_index.core.tools import FunctionTool
 from src.global_settings import (
-    INDEX_STORAGE, 
     CONVERSATION_FILE, 
-    SCORES_FILE,
-    SIMILARITY_TOP_K
+    CHAT_DIR,
+    INDEX_STORAGE,
+    CORPUS_DIR,
+    SIMILARITY_TOP_K,
+    CONTEXT_TOKEN_BUDGET,
+    DEGRADED_CONTEXT_TOKEN_BUDGET
 )
 from src.prompts import CUSTORM_AGENT_SYSTEM_TEMPLATE
+from src import persistence, corpus, sections, user_memory, storage
+
+_retrieval_lock = threading.RLock()
+# "state": loaded index or shards, engines and the snapshot version they
+# were loaded from; replaced, never changed in place, when that changes
+_retrieval = {"state": None}
+_retrieval_watch = {"subscribed": False}
+_legacy_lock = threading.Lock()
+_legacy_chats = {"imported": False}
+
+
+def chat_key(username):
+    """Storage key of a user's chat history"""
+    return storage.user_key(CHAT_DIR, username, ".json")
+
+
+def dump_chat(username, messages):
+    """Serialize a user's chat history as stored under chat_key()"""
+    from llama_index.core.storage.chat_store import SimpleChatStore
 
+    return SimpleChatStore(store={username: list(messages)}).json().encode("utf-8")
 
-def load_chat_store():
-    """Load or initialize chat store"""
-    if os.path.exists(CONVERSATION_FILE) and os.path.getsize(CONVERSATION_FILE) > 0:
+
+def import_legacy_chats(store=None):
+    """
+    Split the legacy single chat file into per-user chat histories
+
+    Users who already have a history in storage are left untouched; the
+    legacy file is renamed to <file>.imported afterwards.
+
+    Returns:
+        int: Number of users imported
+    """
+    from llama_index.core.storage.chat_store import SimpleChatStore
+
+    if not os.path.exists(CONVERSATION_FILE):
+        return 0
+    store = store or storage.get_storage()
+    try:
+        legacy = SimpleChatStore.from_persist_path(CONVERSATION_FILE)
+    except (json.JSONDecodeError, ValueError):
+        legacy = SimpleChatStore()
+
+    imported = 0
+    for username in legacy.get_keys():
         try:
-            chat_store = SimpleChatStore.from_persist_path(CONVERSATION_FILE)
-        except json.JSONDecodeError:
-            chat_store = SimpleChatStore()
-    else:
-        chat_store = SimpleChatStore()
+            store.put(chat_key(username), dump_chat(username, legacy.get_messages(username)), if_version=None)
+            imported += 1
+        except storage.VersionConflict:
+            pass
+    os.replace(CONVERSATION_FILE, f"{CONVERSATION_FILE}.imported")
+    return imported
+
+
+def load_chat_store(username=None):
+    """
+    Load chat history into a chat store
+
+    Args:
+        username: Only load this user's history (every user's if omitted)
+
+    Returns:
+        SimpleChatStore: The chat store
+    """
+    from llama_index.core.storage.chat_store import SimpleChatStore
+
+    with _legacy_lock:
+        if not _legacy_chats["imported"]:
+            import_legacy_chats()
+            _legacy_chats["imported"] = True
+
+    store = storage.get_storage()
+    keys = [chat_key(username)] if username else list(store.list(CHAT_DIR))
+    chat_store = SimpleChatStore()
+    for key in keys:
+        data = store.get(key)
+        if not data:
+            continue
+        try:
+            user_store = SimpleChatStore.model_validate_json(data)
+        except ValueError:
+            continue
+        for user in user_store.get_keys():
+            chat_store.set_messages(user, user_store.get_messages(user))
     return chat_store
 
 
-def save_chat_store(chat_store):
-    """Save chat store to file"""
-    os.makedirs(os.path.dirname(CONVERSATION_FILE), exist_ok=True)
-    chat_store.persist(persist_path=CONVERSATION_FILE)
+def save_chat_store(chat_store, username=None):
+    """
+    Queue chat history for saving by the persistence worker
+
+    Args:
+        chat_store: Chat store holding the new messages
+        username: User whose messages changed (all users if omitted)
+    """
+    usernames = [username] if username else chat_store.get_keys()
+    for key in usernames:
+        messages = chat_store.get_messages(key)
+        persistence.submit_chat(key, messages)
+        # Messages leaving the prompt window are summarized into long-term memory
+        user_memory.archive_messages(key, messages)
 
 
 def save_score(score, content, total_guess, username):
     """
     Save diagnostic score to file
     
+    The entry is queued for the persistence worker, so the agent does not
+    wait for disk I/O.
+    
     Args:
         score (str): Score of the user's mental health
         content (str): Content of the diagnosis
@@ -58,24 +144,128 @@ def save_score(score, content, total_guess, username):
         "Total_guess": total_guess
     }
     
-    # Load existing data
-    try:
-        with open(SCORES_FILE, "r", encoding='utf-8') as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        data = []
-    
-    # Append new entry
-    data.append(new_entry)
-    
-    # Save back to file
-    os.makedirs(os.path.dirname(SCORES_FILE), exist_ok=True)
-    with open(SCORES_FILE, "w", encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    persistence.submit_score(new_entry)
+    user_memory.remember_assessment(username, score, content, total_guess, current_time)
     
     return f"Đã lưu kết quả chẩn đoán cho {username}"
 
 
+def _on_snapshot_change(key):
+    """Reload the index and shards once another node published new ones"""
+    from src.index_builder import INDEX_MANIFEST_FILE
+
+    if key in (INDEX_STORAGE, CORPUS_DIR) or os.path.basename(key) in (corpus.MANIFEST_FILE, INDEX_MANIFEST_FILE):
+        with _retrieval_lock:
+            _retrieval["state"] = None
+
+
+def _snapshot_version():
+    """Modification times of the local index and shard manifests"""
+    from src.index_builder import INDEX_MANIFEST_FILE
+
+    paths = [os.path.join(INDEX_STORAGE, INDEX_MANIFEST_FILE), os.path.join(INDEX_STORAGE, "docstore.json")]
+    try:
+        names = sorted(n for n in os.listdir(CORPUS_DIR) if not n.endswith((".building", ".old")))
+    except FileNotFoundError:
+        names = []
+    paths.extend(os.path.join(CORPUS_DIR, name, corpus.MANIFEST_FILE) for name in names)
+
+    version = []
+    for path in paths:
+        try:
+            version.append((path, os.stat(path).st_mtime_ns))
+        except FileNotFoundError:
+            pass
+    return tuple(version)
+
+
+def load_retrieval():
+    """
+    Index, or corpus shards, and DSM5 query engines shared by every agent
+
+    Loaded once per process, so agents of different users (and the RAG
+    service's workers) do not each hold a copy of the index. Every call
+    compares the modification times of the index and shard manifests with
+    the loaded ones, so an index rebuilt on this node is picked up even
+    with storage that sends no change notifications (LocalStorage);
+    snapshots published by other replicas are loaded when storage
+    notifies about them.
+    """
+    with _retrieval_lock:
+        if not _retrieval_watch["subscribed"]:
+            store = storage.get_storage()
+            store.subscribe(INDEX_STORAGE, _on_snapshot_change)
+            store.subscribe(CORPUS_DIR, _on_snapshot_change)
+            _retrieval_watch["subscribed"] = True
+        version = _snapshot_version()
+        state = _retrieval["state"]
+        if state is None or state["version"] != version:
+            shards = corpus.list_shards()
+            state = dict(shards=shards, index=None, metadata_index=None, engines={}, version=version)
+            if not shards:
+                from src.index_builder import load_index
+                state["index"] = load_index()
+                state["metadata_index"] = sections.load_metadata_index()
+            _retrieval["state"] = state
+        return state
+
+
+def dsm5_engine(username, query, category=""):
+    """
+    DSM5 query engine for a question
+
+    Searches the given disorder category, or the categories the question is
+    classified into, with less retrieved context once the user is past the
+    soft token budget.
+
+    Args:
+        username: User asking
+        query: Question
+        category: One of sections.CATEGORIES, or empty to classify the question
+
+    Returns:
+        RetrieverQueryEngine: Shared query engine
+    """
+    from llama_index.core.query_engine import RetrieverQueryEngine
+    from src.context_packing import ContextPacker
+    from src import metering
+
+    categories = [category] if category in sections.CATEGORIES else sections.classify(query)
+    status, _ = metering.budget_status(username)
+    degraded = status != metering.BUDGET_OK
+
+    state = load_retrieval()
+    # Engines keyed by the categories they search and whether the context is reduced
+    key = (tuple(categories), degraded)
+    with _retrieval_lock:
+        engine = state["engines"].get(key)
+    if engine is not None:
+        return engine
+
+    packer = ContextPacker(
+        token_budget=DEGRADED_CONTEXT_TOKEN_BUDGET if degraded else CONTEXT_TOKEN_BUDGET
+    )
+    if state["shards"]:
+        # Query every corpus shard concurrently
+        engine = corpus.as_query_engine(
+            similarity_top_k=SIMILARITY_TOP_K,
+            categories=categories,
+            node_postprocessors=[packer]
+        )
+    else:
+        retriever = sections.restricted_retriever(
+            state["index"],
+            sections.node_ids_for(state["metadata_index"], categories),
+            similarity_top_k=SIMILARITY_TOP_K
+        )
+        engine = RetrieverQueryEngine.from_args(
+            retriever,
+            node_postprocessors=[packer]
+        )
+    with _retrieval_lock:
+        return state["engines"].setdefault(key, engine)
+
+
 def initialize_agent(username, user_info=""):
     """
     Initialize chatbot agent with tools
@@ -87,36 +277,55 @@ def initialize_agent(username, user_info=""):
     Returns:
         OpenAIAgent: Configured agent
     """
-    # Load chat store
-    chat_store = load_chat_store()
+    from llama_index.core.memory import ChatMemoryBuffer
+    from llama_index.core.tools import FunctionTool
+    from llama_index.agent.openai import OpenAIAgent
+    from src import metering
+
+    # Load chat store, including messages still queued for writing
+    chat_store = load_chat_store(username)
+    pending = persistence.pending_messages(username)
+    if pending is not None:
+        chat_store.set_messages(username, list(pending))
     
-    # Create memory
+    # Create memory: only recent messages reach the prompt, older ones are
+    # recalled on demand through the user_memory tool
     memory = ChatMemoryBuffer.from_defaults(
         token_limit=3000,
         chat_store=chat_store,
         chat_store_key=username
     )
     
-    # Load index
-    storage_context = StorageContext.from_defaults(persist_dir=INDEX_STORAGE)
-    index = load_index_from_storage(storage_context, index_id="vector")
+    description = (
+        "Cung cấp các thông tin liên quan đến các bệnh tâm thần "
+        "theo tiêu chuẩn DSM5. Sử dụng câu hỏi văn bản thuần túy chi tiết "
+        "làm đầu vào cho công cụ này."
+    )
     
-    # Create DSM5 query engine
-    dsm5_engine = index.as_query_engine(similarity_top_k=SIMILARITY_TOP_K)
+    shards = load_retrieval()["shards"]
+    if shards:
+        sources = ", ".join(m["description"] or m["name"] for m in shards)
+        description += f" Nguồn tài liệu: {sources}."
     
-    # Create DSM5 tool
-    dsm5_tool = QueryEngineTool(
-        query_engine=dsm5_engine,
-        metadata=ToolMetadata(
-            name="dsm5",
-            description=(
-                "Cung cấp các thông tin liên quan đến các bệnh tâm thần "
-                "theo tiêu chuẩn DSM5. Sử dụng câu hỏi văn bản thuần túy chi tiết "
-                "làm đầu vào cho công cụ này."
-            ),
-        )
+    categories_help = "; ".join(f"{key}: {label}" for key, (label, _) in sections.CATEGORIES.items())
+    description += (
+        " Tham số category (không bắt buộc) giới hạn tìm kiếm trong một nhóm rối loạn "
+        f"({categories_help}). Bỏ trống để tự động xác định nhóm từ câu hỏi."
     )
     
+    # Create DSM5 tool
+    def dsm5(query: str, category: str = "") -> str:
+        """Tra cứu DSM5, có thể giới hạn trong một nhóm rối loạn"""
+        with metering.attribute(username=username, stage="dsm5"):
+            return str(dsm5_engine(username, query, category).query(query))
+    
+    async def adsm5(query: str, category: str = "") -> str:
+        """Tra cứu DSM5, có thể giới hạn trong một nhóm rối loạn"""
+        with metering.attribute(username=username, stage="dsm5"):
+            return str(await dsm5_engine(username, query, category).aquery(query))
+    
+    dsm5_tool = FunctionTool.from_defaults(fn=dsm5, async_fn=adsm5, name="dsm5", description=description)
+    
     # Create save score tool
     def save_score_wrapper(score: str, content: str, total_guess: str):
         """
@@ -131,9 +340,31 @@ def initialize_agent(username, user_info=""):
     
     save_tool = FunctionTool.from_defaults(fn=save_score_wrapper)
     
+    # Create long-term memory tool
+    def recall_memory(query: str) -> str:
+        """Tra cứu các lần đánh giá và cuộc trò chuyện trước đây của người dùng"""
+        with metering.attribute(username=username, stage="user_memory"):
+            return user_memory.format_episodes(user_memory.recall(username, query))
+    
+    async def arecall_memory(query: str) -> str:
+        """Tra cứu các lần đánh giá và cuộc trò chuyện trước đây của người dùng"""
+        import asyncio
+        return await asyncio.to_thread(recall_memory, query)
+    
+    memory_tool = FunctionTool.from_defaults(
+        fn=recall_memory,
+        async_fn=arecall_memory,
+        name="user_memory",
+        description=(
+            "Tra cứu các lần đánh giá sức khỏe tâm thần và tóm tắt các cuộc trò chuyện "
+            "trước đây của người dùng liên quan đến câu hỏi. Dùng khi cần biết tình trạng, "
+            "triệu chứng hoặc lời khuyên ở những lần trước."
+        )
+    )
+    
     # Create agent
     agent = OpenAIAgent.from_tools(
-        tools=[dsm5_tool, save_tool],
+        tools=[dsm5_tool, save_tool, memory_tool],
         memory=memory,
         system_prompt=CUSTORM_AGENT_SYSTEM_TEMPLATE.format(user_info=user_info),
         verbose=False
@@ -144,13 +375,14 @@ def initialize_agent(username, user_info=""):
 
 def get_chat_history(username):
     """Get chat history for a user"""
-    chat_store = load_chat_store()
+    pending = persistence.pending_messages(username)
+    if pending is not None:
+        return pending
+    chat_store = load_chat_store(username)
     messages = chat_store.get_messages(username)
     return messages
 
 
 def clear_chat_history(username):
     """Clear chat history for a user"""
-    chat_store = load_chat_store()
-    chat_store.delete_messages(username)
-    save_chat_store(chat_store)
\ No newline at end of file
+    persistence.submit_chat(username, [])
\ No newline at end of file
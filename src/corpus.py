@@ -0,0 +1,436 @@
+"""
+Sharded document corpus
+
+Each source (DSM-5, ICD-11, a clinical guideline...) is ingested into its own
+index shard under CORPUS_DIR/<name>/, next to a manifest.json describing the
+source files, their hashes and how the shard was built. Shards are added,
+rebuilt and removed independently; a rebuild is written to a temporary
+directory and swapped in, so queries never see a half-built shard. Built
+shards are published to storage (src/storage.py) and mirrored by every
+replica before it lists them.
+
+At query time ShardedRetriever embeds the query once, fans it out to the
+selected shards concurrently with a per-shard top-k, and merges the results
+by similarity score.
+
+Usage:
+    python -m src.corpus add dsm5 data/ingestion_storage/dsm5.docx --description "DSM-5"
+    python -m src.corpus import-index dsm5     # reuse the existing data/index_storage
+    python -m src.corpus rebuild dsm5
+    python -m src.corpus remove icd11
+    python -m src.corpus list
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from src.storage import get_storage
+from src.sections import (
+    build_metadata_index,
+    load_metadata_index,
+    node_ids_for,
+    restricted_retriever
+)
+from src.global_settings import (
+    CORPUS_DIR,
+    CORPUS_MAX_WORKERS,
+    INDEX_STORAGE,
+    FILES_PATH,
+    CHUNK_SIZE,
+    CHUNK_OVERLAP,
+    SIMILARITY_TOP_K
+)
+
+MANIFEST_FILE = "manifest.json"
+
+_lock = threading.Lock()
+# Loaded shard indexes keyed by name -> (built_at, index)
+_indexes = {}
+_executor = None
+
+
+def shard_dir(name):
+    return os.path.join(CORPUS_DIR, name)
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_manifest(directory, manifest):
+    tmp_path = os.path.join(directory, f"{MANIFEST_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST_FILE))
+
+
+def load_manifest(name):
+    """
+    Read a shard's manifest
+
+    Returns:
+        dict or None: Manifest, or None if the shard does not exist
+    """
+    try:
+        with open(os.path.join(shard_dir(name), MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def list_shards():
+    """
+    Manifests of all complete shards
+
+    Returns:
+        list: Manifests sorted by shard name
+    """
+    get_storage().pull(CORPUS_DIR)
+    if not os.path.isdir(CORPUS_DIR):
+        return []
+    manifests = []
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        # Skip shards being built or swapped out
+        if name.endswith((".building", ".old")):
+            continue
+        manifest = load_manifest(name)
+        if manifest is not None:
+            manifests.append(manifest)
+    return manifests
+
+
+def _swap_in(name, build_dir):
+    """Replace a shard directory with a freshly built one"""
+    target = shard_dir(name)
+    old_dir = f"{target}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(target):
+        os.replace(target, old_dir)
+    os.replace(build_dir, target)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    get_storage().push(target)
+    with _lock:
+        _indexes.pop(name, None)
+
+
+def add_shard(name, files, description="", embed_model=None):
+    """
+    Ingest source files into a new or replaced shard
+
+    Args:
+        name: Shard name
+        files: Source document paths
+        description: What the source covers, shown to the agent
+        embed_model: Embedding model (EMBEDDING_BACKEND's if omitted)
+
+    Returns:
+        dict: The shard's manifest
+    """
+    from llama_index.core import StorageContext, VectorStoreIndex
+    from src.embeddings import embedding_signature, get_embed_model
+    from src.ingest_pipeline import ingest_documents
+
+    embed_model = embed_model or get_embed_model()
+
+    for path in files:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+
+    build_dir = f"{shard_dir(name)}.building"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+
+    # Keep the ingestion cache across rebuilds of the same shard
+    cache_file = os.path.join(shard_dir(name), "pipeline_cache.json")
+    nodes = ingest_documents(
+        files,
+        cache_file=cache_file,
+        embed_model=embed_model,
+        report_file=os.path.join(build_dir, "build_report.json")
+    )
+    for node in nodes:
+        node.metadata["shard"] = name
+    shutil.copy2(cache_file, os.path.join(build_dir, "pipeline_cache.json"))
+
+    storage_context = StorageContext.from_defaults()
+    index = VectorStoreIndex(nodes, storage_context=storage_context, embed_model=embed_model)
+    index.set_index_id("vector")
+    storage_context.persist(persist_dir=build_dir)
+    build_metadata_index(index, build_dir)
+
+    manifest = {
+        "name": name,
+        "description": description,
+        "files": {path: _file_hash(path) for path in files},
+        "nodes": len(nodes),
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "embedding": embedding_signature(embed_model),
+        "built_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    _write_manifest(build_dir, manifest)
+    _swap_in(name, build_dir)
+    return manifest
+
+
+def import_index(name, description="DSM-5", persist_dir=INDEX_STORAGE, files=FILES_PATH):
+    """
+    Turn an existing single index into a shard without re-embedding
+
+    Returns:
+        dict: The shard's manifest
+    """
+    from llama_index.core import StorageContext, load_index_from_storage
+    from src.embeddings import LEGACY_SIGNATURE
+    from src.index_builder import read_index_manifest
+
+    index = load_index_from_storage(
+        StorageContext.from_defaults(persist_dir=persist_dir),
+        index_id="vector"
+    )
+
+    build_dir = f"{shard_dir(name)}.building"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    shutil.copytree(persist_dir, build_dir)
+
+    manifest = {
+        "name": name,
+        "description": description,
+        "files": {path: _file_hash(path) for path in files if os.path.exists(path)},
+        "nodes": len(index.docstore.docs),
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "embedding": read_index_manifest(persist_dir).get("embedding", LEGACY_SIGNATURE),
+        "built_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    _write_manifest(build_dir, manifest)
+    _swap_in(name, build_dir)
+    return manifest
+
+
+def rebuild_shard(name, embed_model=None):
+    """Re-ingest a shard from the source files in its manifest"""
+    manifest = load_manifest(name)
+    if manifest is None:
+        raise KeyError(f"Unknown shard: {name}")
+    return add_shard(name, list(manifest["files"]), manifest.get("description", ""), embed_model)
+
+
+def remove_shard(name):
+    """Delete a shard"""
+    if load_manifest(name) is None:
+        raise KeyError(f"Unknown shard: {name}")
+    shutil.rmtree(shard_dir(name))
+    get_storage().push(shard_dir(name))
+    with _lock:
+        _indexes.pop(name, None)
+
+
+def stale_shards():
+    """Names of shards whose source files changed since they were built"""
+    stale = []
+    for manifest in list_shards():
+        for path, digest in manifest["files"].items():
+            if not os.path.exists(path) or _file_hash(path) != digest:
+                stale.append(manifest["name"])
+                break
+    return stale
+
+
+def load_shard(name, embed_model=None):
+    """
+    Load a shard's index, cached in-process until the shard is rebuilt
+
+    Args:
+        name: Shard name
+        embed_model: Query embedding model (Settings.embed_model if omitted)
+
+    Returns:
+        VectorStoreIndex: The shard index
+
+    Raises:
+        ValueError: If the shard was embedded with a different backend
+    """
+    from llama_index.core import Settings, StorageContext, load_index_from_storage
+    from src.embeddings import check_signature
+
+    manifest = load_manifest(name)
+    if manifest is None:
+        raise KeyError(f"Unknown shard: {name}")
+    embed_model = embed_model or Settings.embed_model
+    check_signature(manifest.get("embedding"), embed_model, source=f"shard '{name}'")
+
+    with _lock:
+        cached = _indexes.get(name)
+        if cached is not None and cached[0] == manifest["built_at"]:
+            return cached[1]
+
+    index = load_index_from_storage(
+        StorageContext.from_defaults(persist_dir=shard_dir(name)),
+        index_id="vector",
+        embed_model=embed_model
+    )
+    with _lock:
+        _indexes[name] = (manifest["built_at"], index)
+    return index
+
+
+def _get_executor():
+    from concurrent.futures import ThreadPoolExecutor
+
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=CORPUS_MAX_WORKERS,
+                thread_name_prefix="corpus"
+            )
+    return _executor
+
+
+def _make_retriever_class():
+    from llama_index.core.retrievers import BaseRetriever
+    from llama_index.core.settings import Settings
+
+    class ShardedRetriever(BaseRetriever):
+        """Retriever that queries several shards concurrently and merges by score"""
+
+        def __init__(self, shards=None, similarity_top_k=SIMILARITY_TOP_K, per_shard_top_k=None,
+                     embed_model=None, categories=None, **kwargs):
+            names = shards or [manifest["name"] for manifest in list_shards()]
+            if not names:
+                raise FileNotFoundError(f"No shards in {CORPUS_DIR}")
+            self._embed_model = embed_model or Settings.embed_model
+            self._top_k = similarity_top_k
+            self._retrievers = {
+                name: restricted_retriever(
+                    load_shard(name, self._embed_model),
+                    node_ids_for(load_metadata_index(shard_dir(name)), categories or []),
+                    similarity_top_k=per_shard_top_k or similarity_top_k,
+                    embed_model=self._embed_model
+                )
+                for name in names
+            }
+            super().__init__(**kwargs)
+
+        def _with_embedding(self, query_bundle):
+            # Embed once instead of once per shard
+            if query_bundle.embedding is None:
+                query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(
+                    query_bundle.embedding_strs
+                )
+            return query_bundle
+
+        def _merge(self, results):
+            nodes = [node for shard_nodes in results for node in shard_nodes]
+            nodes.sort(key=lambda node: node.score or 0.0, reverse=True)
+            return nodes[:self._top_k]
+
+        def _retrieve(self, query_bundle):
+            query_bundle = self._with_embedding(query_bundle)
+            if len(self._retrievers) == 1:
+                return self._merge([next(iter(self._retrievers.values())).retrieve(query_bundle)])
+            futures = [
+                _get_executor().submit(retriever.retrieve, query_bundle)
+                for retriever in self._retrievers.values()
+            ]
+            return self._merge([future.result() for future in futures])
+
+        async def _aretrieve(self, query_bundle):
+            import asyncio
+
+            query_bundle = self._with_embedding(query_bundle)
+            results = await asyncio.gather(*[
+                retriever.aretrieve(query_bundle) for retriever in self._retrievers.values()
+            ])
+            return self._merge(results)
+
+    return ShardedRetriever
+
+
+def sharded_retriever(shards=None, similarity_top_k=SIMILARITY_TOP_K, per_shard_top_k=None,
+                      embed_model=None, categories=None):
+    """
+    Retriever over several shards
+
+    Args:
+        shards: Shard names (all shards if None)
+        similarity_top_k: Number of merged results
+        per_shard_top_k: Results taken from each shard (similarity_top_k if None)
+        embed_model: Query embedding model (Settings.embed_model if None)
+        categories: Only search nodes in these disorder categories (see
+            src.sections); shards without such nodes are searched in full
+
+    Returns:
+        ShardedRetriever: Retriever merging shard results by score
+    """
+    return _make_retriever_class()(shards, similarity_top_k, per_shard_top_k, embed_model, categories)
+
+
+def as_query_engine(shards=None, similarity_top_k=SIMILARITY_TOP_K, categories=None, **kwargs):
+    """Query engine over the sharded corpus"""
+    from llama_index.core.query_engine import RetrieverQueryEngine
+
+    retriever = sharded_retriever(shards, similarity_top_k, categories=categories)
+    return RetrieverQueryEngine.from_args(retriever, **kwargs)
+
+
+def main(argv=None):
+    """Command line interface"""
+    parser = argparse.ArgumentParser(description="Manage the sharded document corpus")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add = subparsers.add_parser("add", help="Ingest source files into a shard")
+    add.add_argument("name")
+    add.add_argument("files", nargs="+")
+    add.add_argument("--description", default="")
+
+    imported = subparsers.add_parser("import-index", help="Turn data/index_storage into a shard")
+    imported.add_argument("name")
+    imported.add_argument("--description", default="DSM-5")
+
+    rebuild = subparsers.add_parser("rebuild", help="Re-ingest shards from their sources")
+    rebuild.add_argument("names", nargs="*", help="Shards to rebuild (stale shards if omitted)")
+
+    remove = subparsers.add_parser("remove", help="Delete a shard")
+    remove.add_argument("name")
+
+    subparsers.add_parser("list", help="Show shards")
+    args = parser.parse_args(argv)
+
+    if args.command in ("add", "rebuild"):
+        from src.ingest_pipeline import initialize_settings
+        initialize_settings()
+
+    if args.command == "add":
+        manifest = add_shard(args.name, args.files, args.description)
+        print(f"✓ Shard '{args.name}' built with {manifest['nodes']} nodes")
+    elif args.command == "import-index":
+        manifest = import_index(args.name, args.description)
+        print(f"✓ Imported {INDEX_STORAGE} as shard '{args.name}' ({manifest['nodes']} nodes)")
+    elif args.command == "rebuild":
+        for name in args.names or stale_shards():
+            manifest = rebuild_shard(name)
+            print(f"✓ Shard '{name}' rebuilt with {manifest['nodes']} nodes")
+    elif args.command == "remove":
+        remove_shard(args.name)
+        print(f"✓ Shard '{args.name}' removed")
+    else:
+        stale = set(stale_shards())
+        for manifest in list_shards():
+            status = " (stale)" if manifest["name"] in stale else ""
+            print(f"{manifest['name']:<16}{manifest['nodes']:>6} nodes  "
+                  f"{manifest['built_at']}  {manifest['description']}{status}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
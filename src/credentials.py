@@ -0,0 +1,80 @@
+"""
+API keys and RAG service user tokens
+
+get_api_key() finds the OpenAI key for the command-line tools and the RAG
+service (the Streamlit pages read it from st.secrets).
+
+Requests to the RAG service act for one user. When RAG_SERVICE_TOKEN is
+set, the client sends a user token instead of the shared secret:
+"<username>:<expiry>:<signature>", signed with HMAC-SHA256 over the
+username and expiry, valid for RAG_SERVICE_USER_TOKEN_TTL seconds. The
+service only serves that user's data to it, and the secret itself never
+goes over the wire.
+"""
+
+import os
+import hmac
+import time
+import hashlib
+import tomllib
+from src.global_settings import SECRETS_FILE, RAG_SERVICE_USER_TOKEN_TTL
+
+
+def get_api_key():
+    """
+    Read the OpenAI API key from the environment or the Streamlit secrets
+
+    Returns:
+        str or None: OPENAI_API_KEY if set, else the key in SECRETS_FILE
+    """
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if api_key:
+        return api_key
+
+    try:
+        with open(SECRETS_FILE, "rb") as f:
+            secrets = tomllib.load(f)
+    except FileNotFoundError:
+        return None
+    return secrets.get("openai", {}).get("OPENAI_API_KEY")
+
+
+def _signature(secret, username, expires):
+    message = f"{username}:{expires}".encode("utf-8")
+    return hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def user_token(secret, username, ttl=RAG_SERVICE_USER_TOKEN_TTL):
+    """
+    Token letting a request act for one user
+
+    Args:
+        secret: RAG_SERVICE_TOKEN
+        username: User the request acts for
+        ttl: Seconds the token stays valid
+
+    Returns:
+        str: The signed token
+    """
+    expires = int(time.time() + ttl)
+    return f"{username}:{expires}:{_signature(secret, username, expires)}"
+
+
+def verify_user_token(secret, token):
+    """
+    User a token was issued for
+
+    Returns:
+        str or None: Username, or None if the token is malformed, forged
+            or expired
+    """
+    try:
+        username, expires, signature = token.rsplit(":", 2)
+        expires = int(expires)
+    except (AttributeError, ValueError):
+        return None
+    if expires < time.time():
+        return None
+    if not hmac.compare_digest(signature, _signature(secret, username, expires)):
+        return None
+    return username
@@ -0,0 +1,238 @@
+"""
+Near-duplicate chunk detection for ingestion
+
+DSM-5 repeats a lot of boilerplate (specifier lists, "Diagnostic Features"
+templates, overlapping criteria). Chunks are compared by the Jaccard
+similarity of their word shingles, estimated with MinHash signatures and
+looked up through LSH bands, so each new chunk is only compared with the
+few earlier chunks that share a band instead of all of them.
+
+A chunk whose estimated similarity to an earlier representative reaches
+DEDUP_THRESHOLD joins that representative's cluster: the pipeline skips it,
+and it receives the representative's summary and embedding afterwards,
+with metadata["duplicate_of"] linking the two. Duplicates stay in the index
+with their own text and chapter/section metadata.
+
+Print the report of the last build:
+    python -m src.dedup
+    python -m src.dedup data/corpus/dsm5/build_report.json
+"""
+
+import re
+import sys
+import json
+import hashlib
+from src.global_settings import (
+    DEDUP_THRESHOLD,
+    DEDUP_NUM_PERM,
+    DEDUP_SHINGLE_SIZE,
+    BUILD_REPORT_FILE
+)
+
+# Mersenne prime for the universal hash permutations
+_PRIME = (1 << 31) - 1
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def shingles(text, size=DEDUP_SHINGLE_SIZE):
+    """Set of lowercased word n-grams of a text"""
+    words = _TERM_RE.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def choose_bands(num_perm, threshold):
+    """
+    LSH bands and rows per band for a similarity threshold
+
+    The candidate threshold of b bands of r rows is about (1/b) ** (1/r).
+    The closest one at or below the threshold is chosen: candidates are
+    verified against the threshold anyway, so erring low only costs a few
+    extra comparisons while erring high misses duplicates.
+
+    Returns:
+        tuple: (bands, rows)
+    """
+    options = []
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows == 0:
+            bands = num_perm // rows
+            options.append(((1 / bands) ** (1 / rows), bands, rows))
+    below = [option for option in options if option[0] <= threshold]
+    _, bands, rows = max(below) if below else min(options)
+    return bands, rows
+
+
+class NearDuplicateIndex:
+    """Incremental MinHash/LSH index of cluster representatives"""
+
+    def __init__(self, threshold=DEDUP_THRESHOLD, num_perm=DEDUP_NUM_PERM,
+                 shingle_size=DEDUP_SHINGLE_SIZE, seed=1):
+        import numpy as np
+
+        self._np = np
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, num_perm, dtype=np.uint64)[:, None]
+        self._b = rng.integers(0, _PRIME, num_perm, dtype=np.uint64)[:, None]
+
+        self._signatures = {}  # representative id -> signature
+        self._buckets = {}  # (band, band bytes) -> [representative id]
+        self.processed = {}  # representative id -> node after the pipeline
+        self.clusters = {}  # representative id -> [duplicate id]
+        self.chunks = 0
+
+    def signature(self, text):
+        """MinHash signature of a text, or None if it has no words"""
+        np = self._np
+        grams = shingles(text, self.shingle_size)
+        if not grams:
+            return None
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=4).digest(), "little")
+             for g in grams),
+            dtype=np.uint64,
+            count=len(grams)
+        )
+        # a * h + b stays below 2**63 for 31-bit a, b and 32-bit h
+        return ((self._a * hashes + self._b) % _PRIME).min(axis=1)
+
+    def _bands(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def find(self, signature):
+        """
+        Most similar representative at or above the threshold
+
+        Returns:
+            tuple: (representative id, estimated similarity) or (None, 0.0)
+        """
+        candidates = set()
+        for key in self._bands(signature):
+            candidates.update(self._buckets.get(key, ()))
+        best, best_similarity = None, 0.0
+        for node_id in candidates:
+            similarity = float((self._signatures[node_id] == signature).mean())
+            if similarity >= self.threshold and similarity > best_similarity:
+                best, best_similarity = node_id, similarity
+        return best, best_similarity
+
+    def split(self, nodes):
+        """
+        Separate new representatives from duplicates of known ones
+
+        Args:
+            nodes: Chunk nodes in document order
+
+        Returns:
+            tuple: (representative nodes, [(duplicate node, representative id)])
+        """
+        representatives, duplicates = [], []
+        for node in nodes:
+            self.chunks += 1
+            signature = self.signature(node.get_content())
+            if signature is not None:
+                match, _ = self.find(signature)
+                if match is not None:
+                    self.clusters[match].append(node.node_id)
+                    duplicates.append((node, match))
+                    continue
+                self._signatures[node.node_id] = signature
+                for key in self._bands(signature):
+                    self._buckets.setdefault(key, []).append(node.node_id)
+            self.clusters[node.node_id] = []
+            representatives.append(node)
+        return representatives, duplicates
+
+    def remember(self, nodes):
+        """Keep representatives as they come out of the pipeline"""
+        for node in nodes:
+            if node.node_id in self.clusters:
+                self.processed[node.node_id] = node
+
+    def resolve(self, duplicates):
+        """
+        Give duplicates the summary and embedding of their representative
+
+        Returns:
+            list: The duplicate nodes
+        """
+        resolved = []
+        for node, representative_id in duplicates:
+            representative = self.processed[representative_id]
+            if "section_summary" in representative.metadata:
+                node.metadata["section_summary"] = representative.metadata["section_summary"]
+            node.metadata["duplicate_of"] = representative_id
+            node.excluded_embed_metadata_keys = list(node.excluded_embed_metadata_keys) + ["duplicate_of"]
+            node.excluded_llm_metadata_keys = list(node.excluded_llm_metadata_keys) + ["duplicate_of"]
+            node.embedding = representative.embedding
+            resolved.append(node)
+        return resolved
+
+    def report(self):
+        """
+        Summary of the deduplication
+
+        Returns:
+            dict: Counts, calls saved and the largest clusters
+        """
+        duplicates = sum(len(members) for members in self.clusters.values())
+        largest = sorted(
+            ((rep, members) for rep, members in self.clusters.items() if members),
+            key=lambda item: len(item[1]),
+            reverse=True
+        )
+        return {
+            "threshold": self.threshold,
+            "bands": self.bands,
+            "rows": self.rows,
+            "chunks": self.chunks,
+            "representatives": len(self.clusters),
+            "duplicates": duplicates,
+            "clusters": len(largest),
+            # One SummaryExtractor call and one embedding per skipped chunk
+            "llm_calls_saved": duplicates,
+            "embedding_calls_saved": duplicates,
+            "largest_clusters": [
+                {"representative": rep, "size": len(members) + 1, "duplicates": members}
+                for rep, members in largest[:10]
+            ],
+        }
+
+
+def save_report(report, report_file=BUILD_REPORT_FILE):
+    """Write a build report as JSON"""
+    import os
+
+    os.makedirs(os.path.dirname(report_file) or ".", exist_ok=True)
+    with open(report_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def print_report(report):
+    """Print a build report"""
+    print("=" * 50)
+    print("Build report")
+    print("=" * 50)
+    print(f"{'Chunks:':<24}{report['chunks']}")
+    print(f"{'Representatives:':<24}{report['representatives']}")
+    print(f"{'Duplicates:':<24}{report['duplicates']} in {report['clusters']} clusters "
+          f"(threshold {report['threshold']})")
+    print(f"{'LLM calls saved:':<24}{report['llm_calls_saved']}")
+    print(f"{'Embedding calls saved:':<24}{report['embedding_calls_saved']}")
+    for cluster in report["largest_clusters"][:5]:
+        print(f"  {cluster['size']:>4} × {cluster['representative']}")
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else BUILD_REPORT_FILE
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            print_report(json.load(f))
+    except FileNotFoundError:
+        print(f"✗ No build report at {path}, run build_data.py first")
+        sys.exit(1)
@@ -0,0 +1,320 @@
+"""
+Embedding backends
+
+The backend used for both ingestion and queries is selected by
+EMBEDDING_BACKEND in global_settings:
+
+- "openai": OpenAIEmbedding (OPENAI_EMBEDDING_MODEL), a network call per batch
+- "local": LocalTransformerEmbedding, a multilingual transformers model on CPU.
+  Concurrent queries are grouped into one forward pass (dynamic batching),
+  ingestion batches are bucketed by token length to minimise padding and
+  encoded on a small thread pool, and ONNX Runtime and int8 quantization
+  can be switched on in global_settings.
+- "hashing": HashingEmbedding maps word unigrams and bigrams into a fixed
+  number of dimensions with a stable hash. It needs no model download or API
+  key and is deterministic, so benchmarks and tests can build and query
+  indexes offline. It only captures lexical overlap.
+
+Each index records embedding_signature() of the model that built it, and
+check_signature() refuses to query it with a different one.
+"""
+
+import os
+import re
+import math
+import time
+import queue
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from src.global_settings import (
+    EMBEDDING_BACKEND,
+    OPENAI_EMBEDDING_MODEL,
+    LOCAL_EMBEDDING_MODEL,
+    LOCAL_EMBEDDING_BATCH_SIZE,
+    LOCAL_EMBEDDING_MAX_LENGTH,
+    LOCAL_EMBEDDING_WORKERS,
+    LOCAL_EMBEDDING_BATCH_WAIT_MS,
+    LOCAL_EMBEDDING_ONNX,
+    LOCAL_EMBEDDING_INT8,
+    HASHING_EMBEDDING_DIM
+)
+
+EMBEDDING_BACKENDS = ("openai", "local", "hashing")
+
+# Signature assumed for indexes built before backends were recorded
+LEGACY_SIGNATURE = {"backend": "openai", "model": OPENAI_EMBEDDING_MODEL}
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _features(text):
+    """Lowercased word unigrams and bigrams"""
+    words = _WORD_RE.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class HashingEmbedding(BaseEmbedding):
+    """Deterministic feature-hashing embedding"""
+
+    dim: int = Field(default=HASHING_EMBEDDING_DIM, description="Number of dimensions", gt=0)
+
+    @classmethod
+    def class_name(cls):
+        return "HashingEmbedding"
+
+    def _embed(self, text):
+        vector = [0.0] * self.dim
+        for feature in _features(text):
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            # Signed hashing keeps collisions from only adding up
+            vector[value % self.dim] += 1.0 if value >> 63 else -1.0
+        norm = math.sqrt(sum(x * x for x in vector))
+        return [x / norm for x in vector] if norm else vector
+
+    def _get_query_embedding(self, query):
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._embed(query)
+
+    def _get_text_embedding(self, text):
+        return self._embed(text)
+
+
+class LocalTransformerEmbedding(BaseEmbedding):
+    """Mean-pooled transformers encoder running on CPU"""
+
+    batch_size: int = Field(default=LOCAL_EMBEDDING_BATCH_SIZE, gt=0)
+    max_length: int = Field(default=LOCAL_EMBEDDING_MAX_LENGTH, gt=0)
+    num_workers: int = Field(default=LOCAL_EMBEDDING_WORKERS, gt=0)
+    batch_wait_ms: float = Field(default=LOCAL_EMBEDDING_BATCH_WAIT_MS, ge=0)
+    use_onnx: bool = Field(default=LOCAL_EMBEDDING_ONNX)
+    quantize: bool = Field(default=LOCAL_EMBEDDING_INT8)
+    # E5 models expect these prefixes; set both to "" for other models
+    query_prefix: str = Field(default="query: ")
+    text_prefix: str = Field(default="passage: ")
+
+    _tokenizer = PrivateAttr(default=None)
+    _model = PrivateAttr(default=None)
+    _pool = PrivateAttr(default=None)
+    _requests = PrivateAttr(default=None)
+    _load_lock = PrivateAttr(default_factory=threading.Lock)
+    # The fast (Rust) tokenizer raises "Already borrowed" when two threads use
+    # it at once, and the caller, the pool and the batcher all do
+    _tokenizer_lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, model_name=LOCAL_EMBEDDING_MODEL, **kwargs):
+        # Let get_text_embedding_batch hand over enough texts to bucket
+        kwargs.setdefault("embed_batch_size", kwargs.get("batch_size", LOCAL_EMBEDDING_BATCH_SIZE) * 16)
+        super().__init__(model_name=model_name, **kwargs)
+
+    @classmethod
+    def class_name(cls):
+        return "LocalTransformerEmbedding"
+
+    def _load(self):
+        """Load the tokenizer and model on first use"""
+        with self._load_lock:
+            if self._model is not None:
+                return
+            from transformers import AutoTokenizer
+
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            model = self._load_onnx() if self.use_onnx else None
+            if model is None:
+                import torch
+                from transformers import AutoModel
+
+                model = AutoModel.from_pretrained(self.model_name)
+                model.eval()
+                if self.quantize:
+                    model = torch.quantization.quantize_dynamic(
+                        model, {torch.nn.Linear}, dtype=torch.qint8
+                    )
+            self._model = model
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.num_workers,
+                thread_name_prefix="embedding"
+            )
+            self._requests = queue.Queue()
+            threading.Thread(target=self._batch_queries, name="embedding-batcher", daemon=True).start()
+
+    def _load_onnx(self):
+        """ONNX Runtime model (int8 if quantize is set), or None if unavailable"""
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        except ImportError:
+            print("optimum[onnxruntime] is not installed, using the PyTorch model")
+            return None
+
+        model = ORTModelForFeatureExtraction.from_pretrained(self.model_name, export=True)
+        if not self.quantize:
+            return model
+
+        save_dir = os.path.join("data/cache/onnx", self.model_name.replace("/", "__") + "_int8")
+        if not os.path.isdir(save_dir):
+            quantizer = ORTQuantizer.from_pretrained(model)
+            config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=save_dir, quantization_config=config)
+        return ORTModelForFeatureExtraction.from_pretrained(save_dir)
+
+    def _tokenize(self, texts, **kwargs):
+        with self._tokenizer_lock:
+            return self._tokenizer(texts, truncation=True, max_length=self.max_length, **kwargs)
+
+    def _pad(self, features):
+        with self._tokenizer_lock:
+            return self._tokenizer.pad(features, return_tensors="pt")
+
+    def _forward(self, inputs):
+        """Mean pooling over the attention mask, L2-normalized"""
+        import torch
+
+        with torch.inference_mode():
+            hidden = self._model(**inputs).last_hidden_state
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        return torch.nn.functional.normalize(pooled, dim=-1).tolist()
+
+    def _encode(self, texts):
+        """Embed one batch of texts"""
+        return self._forward(self._tokenize(texts, padding=True, return_tensors="pt"))
+
+    def _encode_features(self, features):
+        """Embed one batch of tokenized texts"""
+        return self._forward(self._pad(features))
+
+    def _encode_many(self, texts):
+        """
+        Embed many texts in length-bucketed batches on the thread pool
+
+        Texts are tokenized once here; sorting by token length puts texts of
+        similar length in the same batch, so little compute is spent on
+        padding, and the pool only pads and runs the model.
+        """
+        self._load()
+        encoded = self._tokenize(texts)
+        features = [dict(zip(encoded.keys(), values)) for values in zip(*encoded.values())]
+        order = sorted(range(len(texts)), key=lambda i: len(features[i]["input_ids"]))
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        futures = [
+            self._pool.submit(self._encode_features, [features[i] for i in batch])
+            for batch in batches
+        ]
+
+        embeddings = [None] * len(texts)
+        for batch, future in zip(batches, futures):
+            for i, embedding in zip(batch, future.result()):
+                embeddings[i] = embedding
+        return embeddings
+
+    def _batch_queries(self):
+        """Group queries arriving within batch_wait_ms into one forward pass"""
+        while True:
+            requests = [self._requests.get()]
+            deadline = time.monotonic() + self.batch_wait_ms / 1000
+            while len(requests) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    requests.append(self._requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                embeddings = self._encode([text for text, _ in requests])
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(requests, embeddings):
+                future.set_result(embedding)
+
+    def _submit(self, text):
+        self._load()
+        future = Future()
+        self._requests.put((text, future))
+        return future
+
+    def _get_query_embedding(self, query):
+        return self._submit(self.query_prefix + query).result()
+
+    async def _aget_query_embedding(self, query):
+        import asyncio
+
+        return await asyncio.wrap_future(self._submit(self.query_prefix + query))
+
+    def _get_text_embedding(self, text):
+        return self._submit(self.text_prefix + text).result()
+
+    def _get_text_embeddings(self, texts):
+        return self._encode_many([self.text_prefix + text for text in texts])
+
+
+def get_embed_model(backend=None, **openai_kwargs):
+    """
+    Embedding model of a backend
+
+    Args:
+        backend: One of EMBEDDING_BACKENDS (EMBEDDING_BACKEND if omitted)
+        openai_kwargs: Extra OpenAIEmbedding arguments (api_base,
+            http_client...), for the openai backend
+
+    Returns:
+        BaseEmbedding: The embedding model
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend == "openai":
+        from llama_index.embeddings.openai import OpenAIEmbedding
+
+        return OpenAIEmbedding(model=OPENAI_EMBEDDING_MODEL, **openai_kwargs)
+    if backend == "local":
+        return LocalTransformerEmbedding()
+    if backend == "hashing":
+        return HashingEmbedding()
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+
+def embedding_signature(embed_model):
+    """
+    Identify the vectors an embedding model produces
+
+    Returns:
+        dict: backend and model
+    """
+    if isinstance(embed_model, HashingEmbedding):
+        return {"backend": "hashing", "model": f"dim={embed_model.dim}"}
+    if isinstance(embed_model, LocalTransformerEmbedding):
+        return {"backend": "local", "model": embed_model.model_name}
+    if type(embed_model).__name__ == "OpenAIEmbedding":
+        return {"backend": "openai", "model": embed_model.model_name}
+    return {"backend": type(embed_model).__name__, "model": embed_model.model_name}
+
+
+def check_signature(recorded, embed_model, source="index"):
+    """
+    Make sure queries are embedded like the index was
+
+    Args:
+        recorded: Signature stored with the index (None for legacy indexes)
+        embed_model: Model that will embed queries
+        source: Name of the index, for the error message
+
+    Raises:
+        ValueError: If the signatures differ
+    """
+    recorded = recorded or LEGACY_SIGNATURE
+    current = embedding_signature(embed_model)
+    if recorded != current:
+        raise ValueError(
+            f"The {source} was built with {recorded['backend']} embeddings "
+            f"({recorded['model']}) but queries use {current['backend']} "
+            f"({current['model']}). Set EMBEDDING_BACKEND to match or rebuild the {source}."
+        )
@@ -0,0 +1,16 @@
+"""
+Files that evaluate.py saves in eval_results/
+
+Shared with the benchmarks that reuse evaluate.py's question sets, so both
+find them the same way.
+"""
+
+import glob
+
+QUESTIONS_PATTERN = "eval_results/evaluation_questions_*.csv"
+
+
+def latest_questions_file():
+    """Most recent saved question set in eval_results/, or None"""
+    paths = sorted(glob.glob(QUESTIONS_PATTERN))
+    return paths[-1] if paths else None
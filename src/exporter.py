@@ -0,0 +1,302 @@
+"""
+Export of score and chat history
+
+Exports are produced on demand and streamed in record batches to a file,
+so memory stays bounded by the batch size rather than the history size.
+Scores are read from the Parquet mirror maintained by src.cohort_analytics.
+Exports prepared for download that are never fetched are deleted by a
+background sweep once they are EXPORT_MAX_AGE seconds old.
+
+Usage:
+    python -m src.exporter scores --format parquet --output scores.parquet
+    python -m src.exporter scores --username an --format csv --output an.csv
+    python -m src.exporter chat --username an --format json --output an.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import datetime
+from src.global_settings import (
+    EXPORT_DIR,
+    EXPORT_BATCH_SIZE,
+    EXPORT_LINK_DIR,
+    EXPORT_MAX_AGE,
+    EXPORT_CLEAN_INTERVAL
+)
+
+# Format -> (MIME type, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", ".csv"),
+    "json": ("application/json", ".json"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+    "arrow": ("application/vnd.apache.arrow.file", ".arrow"),
+}
+
+# Parquet mirror columns, renamed by _score_schema() in exported files
+SCORE_COLUMNS = ["username", "time", "score", "content", "total_guess"]
+
+_cleaner_lock = threading.Lock()
+_cleaner = {"thread": None}
+
+
+def _score_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("username", pa.string()),
+        ("Time", pa.timestamp("us")),
+        ("Score", pa.string()),
+        ("Content", pa.string()),
+        ("Total_guess", pa.string()),
+    ])
+
+
+def _chat_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("username", pa.string()),
+        ("index", pa.int64()),
+        ("role", pa.string()),
+        ("content", pa.string()),
+    ])
+
+
+def iter_score_batches(usernames=None, start=None, end=None, scores=None,
+                       batch_size=EXPORT_BATCH_SIZE):
+    """
+    Stream score history as Arrow record batches
+
+    Args:
+        usernames: Only export these users (all users if None)
+        start: Keep assessments at or after this datetime
+        end: Keep assessments before this datetime
+        scores: Only export these score labels
+        batch_size: Maximum rows per batch
+
+    Yields:
+        RecordBatch: username, Time, Score, Content, Total_guess
+    """
+    import pyarrow as pa
+    from src.cohort_analytics import sync_columnar_store, load_manifest, open_dataset, build_filter
+
+    sync_columnar_store(usernames=usernames)
+    if not load_manifest()["rows"]:
+        return
+
+    # Fragments are scanned one at a time without readahead, so only one
+    # batch is decoded at once whatever the size of the history
+    dataset = open_dataset()
+    predicate = build_filter(start, end, usernames, scores)
+    for fragment in dataset.get_fragments(filter=predicate):
+        for batch in fragment.to_batches(
+            schema=dataset.schema,
+            columns=SCORE_COLUMNS,
+            filter=predicate,
+            batch_size=batch_size,
+            use_threads=False,
+        ):
+            if batch.num_rows:
+                yield pa.RecordBatch.from_arrays(batch.columns, schema=_score_schema())
+
+
+def iter_chat_batches(username, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Stream a user's chat history as Arrow record batches
+
+    Args:
+        username: Username
+        batch_size: Maximum rows per batch
+
+    Yields:
+        RecordBatch: username, index, role, content
+    """
+    import pyarrow as pa
+    from src.conversation_engine import get_chat_history
+
+    messages = get_chat_history(username)
+    schema = _chat_schema()
+    for offset in range(0, len(messages), batch_size):
+        chunk = messages[offset:offset + batch_size]
+        yield pa.RecordBatch.from_pydict({
+            "username": [username] * len(chunk),
+            "index": list(range(offset, offset + len(chunk))),
+            "role": [str(getattr(m.role, "value", m.role)) for m in chunk],
+            "content": [m.content or "" for m in chunk],
+        }, schema=schema)
+
+
+def write_batches(batches, schema, fmt, path):
+    """
+    Write record batches to a file one batch at a time
+
+    Args:
+        batches: Iterable of RecordBatch
+        schema: Arrow schema of the batches
+        fmt: One of EXPORT_FORMATS
+        path: Output file path
+
+    Returns:
+        int: Number of rows written
+    """
+    import pyarrow as pa
+
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+    rows = 0
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        with pq.ParquetWriter(path, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+
+    elif fmt == "arrow":
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+
+    elif fmt == "csv":
+        import pyarrow.csv as pacsv
+
+        with open(path, "wb") as f:
+            # BOM so spreadsheet apps detect UTF-8, as the previous exports did
+            f.write("\ufeff".encode("utf-8"))
+            with pacsv.CSVWriter(f, schema) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("[")
+            for batch in batches:
+                for record in batch.to_pylist():
+                    f.write(",\n" if rows else "\n")
+                    json.dump(record, f, ensure_ascii=False, default=str)
+                    rows += 1
+            f.write("\n]\n")
+
+    return rows
+
+
+def remove_stale_exports(max_age=EXPORT_MAX_AGE):
+    """
+    Delete exports in EXPORT_DIR and EXPORT_LINK_DIR older than max_age
+
+    Args:
+        max_age: Age in seconds, from the time the file was written
+
+    Returns:
+        int: Number of files deleted
+    """
+    cutoff = time.time() - max_age
+    removed = 0
+    for directory in (EXPORT_DIR, EXPORT_LINK_DIR):
+        for root, dirs, files in os.walk(directory, topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+            # Link directories hold one export each
+            if root != directory and not os.listdir(root) and os.path.getmtime(root) < cutoff:
+                os.rmdir(root)
+    return removed
+
+
+def _run_cleaner():
+    while True:
+        try:
+            remove_stale_exports()
+        except OSError as e:
+            print(f"✗ Removing old exports failed: {e!r}")
+        time.sleep(EXPORT_CLEAN_INTERVAL)
+
+
+def start_cleaner():
+    """Start the background sweep of old exports, once per process"""
+    with _cleaner_lock:
+        if _cleaner["thread"] is None:
+            _cleaner["thread"] = threading.Thread(target=_run_cleaner, name="export-cleaner", daemon=True)
+            _cleaner["thread"].start()
+
+
+def export_path(name, fmt):
+    """Timestamped path for an export file in EXPORT_DIR"""
+    start_cleaner()
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return os.path.join(EXPORT_DIR, f"{name}_{timestamp}{EXPORT_FORMATS[fmt][1]}")
+
+
+def export_scores(fmt, path=None, usernames=None, start=None, end=None, scores=None):
+    """
+    Export score history to a file
+
+    Args:
+        fmt: One of EXPORT_FORMATS
+        path: Output path (timestamped file in EXPORT_DIR if omitted)
+        usernames: Only export these users (all users if None)
+        start: Keep assessments at or after this datetime
+        end: Keep assessments before this datetime
+        scores: Only export these score labels
+
+    Returns:
+        tuple: (path, number of rows)
+    """
+    if path is None:
+        name = "mental_health_" + ("_".join(usernames) if usernames else "all_users")
+        path = export_path(name, fmt)
+    batches = iter_score_batches(usernames, start, end, scores)
+    return path, write_batches(batches, _score_schema(), fmt, path)
+
+
+def export_chat(username, fmt, path=None):
+    """
+    Export a user's chat history to a file
+
+    Args:
+        username: Username
+        fmt: One of EXPORT_FORMATS
+        path: Output path (timestamped file in EXPORT_DIR if omitted)
+
+    Returns:
+        tuple: (path, number of rows)
+    """
+    path = path or export_path(f"chat_{username}", fmt)
+    return path, write_batches(iter_chat_batches(username), _chat_schema(), fmt, path)
+
+
+def main(argv=None):
+    """Command line interface"""
+    parser = argparse.ArgumentParser(description="Export score and chat history")
+    parser.add_argument("kind", choices=["scores", "chat"])
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="parquet")
+    parser.add_argument("--username", action="append", help="Repeat for several users")
+    parser.add_argument("--output", help="Output file path")
+    args = parser.parse_args(argv)
+
+    if args.kind == "chat":
+        if not args.username or len(args.username) != 1:
+            parser.error("chat export needs exactly one --username")
+        path, rows = export_chat(args.username[0], args.format, args.output)
+    else:
+        path, rows = export_scores(args.format, args.output, usernames=args.username)
+
+    print(f"✓ Exported {rows} rows to {path}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
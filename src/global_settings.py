@@ -4,26 +4,150 @@ Global settings and configuration for the Mental Health Care System
 
 # Cache and storage paths
 CACHE_FILE = "data/cache/pipeline_cache.json"
-CONVERSATION_FILE = "data/cache/chat_history.json"
+CONVERSATION_FILE = "data/cache/chat_history.json"  # legacy, imported into CHAT_DIR
+
+# Shared storage of users, chats, scores, caches and index snapshots (see
+# src/storage.py). "" keeps everything in the local files below; set
+# "sqlite:///<path>" to share one database between app replicas running on
+# this host (a local disk path: SQLite's WAL mode does not work over NFS/SMB),
+# or "postgresql+psycopg://<user>:<password>@<host>/<database>" to share a
+# PostgreSQL database between replicas on several hosts.
+STORAGE_URL = ""
+STORAGE_CACHE_BYTES = 64 * 1024 * 1024  # per-replica read cache of shared objects
+STORAGE_POLL_INTERVAL = 1.0  # seconds between checks for other replicas' changes
+STORAGE_CHANGE_LOG_SIZE = 100000  # changes kept for replicas catching up
+STORAGE_POOL_SIZE = 10  # connections per replica to a PostgreSQL server
 
 # Data paths
 STORAGE_PATH = "data/ingestion_storage/"
 FILES_PATH = ["data/ingestion_storage/dsm5.docx"]
 
+# Write-behind persistence of chat history and scores
+PERSIST_QUEUE_SIZE = 1000
+PERSIST_FLUSH_INTERVAL = 0.2  # seconds to coalesce writes before flushing
+PERSIST_FSYNC_INTERVAL = 1.0  # minimum seconds between fsyncs, 0 = every flush
+PERSIST_RETRY_DELAY = 1.0
+PERSIST_MAX_RETRIES = 5  # attempts before a write is moved to the dead-letter file
+PERSIST_DEAD_LETTER_FILE = "data/user_storage/persist_dead_letters.jsonl"
+PERSIST_READ_TIMEOUT = 5.0  # max seconds a reader waits for pending writes
+
+# Exported history files
+EXPORT_DIR = "data/cache/exports"
+EXPORT_BATCH_SIZE = 10000
+EXPORT_INLINE_MAX_BYTES = 10 * 1024 * 1024  # larger exports are downloaded through a link
+# Streamlit serves static/ at app/static/ (see .streamlit/config.toml), up to 200 MB a file
+EXPORT_LINK_DIR = "static/exports"
+EXPORT_LINK_MAX_BYTES = 200 * 1024 * 1024
+EXPORT_MAX_AGE = 3600  # seconds a prepared export is kept if never downloaded
+EXPORT_CLEAN_INTERVAL = 600  # seconds between sweeps of old exports
+
 # Index storage
 INDEX_STORAGE = "data/index_storage"
 
 # User data
-SCORES_FILE = "data/user_storage/scores.json"
+SCORES_FILE = "data/user_storage/scores.json"  # legacy, imported into SCORES_LOG
+SCORES_LOG = "data/user_storage/scores.jsonl"  # one assessment per line, append-only
+CHAT_DIR = "data/user_storage/chats"  # one chat history per user
 USERS_FILE = "data/user_storage/users.yaml"
+USERS_DB = "data/user_storage/users.db"
+USER_CACHE_SIZE = 10000
+STATS_FILE = "data/user_storage/user_stats.json"  # legacy, imported into STATS_DIR
+STATS_DIR = "data/user_storage/stats"  # counters of one user per file
+SCORES_DATASET = "data/user_storage/scores_parquet"
+SCORES_DATASET_MAX_PARTS = 16  # part files a month may gather before they are merged
+
+# Per-user long-term memory of assessments and conversation summaries
+USER_MEMORY_DIR = "data/user_storage/memory"
+USER_MEMORY_TOP_K = 3  # past episodes returned to the agent per lookup
+USER_MEMORY_WINDOW = 20  # recent messages left out of summaries
+USER_MEMORY_WORKERS = 4  # users whose memory is embedded or summarized at once
+
+# Token metering and per-user daily budgets (see src/metering.py)
+USAGE_DB = "data/user_storage/usage.db"
+DAILY_TOKEN_BUDGET = 200000  # tokens per user per day, 0 = unlimited
+BUDGET_DEGRADE_RATIO = 0.8  # share of the budget after which answers are degraded
+USAGE_FLUSH_INTERVAL = 2.0  # seconds token counts are kept in memory before being written
+DEGRADED_CONTEXT_TOKEN_BUDGET = 600  # retrieved context per synthesis when degraded
+# USD per million (input, output) tokens, for cost estimates
+TOKEN_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "text-embedding-ada-002": (0.10, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+
+# RAG backend service (see src/rag_service.py). When RAG_SERVICE_URL is set,
+# the Streamlit pages call the service instead of running the agent themselves.
+RAG_SERVICE_URL = ""  # e.g. "http://127.0.0.1:8700"
+RAG_SERVICE_HOST = "127.0.0.1"
+RAG_SERVICE_PORT = 8700
+RAG_SERVICE_TOKEN = ""  # secret signing per-user tokens, required unless bound to loopback
+RAG_SERVICE_USER_TOKEN_TTL = 300  # seconds a signed user token is valid
+RAG_SERVICE_MAX_AGENTS = 256  # per-user agents kept in memory
+RAG_SERVICE_TIMEOUT = 120.0  # seconds a client waits for the service
+# Keep-alive connection pool of the service's LLM and embedding clients
+LLM_API_BASE = ""  # OpenAI-compatible endpoint, empty = OpenAI
+LLM_MAX_CONNECTIONS = 64
+LLM_MAX_KEEPALIVE_CONNECTIONS = 32
+LLM_KEEPALIVE_EXPIRY = 60.0  # seconds an idle connection is kept
+LLM_TIMEOUT = 60.0
 
 # Application settings
 APP_TITLE = "Hệ thống Chăm sóc Sức khỏe Tinh thần"
 APP_ICON = "🧠"
+HISTORY_PAGE_SIZE = 10
+
+# Usernames allowed to open the admin pages
+ADMIN_USERS = []
+
+# Rerun profiler (see src/profiler.py); admins can also open a page with ?profile=1
+PROFILER_ENABLED = False
+PROFILER_CPROFILE = False  # also save a cProfile trace of every rerun
+PROFILER_HISTORY = 50  # reruns kept per session
+PROFILE_DIR = "data/cache/profiles"
+
+# Embedding backend: "openai", "local" (transformers on CPU) or "hashing"
+# (deterministic, offline; for tests and benchmarks only). Indexes record the
+# backend that built them and refuse to load with a different one.
+EMBEDDING_BACKEND = "openai"
+OPENAI_EMBEDDING_MODEL = "text-embedding-ada-002"
+LOCAL_EMBEDDING_MODEL = "intfloat/multilingual-e5-small"
+LOCAL_EMBEDDING_BATCH_SIZE = 32
+LOCAL_EMBEDDING_MAX_LENGTH = 512
+LOCAL_EMBEDDING_WORKERS = 2  # batches encoded concurrently
+LOCAL_EMBEDDING_BATCH_WAIT_MS = 5  # time to group concurrent queries into one batch
+LOCAL_EMBEDDING_ONNX = False  # needs optimum[onnxruntime]
+LOCAL_EMBEDDING_INT8 = False  # dynamic int8 quantization
+HASHING_EMBEDDING_DIM = 512
 
 # Model settings
 DEFAULT_MODEL = "gpt-4o-mini"
 DEFAULT_TEMPERATURE = 0.2
 CHUNK_SIZE = 512
 CHUNK_OVERLAP = 20
-SIMILARITY_TOP_K = 3
\ No newline at end of file
+INGEST_BATCH_SIZE = 16  # chunks summarized and embedded per pipeline run
+INGEST_PREFETCH_BATCHES = 4  # batches parsed ahead of the pipeline
+# Near-duplicate chunks share the summary and embedding of their cluster
+# representative (see src/dedup.py); 0 disables deduplication
+DEDUP_THRESHOLD = 0.9  # estimated Jaccard similarity of word shingles
+DEDUP_NUM_PERM = 128  # MinHash signature length
+DEDUP_SHINGLE_SIZE = 5  # words per shingle
+BUILD_REPORT_FILE = "data/cache/build_report.json"
+SIMILARITY_TOP_K = 3
+CONTEXT_TOKEN_BUDGET = 1500  # max tokens of retrieved context per synthesis, 0 = no limit
+CONTEXT_MAX_METADATA_CHARS = 200  # longer metadata values are hidden from the LLM
+
+# Evaluation settings
+EVAL_WORKERS = 4
+EVAL_REQUESTS_PER_MINUTE = 300
+EVAL_MAX_RETRIES = 3
+SECRETS_FILE = ".streamlit/secrets.toml"
+
+# Cached evaluator (LLM judge) results
+JUDGE_CACHE_DIR = "data/cache/judge"
+JUDGE_CACHE_MAX_ENTRIES = 50000
+JUDGE_PROMPT_VERSION = 1  # bump to invalidate cached judgments
+
+# Sharded document corpus: one index per source under CORPUS_DIR
+CORPUS_DIR = "data/corpus"
+CORPUS_MAX_WORKERS = 8  # shards queried concurrently
@@ -0,0 +1,166 @@
+"""
+Score analytics for the User Health dashboard
+
+Pure functions that turn a user's saved assessments into a DataFrame,
+summary metrics and Plotly figures. The page caches their results per
+score-store version, so widget interactions do not rebuild them.
+"""
+
+from datetime import datetime, timedelta
+from src.global_settings import PERSIST_READ_TIMEOUT
+from src import persistence
+
+# Score mapping for visualization
+SCORE_MAPPING = {
+    'tốt': 4,
+    'bình thường': 3,
+    'trung bình': 2,
+    'kém': 1
+}
+
+SCORE_LABELS = {4: 'Tốt', 3: 'Bình thường', 2: 'Trung bình', 1: 'Kém'}
+
+RECENT_DAYS = 7
+
+
+def load_user_scores(username):
+    """Load scores for specific user"""
+    persistence.wait_until_flushed(PERSIST_READ_TIMEOUT, username)
+    all_scores, _ = persistence.read_scores()
+    return [s for s in all_scores if s['username'] == username]
+
+
+def build_score_frame(user_scores):
+    """
+    Build the dashboard DataFrame, newest assessment first
+
+    Args:
+        user_scores: List of score entries for one user
+
+    Returns:
+        DataFrame: Scores with parsed Time and Score_Numeric columns
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(user_scores)
+    df['Time'] = pd.to_datetime(df['Time'])
+    df = df.sort_values('Time', ascending=False).reset_index(drop=True)
+    df['Score_Numeric'] = df['Score'].str.lower().map(SCORE_MAPPING)
+    return df
+
+
+def summarize_scores(df, now=None):
+    """
+    Compute the overview metrics shown at the top of the dashboard
+
+    Args:
+        df: DataFrame from build_score_frame
+        now: Reference time for the rolling window
+
+    Returns:
+        dict: total, latest_score, avg_label, recent_count, recent_avg
+    """
+    import pandas as pd
+
+    now = now or datetime.now()
+    recent = df[df['Time'] >= now - timedelta(days=RECENT_DAYS)]
+    avg_score = df['Score_Numeric'].mean()
+
+    return {
+        'total': len(df),
+        'latest_score': df.iloc[0]['Score'],
+        'avg_label': SCORE_LABELS.get(round(avg_score), 'N/A') if pd.notna(avg_score) else 'N/A',
+        'recent_count': len(recent),
+        'recent_avg': recent['Score_Numeric'].mean() if len(recent) else None,
+    }
+
+
+def build_figures(df):
+    """
+    Build the timeline, distribution and recent-scores figures
+
+    Args:
+        df: DataFrame from build_score_frame
+
+    Returns:
+        tuple: (fig_timeline, fig_pie, fig_bar)
+    """
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    score_axis = dict(
+        tickmode='array',
+        tickvals=[1, 2, 3, 4],
+        ticktext=['Kém', 'Trung bình', 'Bình thường', 'Tốt']
+    )
+
+    # Time series chart
+    fig_timeline = go.Figure()
+
+    fig_timeline.add_trace(go.Scatter(
+        x=df['Time'].iloc[::-1],
+        y=df['Score_Numeric'].iloc[::-1],
+        mode='lines+markers',
+        name='Điểm sức khỏe',
+        line=dict(color='#1f77b4', width=3),
+        marker=dict(size=10, color='#1f77b4', symbol='circle')
+    ))
+
+    fig_timeline.update_layout(
+        title='Biểu đồ theo dõi sức khỏe tinh thần theo thời gian',
+        xaxis_title='Thời gian',
+        yaxis_title='Điểm số',
+        yaxis=score_axis,
+        height=400,
+        hovermode='x unified'
+    )
+
+    # Score distribution
+    score_counts = df['Score'].value_counts()
+
+    fig_pie = px.pie(
+        values=score_counts.values,
+        names=score_counts.index,
+        title='Phân bố điểm đánh giá',
+        color_discrete_sequence=px.colors.qualitative.Set3
+    )
+    fig_pie.update_traces(textposition='inside', textinfo='percent+label')
+
+    # Bar chart of scores over time
+    fig_bar = px.bar(
+        df.iloc[:10][::-1],
+        x='Time',
+        y='Score_Numeric',
+        color='Score',
+        title='10 đánh giá gần nhất',
+        labels={'Score_Numeric': 'Điểm số', 'Time': 'Thời gian'},
+        color_discrete_sequence=px.colors.qualitative.Pastel
+    )
+    fig_bar.update_yaxes(**score_axis)
+
+    return fig_timeline, fig_pie, fig_bar
+
+
+def filter_scores(df, start_date=None, end_date=None, scores=None):
+    """
+    Filter the dashboard DataFrame by date range and score labels
+
+    Args:
+        df: DataFrame from build_score_frame
+        start_date: First date to keep (inclusive)
+        end_date: Last date to keep (inclusive)
+        scores: Score labels to keep
+
+    Returns:
+        DataFrame: Filtered rows, newest first
+    """
+    if scores is not None:
+        mask = df['Score'].str.lower().isin([score.lower() for score in scores])
+    else:
+        mask = df['Score'].notna()
+
+    if start_date is not None and end_date is not None:
+        dates = df['Time'].dt.date
+        mask &= (dates >= start_date) & (dates <= end_date)
+
+    return df[mask]
@@ -1,10 +1,88 @@
 """
 Index builder for creating and loading vector store indexes
+
+A built index is published to storage (src/storage.py), and mirrored from
+it before being loaded, so every replica serves the same snapshot.
 """
 
-from llama_index.core import VectorStoreIndex, load_index_from_storage
-from llama_index.core import StorageContext
+import os
+import json
+from datetime import datetime
 from src.global_settings import INDEX_STORAGE
+from src.sections import build_metadata_index
+from src.storage import get_storage
+
+INDEX_MANIFEST_FILE = "index_manifest.json"
+
+
+def write_index_manifest(persist_dir, embed_model, nodes):
+    """
+    Record how an index was built next to it
+
+    Args:
+        persist_dir: Index directory
+        embed_model: Embedding model that embedded the nodes
+        nodes: Number of nodes
+
+    Returns:
+        dict: The manifest
+    """
+    from src.embeddings import embedding_signature
+
+    manifest = {
+        "embedding": embedding_signature(embed_model),
+        "nodes": nodes,
+        "built_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(os.path.join(persist_dir, INDEX_MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_index_manifest(persist_dir=INDEX_STORAGE):
+    """
+    Read an index manifest
+
+    Returns:
+        dict: The manifest, empty for indexes built before manifests existed
+    """
+    try:
+        with open(os.path.join(persist_dir, INDEX_MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def load_index(embed_model=None):
+    """
+    Load the persisted vector index without ingesting documents
+
+    Args:
+        embed_model: Query embedding model (Settings.embed_model if omitted)
+
+    Returns:
+        VectorStoreIndex: The vector index
+
+    Raises:
+        FileNotFoundError: If no index has been persisted yet
+        ValueError: If the index was embedded with a different backend
+    """
+    from llama_index.core import Settings
+    from llama_index.core import load_index_from_storage
+    from llama_index.core import StorageContext
+    from src.embeddings import check_signature
+
+    get_storage().pull(INDEX_STORAGE)
+    if not os.path.exists(os.path.join(INDEX_STORAGE, "docstore.json")):
+        raise FileNotFoundError(
+            f"No index found in {INDEX_STORAGE}, run build_data.py first"
+        )
+
+    embed_model = embed_model or Settings.embed_model
+    check_signature(read_index_manifest(INDEX_STORAGE).get("embedding"), embed_model)
+
+    storage_context = StorageContext.from_defaults(persist_dir=INDEX_STORAGE)
+    return load_index_from_storage(storage_context, index_id="vector", embed_model=embed_model)
 
 
 def build_indexes(nodes):
@@ -17,15 +95,12 @@ def build_indexes(nodes):
     Returns:
         VectorStoreIndex: The vector index
     """
+    from llama_index.core import VectorStoreIndex
+    from llama_index.core import StorageContext
+
     try:
         # Try to load existing index
-        storage_context = StorageContext.from_defaults(
-            persist_dir=INDEX_STORAGE
-        )
-        vector_index = load_index_from_storage(
-            storage_context, 
-            index_id="vector"
-        )
+        vector_index = load_index()
         print("All indices loaded from storage.")
         
     except Exception as e:
@@ -40,8 +115,12 @@ def build_indexes(nodes):
         )
         vector_index.set_index_id("vector")
         
-        # Persist the index
+        # Persist the index, its chapter/category metadata index and the
+        # embedding backend queries must use
         storage_context.persist(persist_dir=INDEX_STORAGE)
+        build_metadata_index(vector_index, INDEX_STORAGE)
+        write_index_manifest(INDEX_STORAGE, vector_index._embed_model, len(nodes))
+        get_storage().push(INDEX_STORAGE)
         print("New indexes created and persisted.")
     
     return vector_index
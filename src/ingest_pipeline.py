@@ -1,16 +1,10 @@
 """
 Data ingestion pipeline for processing documents
+
+LlamaIndex, OpenAI and Streamlit are imported inside the functions that use
+them, so pages importing this module only pay for what they call.
 """
 
-from llama_index.core import SimpleDirectoryReader
-from llama_index.core.ingestion import IngestionPipeline, IngestionCache
-from llama_index.core.node_parser import TokenTextSplitter
-from llama_index.core.extractors import SummaryExtractor
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core import Settings
-from llama_index.llms.openai import OpenAI
-import openai
-import streamlit as st
 from src.global_settings import (
     STORAGE_PATH,
     FILES_PATH,
@@ -18,65 +12,152 @@ from src.global_settings import (
     DEFAULT_MODEL,
     DEFAULT_TEMPERATURE,
     CHUNK_SIZE,
-    CHUNK_OVERLAP
+    CHUNK_OVERLAP,
+    INGEST_BATCH_SIZE,
+    INGEST_PREFETCH_BATCHES,
+    DEDUP_THRESHOLD,
+    BUILD_REPORT_FILE
 )
 from src.prompts import CUSTORM_SUMMARY_EXTRACT_TEMPLATE
 
 
 def initialize_settings():
     """Initialize OpenAI settings"""
+    import openai
+    import streamlit as st
+    from llama_index.core import Settings
+    from llama_index.llms.openai import OpenAI
+    from src.embeddings import get_embed_model
+    from src import metering
+
+    # Meter token usage of everything created from Settings
+    metering.install()
     openai.api_key = st.secrets.openai.OPENAI_API_KEY
     Settings.llm = OpenAI(model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE)
+    Settings.embed_model = get_embed_model()
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _prefetch(iterable, size):
+    """
+    Produce items of iterable in a background thread
+
+    At most size items are buffered, so parsing runs ahead of the pipeline
+    without holding the whole input in memory.
+    """
+    import queue
+    import threading
+
+    items = queue.Queue(maxsize=size)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        items.put(done)
+
+    threading.Thread(target=produce, name="ingest-prefetch", daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
 
 
-def ingest_documents():
+def ingest_documents(files=None, cache_file=CACHE_FILE, embed_model=None,
+                     report_file=BUILD_REPORT_FILE):
     """
     Load and process documents through ingestion pipeline
 
+    Chunks are streamed from the source files and summarized and embedded in
+    batches of INGEST_BATCH_SIZE while the files are still being parsed.
+    Near-duplicate chunks skip the pipeline and reuse the results of their
+    cluster representative.
+
+    Args:
+        files: Document paths (FILES_PATH if omitted)
+        cache_file: Ingestion cache file
+        embed_model: Embedding transformation (EMBEDDING_BACKEND's if omitted)
+        report_file: Where the build report is saved
+
     Returns:
         list: Processed nodes
     """
-    # Load documents with filename as ID
-    documents = SimpleDirectoryReader(
-        input_files=FILES_PATH,
-        filename_as_id=True
-    ).load_data()
+    from llama_index.core.ingestion import IngestionPipeline, IngestionCache
+    from llama_index.core.extractors import SummaryExtractor
+    from src.chunking import iter_chunks
+    from src.dedup import NearDuplicateIndex, print_report, save_report
+    from src import metering
+    from src.storage import get_storage
 
-    print(f"Loaded {len(documents)} documents")
-    for doc in documents:
-        print(f"Document ID: {doc.id_}")
+    if embed_model is None:
+        from src.embeddings import get_embed_model
+        embed_model = get_embed_model()
+    metering.install(embed_model)
 
-    # Try to load cached pipeline
+    # Try to load cached pipeline, as last published by any node
+    get_storage().pull(cache_file)
     try:
-        cached_hashes = IngestionCache.from_persist_path(CACHE_FILE)
+        cached_hashes = IngestionCache.from_persist_path(cache_file)
         print("Cache file found. Running using cache...")
     except:
         cached_hashes = ""
         print("No cache file found. Running without cache...")
 
-    # Create ingestion pipeline
+    # Create ingestion pipeline; chunking happens while streaming the files
     pipeline = IngestionPipeline(
         transformations=[
-            TokenTextSplitter(
-                chunk_size=CHUNK_SIZE,
-                chunk_overlap=CHUNK_OVERLAP
-            ),
             SummaryExtractor(
                 summaries=['self'],
                 prompt_template=CUSTORM_SUMMARY_EXTRACT_TEMPLATE
             ),
-            OpenAIEmbedding()
+            embed_model
         ],
         cache=cached_hashes
     )
 
-    # Process documents
-    nodes = pipeline.run(documents=documents)
+    # Process chunk batches as they are parsed: .docx files are split at
+    # their headings and tagged with chapter/section metadata
+    nodes = []
+    dedup = NearDuplicateIndex(DEDUP_THRESHOLD) if DEDUP_THRESHOLD else None
+    chunks = _batched(iter_chunks(files or FILES_PATH, CHUNK_SIZE, CHUNK_OVERLAP), INGEST_BATCH_SIZE)
+    with metering.attribute(feature="ingestion"):
+        for batch in _prefetch(chunks, INGEST_PREFETCH_BATCHES):
+            if dedup is None:
+                nodes.extend(pipeline.run(nodes=batch))
+            else:
+                representatives, duplicates = dedup.split(batch)
+                processed = pipeline.run(nodes=representatives) if representatives else []
+                dedup.remember(processed)
+                nodes.extend(processed)
+                nodes.extend(dedup.resolve(duplicates))
+            print(f"Processed {len(nodes)} nodes...")
 
     # Save cache
-    pipeline.cache.persist(CACHE_FILE)
+    pipeline.cache.persist(cache_file)
+    get_storage().push(cache_file)
     print(f"Processed {len(nodes)} nodes and saved cache")
 
+    if dedup is not None:
+        report = dedup.report()
+        save_report(report, report_file)
+        print_report(report)
+
     return nodes
 
 
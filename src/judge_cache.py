@@ -0,0 +1,210 @@
+"""
+Content-addressed cache of evaluator results
+
+Each judgment is stored under a hash of the evaluator type, judge model,
+prompt version and the evaluated inputs (query, response, contexts and
+reference), so re-running an evaluation only re-judges items whose inputs
+changed. Entries are one JSON file each, and the least recently used ones
+are evicted once the cache grows past JUDGE_CACHE_MAX_ENTRIES.
+
+Clear or trim the cache:
+    python -m src.judge_cache clear
+    python -m src.judge_cache evict
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+from src.global_settings import (
+    JUDGE_CACHE_DIR,
+    JUDGE_CACHE_MAX_ENTRIES,
+    JUDGE_PROMPT_VERSION
+)
+
+# Fields of an EvaluationResult that are cached; inputs are part of the key
+RESULT_FIELDS = ("response", "passing", "feedback", "score", "invalid_result", "invalid_reason")
+
+_stats = {}
+
+
+def _digest(value):
+    """SHA-256 of a JSON-serializable value"""
+    text = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def judge_signature(evaluator):
+    """
+    Identify the judge behind an evaluator
+
+    The prompt version combines JUDGE_PROMPT_VERSION with a hash of the
+    evaluator's prompt templates, so editing a prompt invalidates its entries.
+
+    Returns:
+        dict: evaluator type, model, temperature and prompt version
+    """
+    llm = getattr(evaluator, "_llm", None)
+    prompts = {
+        name: prompt.get_template()
+        for name, prompt in evaluator.get_prompts().items()
+    }
+    return {
+        "evaluator": type(evaluator).__name__,
+        "model": getattr(llm, "model", None) or type(llm).__name__,
+        "temperature": getattr(llm, "temperature", None),
+        "prompt_version": f"{JUDGE_PROMPT_VERSION}-{_digest(prompts)[:12]}",
+    }
+
+
+def cache_key(signature, query, response, contexts, reference=None):
+    """Content hash of one judgment"""
+    return _digest({
+        **signature,
+        "query": query,
+        "response": response,
+        "contexts": list(contexts or []),
+        "reference": reference,
+    })
+
+
+def _entry_path(key, cache_dir=JUDGE_CACHE_DIR):
+    return os.path.join(cache_dir, key[:2], f"{key}.json")
+
+
+def get(key, cache_dir=JUDGE_CACHE_DIR):
+    """
+    Look up a cached judgment
+
+    Returns:
+        dict or None: Cached result fields
+    """
+    path = _entry_path(key, cache_dir)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    # Refresh the access time used for LRU eviction
+    os.utime(path)
+    return entry
+
+
+def put(key, entry, cache_dir=JUDGE_CACHE_DIR):
+    """Store a judgment atomically"""
+    path = _entry_path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _record(name, hit):
+    stats = _stats.setdefault(name, {"hits": 0, "misses": 0})
+    stats["hits" if hit else "misses"] += 1
+
+
+async def aevaluate(name, evaluator, query, response, contexts, reference=None,
+                    evaluate_fn=None, cache_dir=JUDGE_CACHE_DIR):
+    """
+    Evaluate with an evaluator, reusing a cached judgment when possible
+
+    Args:
+        name: Metric name used in the hit-rate statistics
+        evaluator: LlamaIndex evaluator
+        query: Question
+        response: Response text
+        contexts: Retrieved context strings
+        reference: Reference answer, if any
+        evaluate_fn: Coroutine function used on a miss (evaluator.aevaluate
+            if omitted), e.g. a rate-limited wrapper
+        cache_dir: Cache directory
+
+    Returns:
+        EvaluationResult: Cached or fresh result
+    """
+    from llama_index.core.evaluation import EvaluationResult
+
+    key = cache_key(judge_signature(evaluator), query, response, contexts, reference)
+    cached = get(key, cache_dir)
+    _record(name, cached is not None)
+    if cached is not None:
+        return EvaluationResult(query=query, contexts=contexts, **cached)
+
+    kwargs = {"query": query, "response": response, "contexts": contexts}
+    if reference is not None:
+        kwargs["reference"] = reference
+    result = await (evaluate_fn or evaluator.aevaluate)(**kwargs)
+
+    # Failed judgments are not cached so they are retried next run
+    if not result.invalid_result:
+        put(key, {field: getattr(result, field) for field in RESULT_FIELDS}, cache_dir)
+    return result
+
+
+def get_stats():
+    """
+    Hit and miss counts per metric since the last reset
+
+    Returns:
+        dict: {name: {"hits", "misses", "hit_rate"}}
+    """
+    return {
+        name: {**stats, "hit_rate": stats["hits"] / max(stats["hits"] + stats["misses"], 1)}
+        for name, stats in _stats.items()
+    }
+
+
+def reset_stats():
+    _stats.clear()
+
+
+def evict(max_entries=JUDGE_CACHE_MAX_ENTRIES, cache_dir=JUDGE_CACHE_DIR):
+    """
+    Remove the least recently used entries beyond max_entries
+
+    Returns:
+        int: Number of entries removed
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    entries = []
+    for shard in os.scandir(cache_dir):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.name.endswith(".json"):
+                entries.append((entry.stat().st_mtime, entry.path))
+
+    excess = len(entries) - max_entries
+    if excess <= 0:
+        return 0
+
+    entries.sort()
+    for _, path in entries[:excess]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return excess
+
+
+def clear(cache_dir=JUDGE_CACHE_DIR):
+    """Delete every cached judgment"""
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["clear"]:
+        clear()
+        print(f"✓ Cleared {JUDGE_CACHE_DIR}")
+    elif sys.argv[1:] == ["evict"]:
+        removed = evict()
+        print(f"✓ Evicted {removed} entries (limit {JUDGE_CACHE_MAX_ENTRIES})")
+    else:
+        print("Usage: python -m src.judge_cache clear|evict")
+        sys.exit(1)
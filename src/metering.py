@@ -0,0 +1,369 @@
+"""
+Per-user token metering and daily budgets
+
+TokenMeter is a LlamaIndex callback handler: every LLM and embedding call
+made through Settings (the chat agent, dsm5 synthesis, SummaryExtractor,
+the evaluators...) reports its prompt, completion and embedding tokens to
+it. Counts are attributed to the username, feature and stage set with
+attribute() around the work, e.g.
+
+    with metering.attribute(username="alice", feature="chat"):
+        agent.chat(message)
+
+and added up per day, user, feature, stage and model in memory, then
+written to a database table (the SQLite file USAGE_DB, or the shared
+storage database, SQLite or PostgreSQL, so budgets hold across replicas and
+hosts) by a background thread every
+USAGE_FLUSH_INTERVAL seconds, so a call never waits on the database.
+Work done outside any attribute() block is recorded under the
+"system" user. Attribution follows contextvars, so it applies to the
+current thread or asyncio task only: background threads set their own.
+
+Each user gets DAILY_TOKEN_BUDGET tokens a day. Past BUDGET_DEGRADE_RATIO
+of it, answers are built from less retrieved context and conversations are
+no longer summarized into long-term memory; once it is used up the chat
+stops calling the LLM until the next day. Tokens of the embedding backends
+that run in-process (local and hashing, see src/embeddings.py) cost nothing:
+they are recorded under a "local:" model name and do not count against the
+budget.
+"""
+
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from src.global_settings import (
+    USAGE_DB,
+    DAILY_TOKEN_BUDGET,
+    BUDGET_DEGRADE_RATIO,
+    USAGE_FLUSH_INTERVAL,
+    TOKEN_PRICES
+)
+from src.storage import get_storage
+
+SYSTEM_USER = "system"
+
+BUDGET_OK = "ok"
+BUDGET_DEGRADED = "degraded"
+BUDGET_EXHAUSTED = "exhausted"
+
+# Model name prefix of the in-process embedding backends, left out of budgets
+LOCAL_MODEL_PREFIX = "local:"
+_LOCAL_EMBEDDINGS = ("HashingEmbedding", "LocalTransformerEmbedding")
+
+_UPSERT = """
+    INSERT INTO usage (day, username, feature, stage, model, prompt_tokens,
+                       completion_tokens, embedding_tokens, calls)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (day, username, feature, stage, model) DO UPDATE SET
+        prompt_tokens = usage.prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = usage.completion_tokens + excluded.completion_tokens,
+        embedding_tokens = usage.embedding_tokens + excluded.embedding_tokens,
+        calls = usage.calls + excluded.calls
+"""
+
+_attribution = ContextVar("metering_attribution", default={})
+_local = threading.local()
+_init_lock = threading.Lock()
+_meter = None
+
+# Counts not written yet: (day, username, feature, stage, model) ->
+# [prompt_tokens, completion_tokens, embedding_tokens, calls]
+_pending_lock = threading.Lock()
+_pending = {}
+_flusher = {"thread": None}
+
+
+@contextmanager
+def attribute(**fields):
+    """
+    Attribute the tokens used inside the block
+
+    Args:
+        username: User the work is done for
+        feature: Product feature (chat, memory, ingestion, evaluation...)
+        stage: Step within the feature (dsm5, user_memory, judge...)
+
+    Fields not given are inherited from the enclosing block.
+    """
+    token = _attribution.set({**_attribution.get(), **fields})
+    try:
+        yield
+    finally:
+        _attribution.reset(token)
+
+
+def current_attribution():
+    """Username, feature and stage of the running work"""
+    fields = _attribution.get()
+    return (
+        fields.get("username") or SYSTEM_USER,
+        fields.get("feature") or "other",
+        fields.get("stage") or "",
+    )
+
+
+def _connect():
+    """Get this thread's connection to the usage database"""
+    storage = get_storage()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'key', None) == (storage, USAGE_DB):
+        return conn
+
+    with _init_lock:
+        conn = storage.connect(USAGE_DB)
+        conn.create_table("""
+            CREATE TABLE IF NOT EXISTS usage (
+                day TEXT NOT NULL,
+                username TEXT NOT NULL,
+                feature TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                embedding_tokens INTEGER NOT NULL DEFAULT 0,
+                calls INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, username, feature, stage, model)
+            )
+        """, without_rowid=True)
+
+    _local.conn = conn
+    _local.key = (storage, USAGE_DB)
+    return conn
+
+
+def is_local(model):
+    """Whether a model runs in-process, so its tokens are free"""
+    return model.startswith(LOCAL_MODEL_PREFIX)
+
+
+def _add(key, counts):
+    """Add counts to the pending ones (call with _pending_lock held)"""
+    pending = _pending.setdefault(key, [0, 0, 0, 0])
+    for i, count in enumerate(counts):
+        pending[i] += count
+
+
+def record(model, prompt_tokens=0, completion_tokens=0, embedding_tokens=0, stage=None):
+    """
+    Add one call's tokens to today's usage of the current attribution
+
+    Counts are written by the background flusher (see flush()).
+
+    Args:
+        model: Model name
+        prompt_tokens: LLM input tokens
+        completion_tokens: LLM output tokens
+        embedding_tokens: Tokens of embedded text
+        stage: Stage to use when none was attributed
+    """
+    username, feature, attributed_stage = current_attribution()
+    key = (date.today().isoformat(), username, feature, attributed_stage or stage or "", model or "unknown")
+    with _pending_lock:
+        _add(key, (prompt_tokens, completion_tokens, embedding_tokens, 1))
+        if _flusher["thread"] is None:
+            _flusher["thread"] = threading.Thread(target=_run_flusher, name="usage-flusher", daemon=True)
+            _flusher["thread"].start()
+
+
+def flush():
+    """Write the counts kept in memory to the usage database"""
+    with _pending_lock:
+        rows = [key + tuple(counts) for key, counts in _pending.items()]
+        _pending.clear()
+    if not rows:
+        return
+
+    try:
+        conn = _connect()
+        with conn.transaction():
+            conn.executemany(_UPSERT, rows)
+    except Exception:
+        # Keep the counts for the next flush
+        with _pending_lock:
+            for row in rows:
+                _add(row[:5], row[5:])
+        raise
+
+
+def _run_flusher():
+    while True:
+        time.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            print(f"✗ Token usage flush failed: {e!r}")
+
+
+def _make_meter_class():
+    from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+    from llama_index.core.callbacks.schema import CBEventType, EventPayload
+    from llama_index.core.callbacks.token_counting import get_llm_token_counts
+    from llama_index.core.utilities.token_counting import TokenCounter
+
+    class TokenMeter(BaseCallbackHandler):
+        """Callback handler recording LLM and embedding tokens in the usage store"""
+
+        def __init__(self):
+            super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+            self._models = {}  # event id -> model name, between start and end
+            self._counter = None
+
+        def _token_counter(self):
+            # Created on first use so the tokenizer set in Settings is picked up
+            if self._counter is None:
+                self._counter = TokenCounter()
+            return self._counter
+
+        def on_event_start(self, event_type, payload=None, event_id="", parent_id="", **kwargs):
+            if event_type in (CBEventType.LLM, CBEventType.EMBEDDING) and payload:
+                serialized = payload.get(EventPayload.SERIALIZED) or {}
+                model = serialized.get("model") or serialized.get("model_name")
+                if serialized.get("class_name") in _LOCAL_EMBEDDINGS:
+                    name = model if model and model != "unknown" else serialized["class_name"]
+                    model = LOCAL_MODEL_PREFIX + name
+                self._models[event_id] = model
+            return event_id
+
+        def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+            model = self._models.pop(event_id, None)
+            if not payload:
+                return
+            try:
+                if event_type == CBEventType.LLM:
+                    counts = get_llm_token_counts(self._token_counter(), payload, event_id)
+                    record(model, prompt_tokens=counts.prompt_token_count,
+                           completion_tokens=counts.completion_token_count, stage="llm")
+                elif event_type == CBEventType.EMBEDDING and EventPayload.CHUNKS in payload:
+                    counter = self._token_counter()
+                    tokens = sum(counter.get_string_tokens(c) for c in payload[EventPayload.CHUNKS])
+                    record(model, embedding_tokens=tokens, stage="embedding")
+            except Exception as e:
+                # Metering must never break the call it measures
+                print(f"✗ Token metering failed: {e!r}")
+
+        def start_trace(self, trace_id=None):
+            pass
+
+        def end_trace(self, trace_id=None, trace_map=None):
+            pass
+
+    return TokenMeter
+
+
+def install(*components):
+    """
+    Meter every LLM and embedding call made through Settings
+
+    LLMs and embed models pick up Settings.callback_manager when read from
+    Settings; components used directly (an embed model passed to an
+    ingestion pipeline, for example) must be given here.
+
+    Args:
+        components: LlamaIndex LLMs or embed models to meter as well
+    """
+    global _meter
+    from llama_index.core import Settings
+
+    with _init_lock:
+        if _meter is None:
+            _meter = _make_meter_class()()
+    for manager in [Settings.callback_manager] + [c.callback_manager for c in components]:
+        if _meter not in manager.handlers:
+            manager.add_handler(_meter)
+
+
+def tokens_today(username):
+    """Tokens the user has used today that count against the budget"""
+    today = date.today().isoformat()
+    row = _connect().execute(
+        """
+        SELECT COALESCE(SUM(prompt_tokens + completion_tokens + embedding_tokens), 0)
+        FROM usage WHERE day = ? AND username = ? AND model NOT LIKE ?
+        """,
+        (today, username, LOCAL_MODEL_PREFIX + "%")
+    ).fetchone()
+    with _pending_lock:
+        pending = sum(
+            sum(counts[:3]) for key, counts in _pending.items()
+            if key[0] == today and key[1] == username and not is_local(key[4])
+        )
+    return row[0] + pending
+
+
+def budget_status(username):
+    """
+    Where the user stands against today's budget
+
+    Returns:
+        tuple: (status, tokens used today), status being BUDGET_OK,
+            BUDGET_DEGRADED or BUDGET_EXHAUSTED
+    """
+    used = tokens_today(username)
+    if not DAILY_TOKEN_BUDGET:
+        return BUDGET_OK, used
+    if used >= DAILY_TOKEN_BUDGET:
+        return BUDGET_EXHAUSTED, used
+    if used >= DAILY_TOKEN_BUDGET * BUDGET_DEGRADE_RATIO:
+        return BUDGET_DEGRADED, used
+    return BUDGET_OK, used
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, embedding_tokens):
+    """Estimated cost in USD from TOKEN_PRICES (0 for unknown models)"""
+    input_price, output_price = TOKEN_PRICES.get(model, (0.0, 0.0))
+    return ((prompt_tokens + embedding_tokens) * input_price + completion_tokens * output_price) / 1e6
+
+
+def usage_summary(start, end, by=("username",)):
+    """
+    Usage between two days, grouped
+
+    Args:
+        start: First day (date)
+        end: Last day, included (date)
+        by: Columns to group by (day, username, feature, stage, model)
+
+    Returns:
+        list: One dict per group with the group columns, token counts,
+            calls, estimated cost and budget_tokens (the tokens that count
+            against the budget), most tokens first
+    """
+    flush()
+    columns = [c for c in by if c in ("day", "username", "feature", "stage", "model")]
+    group = ", ".join(columns + (["model"] if "model" not in columns else []))
+    rows = _connect().execute(
+        f"""
+        SELECT {group}, SUM(prompt_tokens) AS prompt_tokens,
+               SUM(completion_tokens) AS completion_tokens,
+               SUM(embedding_tokens) AS embedding_tokens, SUM(calls) AS calls
+        FROM usage WHERE day BETWEEN ? AND ?
+        GROUP BY {group}
+        """,
+        (start.isoformat(), end.isoformat())
+    ).fetchall()
+
+    # Costs depend on the model, so they are added up after pricing each row
+    summary = {}
+    for row in rows:
+        key = tuple(row[c] for c in columns)
+        entry = summary.setdefault(key, {
+            **dict(zip(columns, key)),
+            "prompt_tokens": 0, "completion_tokens": 0, "embedding_tokens": 0,
+            "calls": 0, "cost_usd": 0.0, "budget_tokens": 0
+        })
+        for field in ("prompt_tokens", "completion_tokens", "embedding_tokens", "calls"):
+            entry[field] += row[field]
+        entry["cost_usd"] += estimate_cost(
+            row["model"], row["prompt_tokens"], row["completion_tokens"], row["embedding_tokens"]
+        )
+        if not is_local(row["model"]):
+            entry["budget_tokens"] += row["prompt_tokens"] + row["completion_tokens"] + row["embedding_tokens"]
+    for entry in summary.values():
+        entry["total_tokens"] = entry["prompt_tokens"] + entry["completion_tokens"] + entry["embedding_tokens"]
+    return sorted(summary.values(), key=lambda e: e["total_tokens"], reverse=True)
+
+
+atexit.register(flush)
@@ -0,0 +1,454 @@
+"""
+Write-behind persistence for chat history and scores
+
+Chat and score writes are queued and written to storage (src/storage.py)
+by a single background worker, so disk and network latency stay off the
+response path. Repeated chat flushes for the same user are coalesced into
+one write of that user's history, objects are replaced atomically and
+fsynced on a configurable cadence, and the queue is drained on shutdown.
+Scores are appended to a log, one JSON entry per line, so saving one does
+not rewrite the others and replicas saving at the same time do not
+overwrite each other; readers parse the log from any offset on.
+
+Each finished step of a flush is dropped from the batch, so retrying a
+failed batch repeats no write; an operation that still fails after
+PERSIST_MAX_RETRIES attempts is moved to a dead-letter file
+(PERSIST_DEAD_LETTER_FILE) and reported instead of being retried forever.
+
+Readers get read-your-writes consistency: pending chat messages and scores
+are served from memory, and wait_until_flushed(username=...) blocks until
+the user's writes submitted so far are on disk, without waiting for other
+users'.
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+from src.global_settings import (
+    SCORES_FILE,
+    SCORES_LOG,
+    PERSIST_QUEUE_SIZE,
+    PERSIST_FLUSH_INTERVAL,
+    PERSIST_FSYNC_INTERVAL,
+    PERSIST_RETRY_DELAY,
+    PERSIST_MAX_RETRIES,
+    PERSIST_DEAD_LETTER_FILE
+)
+
+_queue = queue.Queue(maxsize=PERSIST_QUEUE_SIZE)
+_lock = threading.Lock()
+_flushed = threading.Condition(_lock)
+
+# Chat messages submitted but not yet written, keyed by username
+_pending_chats = {}
+
+# Scores submitted but not yet counted in statistics: ticket -> entry
+_pending_scores = {}
+
+# Operations not written yet: ticket -> username
+_outstanding = {}
+
+# Failed attempts of operations still being retried, keyed by ticket
+_attempts = {}
+
+_state = {
+    "worker": None,
+    "submitted": 0,
+    "last_fsync": 0.0,
+}
+
+_metrics = {
+    "flushes": 0,
+    "chat_writes": 0,
+    "chat_coalesced": 0,
+    "score_writes": 0,
+    "errors": 0,
+    "last_error": None,
+    "dead_letters": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "total_flush_ms": 0.0,
+}
+
+_STOP = object()
+
+_legacy_lock = threading.Lock()
+_legacy_scores = {"imported": False}
+
+
+def _ensure_worker():
+    """Start the background worker on first use"""
+    with _lock:
+        worker = _state["worker"]
+        if worker is None or not worker.is_alive():
+            worker = threading.Thread(target=_run, name="persistence-worker", daemon=True)
+            _state["worker"] = worker
+            worker.start()
+
+
+def _submit(kind, username, payload):
+    """Queue an operation, blocking when the queue is full"""
+    _ensure_worker()
+    with _lock:
+        _state["submitted"] += 1
+        ticket = _state["submitted"]
+        _outstanding[ticket] = username
+        if kind == "score":
+            _pending_scores[ticket] = payload
+    _queue.put((kind, ticket, username, payload))
+
+
+def submit_chat(username, messages):
+    """
+    Queue a write of a user's full chat history
+
+    Args:
+        username: Username
+        messages: Current list of chat messages for the user
+    """
+    messages = list(messages)
+    with _lock:
+        _pending_chats[username] = messages
+    _submit("chat", username, messages)
+
+
+def submit_score(entry):
+    """
+    Queue an append to the scores log
+
+    Args:
+        entry: Score entry dict (username, Time, Score, Content, Total_guess)
+    """
+    _submit("score", entry["username"], entry)
+
+
+def pending_messages(username):
+    """
+    Chat messages for a user that are queued but not yet on disk
+
+    Returns:
+        list or None: Messages, or None if nothing is pending
+    """
+    with _lock:
+        return _pending_chats.get(username)
+
+
+def pending_scores(username):
+    """
+    Score entries of a user that are queued but not yet counted
+
+    Returns:
+        list: Entries in submission order
+    """
+    with _lock:
+        return [entry for entry in _pending_scores.values() if entry["username"] == username]
+
+
+def wait_until_flushed(timeout=None, username=None):
+    """
+    Block until the writes submitted so far have been flushed
+
+    Args:
+        timeout: Maximum seconds to wait
+        username: Only wait for this user's writes (everyone's if None)
+
+    Returns:
+        bool: True if those writes are on disk (or dead-lettered)
+    """
+    def flushed():
+        return not any(
+            ticket <= target and (username is None or owner == username)
+            for ticket, owner in _outstanding.items()
+        )
+
+    with _lock:
+        target = _state["submitted"]
+        return _flushed.wait_for(flushed, timeout)
+
+
+def _score_lines(entries):
+    return "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries).encode("utf-8")
+
+
+def import_legacy_scores(store=None):
+    """
+    Convert the legacy scores file (one JSON list) into the scores log
+
+    Skipped if the log already exists; the legacy file is kept as
+    <file>.imported afterwards.
+
+    Returns:
+        int: Number of assessments imported
+    """
+    from src.storage import get_storage, VersionConflict
+
+    store = store or get_storage()
+    data = store.get(SCORES_FILE)
+    if data is None:
+        return 0
+    try:
+        entries = json.loads(data)
+    except json.JSONDecodeError:
+        entries = []
+
+    imported = 0
+    try:
+        store.put(SCORES_LOG, _score_lines(entries), if_version=None)
+        imported = len(entries)
+    except VersionConflict:
+        pass
+    store.put(f"{SCORES_FILE}.imported", data)
+    store.delete(SCORES_FILE)
+    return imported
+
+
+def _import_legacy_scores_once():
+    with _legacy_lock:
+        if not _legacy_scores["imported"]:
+            import_legacy_scores()
+            _legacy_scores["imported"] = True
+
+
+def read_scores(offset=0):
+    """
+    Assessments in the scores log from a byte offset on
+
+    Args:
+        offset: Offset returned by a previous call, 0 for every assessment
+
+    Returns:
+        tuple: (score entries, offset after the last complete entry); the
+            offset is smaller than the one given if the log was truncated
+    """
+    from src.storage import get_storage
+
+    _import_legacy_scores_once()
+    _, size, data = get_storage().read_tail(SCORES_LOG, offset)
+    if data is None or size < offset:
+        return [], size
+    end = data.rfind(b"\n") + 1
+    entries = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+    return entries, offset + end
+
+
+def get_metrics():
+    """
+    Queue and flush statistics
+
+    Returns:
+        dict: queue_depth, pending writes, flush counts and latencies (ms)
+    """
+    with _lock:
+        metrics = dict(_metrics)
+        metrics["pending"] = len(_outstanding)
+    metrics["queue_depth"] = _queue.qsize()
+    metrics["avg_flush_ms"] = (
+        metrics["total_flush_ms"] / metrics["flushes"] if metrics["flushes"] else 0.0
+    )
+    return metrics
+
+
+def _sync_due():
+    """Whether this flush should be fsynced, given the cadence"""
+    now = time.monotonic()
+    if now - _state["last_fsync"] >= PERSIST_FSYNC_INTERVAL:
+        _state["last_fsync"] = now
+        return True
+    return False
+
+
+def _done(ops):
+    """Mark operations as written (call with _lock held)"""
+    for op in ops:
+        _outstanding.pop(op[1], None)
+        _attempts.pop(op[1], None)
+        _pending_scores.pop(op[1], None)
+    _flushed.notify_all()
+
+
+def _flush(batch):
+    """
+    Write a batch of queued operations, one step at a time
+
+    Every finished step is removed from the batch (saved scores become
+    "assessment" operations, only left to count in the user's statistics),
+    so when a step fails, what is left in the batch can be retried as is.
+    A user's failing step does not hold up other users' steps.
+
+    Args:
+        batch: List of operations, updated in place
+
+    Returns:
+        Exception or None: The last error of a user's step
+    """
+    from src import user_stats
+    from src.storage import get_storage
+    from src.conversation_engine import chat_key, dump_chat
+
+    store = get_storage()
+    sync = _sync_due()
+
+    error = None
+    chats = {}
+    for op in batch:
+        if op[0] == "chat":
+            chats[op[2]] = op[3]
+    for username, messages in chats.items():
+        try:
+            if messages:
+                store.put(chat_key(username), dump_chat(username, messages), sync=sync)
+            else:
+                store.delete(chat_key(username))
+            user_stats.record_message_count(username, len(messages))
+        except Exception as e:
+            error = e
+            continue
+
+        written = [op for op in batch if op[0] == "chat" and op[2] == username]
+        batch[:] = [op for op in batch if op[0] != "chat" or op[2] != username]
+        with _lock:
+            if _pending_chats.get(username) is messages:
+                del _pending_chats[username]
+            _metrics["chat_writes"] += 1
+            _metrics["chat_coalesced"] += len(written) - 1
+            _done(written)
+
+    scores = [op[3] for op in batch if op[0] == "score"]
+    if scores:
+        _import_legacy_scores_once()
+        store.append(SCORES_LOG, _score_lines(scores), sync=sync)
+        batch[:] = [("assessment",) + op[1:] if op[0] == "score" else op for op in batch]
+        with _lock:
+            _metrics["score_writes"] += len(scores)
+
+    for op in [op for op in batch if op[0] == "assessment"]:
+        entry = op[3]
+        try:
+            user_stats.record_assessment(entry["username"], entry["Score"], entry["Time"])
+        except Exception as e:
+            error = e
+            continue
+        batch.remove(op)
+        with _lock:
+            _done([op])
+    return error
+
+
+def _dead_letter(ops, error):
+    """Give up on operations: record them in the dead-letter file and report them"""
+    records = []
+    for kind, ticket, username, payload in ops:
+        if kind == "chat":
+            payload = [{"role": m.role.value, "content": m.content} for m in payload]
+        records.append({
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "kind": kind,
+            "username": username,
+            "payload": payload,
+            "error": repr(error),
+        })
+    try:
+        directory = os.path.dirname(PERSIST_DEAD_LETTER_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(PERSIST_DEAD_LETTER_FILE, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    except OSError as e:
+        print(f"✗ Could not write {PERSIST_DEAD_LETTER_FILE}: {e!r}")
+
+    with _lock:
+        for kind, ticket, username, payload in ops:
+            if kind == "chat" and _pending_chats.get(username) is payload:
+                del _pending_chats[username]
+        _metrics["dead_letters"] += len(ops)
+        _done(ops)
+    print(f"✗ Gave up on {len(ops)} write(s) after {PERSIST_MAX_RETRIES} attempts, "
+          f"saved to {PERSIST_DEAD_LETTER_FILE}: {error!r}")
+
+
+def _run():
+    """Worker loop: collect a batch of operations, then flush it"""
+    retry = []
+    while True:
+        try:
+            ops = retry + [_queue.get(timeout=PERSIST_RETRY_DELAY if retry else None)]
+        except queue.Empty:
+            ops = retry
+
+        # Give concurrent writers a short window to coalesce into this flush
+        deadline = time.monotonic() + PERSIST_FLUSH_INTERVAL
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                ops.append(_queue.get(timeout=remaining) if remaining > 0
+                           else _queue.get_nowait())
+            except queue.Empty:
+                break
+
+        stop = any(item is _STOP for item in ops)
+        ops = [item for item in ops if item is not _STOP]
+
+        start = time.perf_counter()
+        try:
+            error = _flush(ops)
+        except Exception as e:
+            error = e
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        retry = []
+        with _lock:
+            _metrics["flushes"] += 1
+            _metrics["last_flush_ms"] = elapsed_ms
+            _metrics["max_flush_ms"] = max(_metrics["max_flush_ms"], elapsed_ms)
+            _metrics["total_flush_ms"] += elapsed_ms
+            if error is not None:
+                _metrics["errors"] += 1
+                _metrics["last_error"] = repr(error)
+                for op in ops:
+                    _attempts[op[1]] = _attempts.get(op[1], 0) + 1
+                # Nothing is left to retry with once the worker stops
+                failed = [op for op in ops if stop or _attempts[op[1]] >= PERSIST_MAX_RETRIES]
+                retry = [op for op in ops if op not in failed]
+
+        if error is not None:
+            if failed:
+                _dead_letter(failed, error)
+            if retry:
+                print(f"✗ Persistence flush failed, retrying {len(retry)} write(s): {error!r}")
+        if stop:
+            return
+
+
+def dead_letters(limit=100):
+    """
+    Writes given up on, most recent last
+
+    Args:
+        limit: Maximum number of records returned
+
+    Returns:
+        list: Records with time, kind, username, payload and error
+    """
+    try:
+        with open(PERSIST_DEAD_LETTER_FILE, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+    return [json.loads(line) for line in lines[-limit:] if line.strip()]
+
+
+def shutdown(timeout=10):
+    """Drain the queue and stop the worker"""
+    worker = _state["worker"]
+    if worker is None or not worker.is_alive():
+        return
+    _queue.put(_STOP)
+    worker.join(timeout)
+
+
+atexit.register(shutdown)
@@ -0,0 +1,318 @@
+"""
+Opt-in profiler for Streamlit reruns
+
+Every widget interaction reruns the whole page script. With profiling on,
+each rerun and the parts of it wrapped in section() are timed (wall clock
+and CPU time of the script thread), and the sidebar shows a live breakdown
+of the current rerun next to the averages of the previous ones. Optionally
+every rerun also runs under cProfile and its trace is saved to PROFILE_DIR
+(open with snakeviz or pstats). The collected profiles can be downloaded
+as JSON from the sidebar.
+
+Profiling is on for every session when PROFILER_ENABLED is set, or for an
+admin who opens a page with ?profile=1 (?profile=cprofile to also capture
+cProfile traces), until ?profile=0.
+
+Pages call start_rerun() at the top and end_rerun() at the bottom; a rerun
+cut short by st.stop() ends at its last finished section and is closed by
+the next start_rerun(). Fragments wrap their body in fragment(), so their
+own reruns are profiled too.
+"""
+
+import os
+import re
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import streamlit as st
+from src.global_settings import (
+    PROFILER_ENABLED,
+    PROFILER_CPROFILE,
+    PROFILER_HISTORY,
+    PROFILE_DIR
+)
+
+_RERUN_KEY = "_profiler_rerun"
+_HISTORY_KEY = "_profiler_history"
+_MODE_KEY = "_profiler_mode"
+
+MODE_TIMING = "timing"
+MODE_CPROFILE = "cprofile"
+
+
+def profiling_mode():
+    """
+    Profiling mode of this session
+
+    Returns:
+        str: MODE_TIMING, MODE_CPROFILE or None when profiling is off
+    """
+    param = st.query_params.get("profile")
+    if param is not None:
+        username = st.session_state.get("username")
+        if param in ("0", "off"):
+            st.session_state.pop(_MODE_KEY, None)
+        elif username:
+            from src.authenticate import is_admin
+            if is_admin(username):
+                st.session_state[_MODE_KEY] = MODE_CPROFILE if param == MODE_CPROFILE else MODE_TIMING
+
+    mode = st.session_state.get(_MODE_KEY)
+    if mode is None and PROFILER_ENABLED:
+        mode = MODE_CPROFILE if PROFILER_CPROFILE else MODE_TIMING
+    return mode
+
+
+def start_rerun(page):
+    """
+    Start profiling a rerun of a page, if profiling is on
+
+    Args:
+        page: Page name shown in the breakdown
+    """
+    stale = st.session_state.pop(_RERUN_KEY, None)
+    if stale is not None:
+        _finish(stale)
+
+    mode = profiling_mode()
+    if mode is None:
+        return
+
+    now, cpu = time.perf_counter(), time.thread_time()
+    rerun = {
+        "page": page,
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "start": now,
+        "cpu_start": cpu,
+        "last": now,
+        "cpu_last": cpu,
+        "sections": [],
+        "depth": 0,
+        "panel": None,
+        "profile": None,
+    }
+    if mode == MODE_CPROFILE:
+        import cProfile
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            rerun["profile"] = profile
+        except ValueError:
+            # Another profiler is already active in this process
+            pass
+    st.session_state[_RERUN_KEY] = rerun
+
+
+def end_rerun():
+    """Finish profiling the current rerun and keep it in the session history"""
+    rerun = st.session_state.pop(_RERUN_KEY, None)
+    if rerun is None:
+        return
+    rerun["last"], rerun["cpu_last"] = time.perf_counter(), time.thread_time()
+    record = _finish(rerun)
+    _render_live(rerun, record)
+
+
+@contextmanager
+def section(name):
+    """
+    Time a part of the rerun
+
+    Sections may be nested; they cost nothing when profiling is off.
+
+    Args:
+        name: Section name shown in the breakdown
+    """
+    rerun = st.session_state.get(_RERUN_KEY)
+    if rerun is None:
+        yield
+        return
+
+    depth = rerun["depth"]
+    entry = {"name": name, "depth": depth, "ms": None, "cpu_ms": None}
+    rerun["sections"].append(entry)
+    rerun["depth"] = depth + 1
+    start, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        rerun["last"], rerun["cpu_last"] = time.perf_counter(), time.thread_time()
+        entry["ms"] = (rerun["last"] - start) * 1000
+        entry["cpu_ms"] = (rerun["cpu_last"] - cpu) * 1000
+        rerun["depth"] = depth
+        _render_live(rerun)
+
+
+@contextmanager
+def fragment(page, name):
+    """
+    Time the body of an st.fragment
+
+    Within a full rerun the fragment is a section of it; when the fragment
+    reruns on its own it is profiled as a rerun of its own, named
+    "<page> › <name>". Its breakdown is not shown live, as a fragment cannot
+    write to the sidebar, but it is kept in the history.
+
+    Args:
+        page: Page the fragment belongs to
+        name: Fragment name
+    """
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    # fragment_ids_this_run is only set when fragments rerun on their own
+    ctx = get_script_run_ctx()
+    if ctx is None or not ctx.fragment_ids_this_run:
+        with section(name):
+            yield
+        return
+
+    start_rerun(f"{page} › {name}")
+    try:
+        yield
+    finally:
+        end_rerun()
+
+
+def _top_functions(profile, limit=20):
+    import pstats
+
+    stats = pstats.Stats(profile).sort_stats("cumulative")
+    top = []
+    for func in stats.fcn_list[:limit]:
+        _, calls, tottime, cumtime, _ = stats.stats[func]
+        filename, line, function = func
+        top.append({
+            "function": f"{filename}:{line}({function})",
+            "calls": calls,
+            "tottime_ms": round(tottime * 1000, 3),
+            "cumtime_ms": round(cumtime * 1000, 3),
+        })
+    return top
+
+
+def _finish(rerun):
+    """Turn a rerun into a history record, saving its cProfile trace"""
+    record = {
+        "page": rerun["page"],
+        "started": rerun["started"],
+        "ms": (rerun["last"] - rerun["start"]) * 1000,
+        "cpu_ms": (rerun["cpu_last"] - rerun["cpu_start"]) * 1000,
+        "sections": [dict(s) for s in rerun["sections"] if s["ms"] is not None],
+    }
+
+    profile = rerun["profile"]
+    if profile is not None:
+        profile.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        name = re.sub(r"\W+", "_", rerun["page"], flags=re.ASCII)
+        path = os.path.join(PROFILE_DIR, f"{name}_{stamp}.prof")
+        profile.dump_stats(path)
+        record["trace"] = path
+        record["top_functions"] = _top_functions(profile)
+
+    history = st.session_state.setdefault(_HISTORY_KEY, [])
+    history.append(record)
+    del history[:-PROFILER_HISTORY]
+    return record
+
+
+def _breakdown(rerun, record=None):
+    """Markdown table of a rerun's sections, running or finished"""
+    total = record["ms"] if record else (rerun["last"] - rerun["start"]) * 1000
+    cpu = record["cpu_ms"] if record else (rerun["cpu_last"] - rerun["cpu_start"]) * 1000
+    status = "xong" if record else "đang chạy"
+    lines = [
+        f"**{rerun['page']}** ({status}): {total:.0f} ms, CPU {cpu:.0f} ms",
+        "",
+        "| Phần | ms | CPU ms | % |",
+        "|---|---:|---:|---:|",
+    ]
+    for s in rerun["sections"]:
+        name = "  " * s["depth"] + s["name"]
+        if s["ms"] is None:
+            lines.append(f"| {name} | … | … | |")
+        else:
+            share = s["ms"] / total * 100 if total else 0
+            lines.append(f"| {name} | {s['ms']:.1f} | {s['cpu_ms']:.1f} | {share:.0f} |")
+    if record and record.get("trace"):
+        lines += ["", f"Trace: `{record['trace']}`"]
+    return "\n".join(lines)
+
+
+def _averages(history, page):
+    """Markdown table of the mean and max time of a page's sections"""
+    runs = [r for r in history if r["page"] == page]
+    if not runs:
+        return None
+    times = {}
+    for run in runs:
+        times.setdefault("(tổng)", []).append(run["ms"])
+        for s in run["sections"]:
+            times.setdefault(s["name"], []).append(s["ms"])
+    lines = [
+        f"{len(runs)} lần chạy trước của {page}",
+        "",
+        "| Phần | TB ms | Max ms | Số lần |",
+        "|---|---:|---:|---:|",
+    ]
+    for name, values in times.items():
+        lines.append(f"| {name} | {sum(values) / len(values):.1f} | {max(values):.1f} | {len(values)} |")
+    return "\n".join(lines)
+
+
+def _in_fragment():
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    return ctx is not None and ctx.current_fragment_id is not None
+
+
+def _render_live(rerun, record=None):
+    # Fragments cannot write to the sidebar: the panel catches up after them
+    if rerun["panel"] is not None and not _in_fragment():
+        rerun["panel"].markdown(_breakdown(rerun, record))
+
+
+def export_profiles(history=None):
+    """
+    Collected profiles as JSON
+
+    Returns:
+        str: JSON with every rerun of the session history
+    """
+    if history is None:
+        history = st.session_state.get(_HISTORY_KEY, [])
+    return json.dumps(
+        {"exported": datetime.now().isoformat(timespec="seconds"), "reruns": history},
+        ensure_ascii=False,
+        indent=2
+    )
+
+
+def render_panel():
+    """Render the profiling panel in the current container (the sidebar)"""
+    rerun = st.session_state.get(_RERUN_KEY)
+    if rerun is None:
+        return
+
+    st.markdown("---")
+    st.markdown("### ⏱️ Hiệu năng")
+    rerun["panel"] = st.empty()
+    _render_live(rerun)
+
+    history = st.session_state.get(_HISTORY_KEY, [])
+    averages = _averages(history, rerun["page"])
+    if averages:
+        with st.expander("📊 Trung bình các lần chạy trước"):
+            st.markdown(averages)
+    if history:
+        st.download_button(
+            label=f"📥 Xuất hồ sơ hiệu năng ({len(history)} lần chạy)",
+            data=export_profiles(history),
+            file_name=f"profiles_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+            mime="application/json",
+            use_container_width=True
+        )
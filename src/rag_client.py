@@ -0,0 +1,162 @@
+"""
+Client of the RAG backend service (src/rag_service.py)
+
+Used by the Streamlit pages when RAG_SERVICE_URL is set: chats, history and
+scores then go to the service instead of running in the Streamlit process.
+Requests share one keep-alive connection pool per process, and each one
+carries a token signed for the user it acts for (see src/credentials.py).
+"""
+
+import json
+import threading
+from types import SimpleNamespace
+from src.global_settings import RAG_SERVICE_URL, RAG_SERVICE_TOKEN, RAG_SERVICE_TIMEOUT
+
+_lock = threading.Lock()
+_client = None
+
+
+class RagServiceError(RuntimeError):
+    """The service failed to answer"""
+
+
+class BudgetExhausted(RagServiceError):
+    """The user has used up today's token budget"""
+
+
+def enabled():
+    """Whether the pages should use the RAG service"""
+    return bool(RAG_SERVICE_URL)
+
+
+def _get_client():
+    global _client
+    with _lock:
+        if _client is None:
+            import httpx
+
+            _client = httpx.Client(base_url=RAG_SERVICE_URL, timeout=RAG_SERVICE_TIMEOUT)
+        return _client
+
+
+def _headers(username):
+    """Authorization header acting for a user"""
+    if not RAG_SERVICE_TOKEN:
+        return {}
+    from src.credentials import user_token
+
+    return {"Authorization": f"Bearer {user_token(RAG_SERVICE_TOKEN, username)}"}
+
+
+def _request(method, path, username, **kwargs):
+    response = _get_client().request(method, path, headers=_headers(username), **kwargs)
+    if response.status_code >= 400:
+        raise RagServiceError(f"{method} {path}: {response.status_code} {response.text}")
+    return response.json()
+
+
+class ChatStream:
+    """
+    Iterator over the pieces of a streamed answer
+
+    After iteration, response holds the whole answer and degraded tells
+    whether it was built with reduced context (soft token budget).
+    """
+
+    def __init__(self, username, message, user_info=""):
+        self._username = username
+        self._body = {"username": username, "message": message, "user_info": user_info}
+        self.response = ""
+        self.degraded = False
+
+    def __iter__(self):
+        with _get_client().stream("POST", "/chat", json=self._body, headers=_headers(self._username)) as response:
+            if response.status_code == 429:
+                raise BudgetExhausted(response.read().decode("utf-8"))
+            if response.status_code >= 400:
+                raise RagServiceError(f"POST /chat: {response.status_code} {response.read().decode('utf-8')}")
+
+            event = None
+            for line in response.iter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "delta":
+                        yield data["text"]
+                    elif event == "done":
+                        self.response = data["response"]
+                        self.degraded = data.get("degraded", False)
+                    elif event == "error":
+                        raise RagServiceError(data["error"])
+
+
+def stream_chat(username, message, user_info=""):
+    """
+    Send a chat message and stream the answer
+
+    Args:
+        username: Username
+        message: User message
+        user_info: Additional user information for a new agent
+
+    Returns:
+        ChatStream: Iterable of answer pieces (BudgetExhausted is raised
+            while iterating once the daily budget is used up)
+    """
+    return ChatStream(username, message, user_info)
+
+
+def get_history(username):
+    """
+    Chat history of a user
+
+    Returns:
+        list: Messages with role and content attributes
+    """
+    messages = _request("GET", f"/history/{username}", username)["messages"]
+    return [SimpleNamespace(**m) for m in messages]
+
+
+def clear_history(username):
+    """Clear chat history for a user"""
+    _request("DELETE", f"/history/{username}", username)
+
+
+def get_scores(username):
+    """
+    Saved assessments of a user
+
+    Returns:
+        tuple: (score version, list of score entries)
+    """
+    data = _request("GET", f"/scores/{username}", username)
+    return tuple(data["version"]), data["scores"]
+
+
+def get_score_version(username):
+    """Version of the user's scores, changing whenever one is saved"""
+    return tuple(_request("GET", f"/scores/{username}/version", username)["version"])
+
+
+def save_score(score, content, total_guess, username):
+    """Save a diagnostic score through the service"""
+    return _request(
+        "POST",
+        f"/scores/{username}",
+        username,
+        json={"score": score, "content": content, "total_guess": total_guess}
+    )["message"]
+
+
+def query_dsm5(query, category="", username=None):
+    """
+    Ask the DSM5 query engine directly
+
+    Returns:
+        dict: response text and source nodes (text, score, metadata)
+    """
+    from src.metering import SYSTEM_USER
+
+    username = username or SYSTEM_USER
+    return _request("POST", "/dsm5", username, json={"username": username, "query": query, "category": category})
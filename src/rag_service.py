@@ -0,0 +1,374 @@
+"""
+Standalone RAG backend service
+
+Runs the chat agents, the shared DSM5 index and the chat/score stores in a
+single asyncio HTTP service, so Streamlit replicas stay thin clients (see
+src/rag_client.py, enabled by RAG_SERVICE_URL) and UI replicas and RAG
+workers scale independently. The index is loaded once per worker and
+shared by every user's agent; agents are kept per user (up to
+RAG_SERVICE_MAX_AGENTS, least recently used first out) and a user's chats
+are answered one at a time. Several services can share storage
+(src/storage.py): an agent whose chats another one changed is recreated
+from the stored history.
+
+LLM and embedding calls go through one keep-alive httpx connection pool
+(LLM_MAX_CONNECTIONS), to OpenAI or to any OpenAI-compatible endpoint
+(LLM_API_BASE / --llm-base-url).
+
+Endpoints (JSON in and out unless noted):
+    GET    /health
+    POST   /chat                        {"username", "message", "user_info"}
+                                        -> text/event-stream
+    GET    /history/{username}
+    DELETE /history/{username}
+    GET    /scores/{username}
+    GET    /scores/{username}/version
+    POST   /scores/{username}           {"score", "content", "total_guess"}
+    POST   /dsm5                        {"username", "query", "category"}
+
+/chat streams server-sent events: "delta" ({"text"}) for each piece of the
+answer, then "done" ({"response", "degraded"}) or "error" ({"error"}).
+A user past the daily token budget gets 429 instead.
+
+When RAG_SERVICE_TOKEN is set, every request must send a bearer token
+signed for one user (see src/credentials.py). The request then acts for
+that user only: a username in its path or body must match, or it gets 403.
+Without a secret there are no checks, so the service then refuses to bind
+anything but a loopback address.
+
+Usage:
+    python -m src.rag_service
+    python -m src.rag_service --port 8700 --llm-base-url http://127.0.0.1:8000/v1
+"""
+
+import sys
+import json
+import asyncio
+import argparse
+import ipaddress
+from collections import OrderedDict
+from aiohttp import web
+from src.global_settings import (
+    SECRETS_FILE,
+    DEFAULT_MODEL,
+    DEFAULT_TEMPERATURE,
+    RAG_SERVICE_HOST,
+    RAG_SERVICE_PORT,
+    RAG_SERVICE_TOKEN,
+    RAG_SERVICE_MAX_AGENTS,
+    LLM_API_BASE,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_KEEPALIVE_EXPIRY,
+    LLM_TIMEOUT,
+    CHAT_DIR
+)
+from src import metering
+from src.credentials import get_api_key, verify_user_token
+from src.storage import get_storage
+from src.conversation_engine import (
+    chat_key,
+    initialize_agent,
+    save_chat_store,
+    save_score,
+    get_chat_history,
+    clear_chat_history,
+    dsm5_engine,
+    load_retrieval
+)
+
+
+def create_http_clients():
+    """
+    Keep-alive connection pools for the LLM and embedding clients
+
+    Returns:
+        tuple: (httpx.Client, httpx.AsyncClient) sharing the same limits
+    """
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+    )
+    timeout = httpx.Timeout(LLM_TIMEOUT)
+    return httpx.Client(limits=limits, timeout=timeout), httpx.AsyncClient(limits=limits, timeout=timeout)
+
+
+def initialize_settings(api_key, api_base=None, http_client=None, async_http_client=None):
+    """
+    Initialize LLM and embedding settings on the given connection pools
+
+    Args:
+        api_key: OpenAI API key
+        api_base: OpenAI-compatible endpoint (OpenAI if None)
+        http_client: httpx.Client used by synchronous calls
+        async_http_client: httpx.AsyncClient used by the service's requests
+    """
+    from llama_index.core import Settings
+    from llama_index.llms.openai import OpenAI
+    from src.embeddings import get_embed_model
+
+    metering.install()
+    clients = {"api_key": api_key, "http_client": http_client, "async_http_client": async_http_client}
+    if api_base:
+        clients["api_base"] = api_base
+    Settings.llm = OpenAI(model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE, **clients)
+    Settings.embed_model = get_embed_model(**clients)
+
+
+async def _send_event(response, event, data):
+    payload = json.dumps(data, ensure_ascii=False)
+    await response.write(f"event: {event}\ndata: {payload}\n\n".encode("utf-8"))
+
+
+def _message_dict(message):
+    return {"role": message.role.value, "content": message.content}
+
+
+def is_loopback(host):
+    """Whether a bind address only accepts connections from this machine"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class RagService:
+    """Per-user agents over the shared index, served over HTTP"""
+
+    def __init__(self, max_agents=RAG_SERVICE_MAX_AGENTS, token=RAG_SERVICE_TOKEN):
+        self.max_agents = max_agents
+        self.token = token
+        # username -> (agent, chat_store), least recently used first
+        self._agents = OrderedDict()
+        self._locks = {}
+
+    def _on_chat_change(self, key):
+        """Another service changed chats: the agents holding them are stale"""
+        for username in [u for u in self._agents if key in (chat_key(u), CHAT_DIR)]:
+            lock = self._locks.get(username)
+            # An agent answering right now writes the history again anyway
+            if lock is None or not lock.locked():
+                self._agents.pop(username, None)
+
+    def _lock(self, username):
+        lock = self._locks.get(username)
+        if lock is None:
+            lock = self._locks[username] = asyncio.Lock()
+        return lock
+
+    async def _agent(self, username, user_info=""):
+        """The user's agent, created on first use (call with the user's lock held)"""
+        entry = self._agents.get(username)
+        if entry is not None:
+            self._agents.move_to_end(username)
+            return entry
+
+        entry = await asyncio.to_thread(initialize_agent, username, user_info)
+        self._agents[username] = entry
+        while len(self._agents) > self.max_agents:
+            evicted, _ = self._agents.popitem(last=False)
+            lock = self._locks.get(evicted)
+            if lock is not None and not lock.locked():
+                del self._locks[evicted]
+        return entry
+
+    @web.middleware
+    async def _authenticate(self, request, handler):
+        if self.token:
+            scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+            username = verify_user_token(self.token, token) if scheme == "Bearer" else None
+            if username is None:
+                raise web.HTTPUnauthorized(text="Invalid or expired user token")
+            request["username"] = username
+        return await handler(request)
+
+    def _user(self, request, username=None):
+        """
+        User a request acts for
+
+        Args:
+            request: The request
+            username: Username given in its path or body, if any
+
+        Returns:
+            str: The authenticated user when tokens are checked, else username
+        """
+        authenticated = request.get("username")
+        if authenticated is None:
+            return username
+        if username and username != authenticated:
+            raise web.HTTPForbidden(text=f"Token is not valid for {username}")
+        return authenticated
+
+    async def health(self, request):
+        return web.json_response({"status": "ok", "agents": len(self._agents)})
+
+    async def chat(self, request):
+        body = await request.json()
+        username, message = self._user(request, body.get("username")), body.get("message")
+        if not username or not message:
+            raise web.HTTPBadRequest(text="username and message are required")
+
+        status, used = await asyncio.to_thread(metering.budget_status, username)
+        if status == metering.BUDGET_EXHAUSTED:
+            return web.json_response({"error": "budget_exhausted", "used": used}, status=429)
+
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache"
+        })
+        await response.prepare(request)
+
+        async with self._lock(username):
+            try:
+                agent, chat_store = await self._agent(username, body.get("user_info", ""))
+                with metering.attribute(username=username, feature="chat"):
+                    stream = await agent.astream_chat(message)
+                    async for delta in stream.async_response_gen():
+                        await _send_event(response, "delta", {"text": delta})
+                save_chat_store(chat_store, username)
+                await _send_event(response, "done", {
+                    "response": stream.response,
+                    "degraded": status == metering.BUDGET_DEGRADED
+                })
+            except (ConnectionResetError, asyncio.CancelledError):
+                # The client went away
+                raise
+            except Exception as e:
+                await _send_event(response, "error", {"error": str(e)})
+
+        await response.write_eof()
+        return response
+
+    async def history(self, request):
+        username = self._user(request, request.match_info["username"])
+        messages = await asyncio.to_thread(get_chat_history, username)
+        return web.json_response({"messages": [_message_dict(m) for m in messages]})
+
+    async def clear_history(self, request):
+        username = self._user(request, request.match_info["username"])
+        async with self._lock(username):
+            # The agent's memory holds the old messages
+            self._agents.pop(username, None)
+            clear_chat_history(username)
+        return web.json_response({"cleared": username})
+
+    async def scores(self, request):
+        from src.health_analytics import load_user_scores
+        from src.user_stats import get_score_version
+
+        username = self._user(request, request.match_info["username"])
+        version = await asyncio.to_thread(get_score_version, username)
+        scores = await asyncio.to_thread(load_user_scores, username)
+        return web.json_response({"version": version, "scores": scores})
+
+    async def score_version(self, request):
+        from src.user_stats import get_score_version
+
+        username = self._user(request, request.match_info["username"])
+        version = await asyncio.to_thread(get_score_version, username)
+        return web.json_response({"version": version})
+
+    async def add_score(self, request):
+        username = self._user(request, request.match_info["username"])
+        body = await request.json()
+        try:
+            message = save_score(body["score"], body["content"], body.get("total_guess", ""), username)
+        except KeyError as e:
+            raise web.HTTPBadRequest(text=f"Missing field: {e.args[0]}")
+        return web.json_response({"message": message}, status=201)
+
+    async def dsm5(self, request):
+        body = await request.json()
+        username = self._user(request, body.get("username")) or metering.SYSTEM_USER
+        query = body.get("query")
+        if not query:
+            raise web.HTTPBadRequest(text="query is required")
+
+        engine = await asyncio.to_thread(dsm5_engine, username, query, body.get("category", ""))
+        with metering.attribute(username=username, feature="dsm5"):
+            result = await engine.aquery(query)
+        return web.json_response({
+            "response": str(result),
+            "sources": [
+                {"text": n.node.get_content(), "score": n.score, "metadata": n.node.metadata}
+                for n in result.source_nodes
+            ]
+        })
+
+    def create_app(self, http_clients=None):
+        """
+        aiohttp application serving the endpoints
+
+        Args:
+            http_clients: (httpx.Client, httpx.AsyncClient) closed on shutdown
+
+        Returns:
+            web.Application: The application
+        """
+        app = web.Application(middlewares=[self._authenticate])
+        app.add_routes([
+            web.get("/health", self.health),
+            web.post("/chat", self.chat),
+            web.get("/history/{username}", self.history),
+            web.delete("/history/{username}", self.clear_history),
+            web.get("/scores/{username}", self.scores),
+            web.get("/scores/{username}/version", self.score_version),
+            web.post("/scores/{username}", self.add_score),
+            web.post("/dsm5", self.dsm5),
+        ])
+
+        async def warm_up(app):
+            # Load the shared index before the first request needs it
+            await asyncio.to_thread(load_retrieval)
+            loop = asyncio.get_running_loop()
+            get_storage().subscribe(CHAT_DIR, lambda key: loop.call_soon_threadsafe(self._on_chat_change, key))
+
+        async def close_clients(app):
+            if http_clients:
+                sync_client, async_client = http_clients
+                sync_client.close()
+                await async_client.aclose()
+
+        app.on_startup.append(warm_up)
+        app.on_cleanup.append(close_clients)
+        return app
+
+
+def main():
+    """Run the RAG service"""
+    parser = argparse.ArgumentParser(description="Mental Health Care RAG service")
+    parser.add_argument("--host", default=RAG_SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=RAG_SERVICE_PORT)
+    parser.add_argument("--llm-base-url", default=LLM_API_BASE or None,
+                        help="OpenAI-compatible endpoint (OpenAI if omitted)")
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print("Mental Health Care System - RAG service")
+    print("=" * 50)
+
+    if not RAG_SERVICE_TOKEN and not is_loopback(args.host):
+        print(f"Error: set RAG_SERVICE_TOKEN to serve on {args.host} (only loopback addresses run without one)")
+        sys.exit(1)
+
+    api_key = get_api_key()
+    if not api_key:
+        print(f"Error: set OPENAI_API_KEY or add it to {SECRETS_FILE}")
+        sys.exit(1)
+
+    http_clients = create_http_clients()
+    initialize_settings(api_key, args.llm_base_url, *http_clients)
+    print("✓ Settings initialized")
+
+    app = RagService().create_app(http_clients)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Chapter and section structure of the DSM-5 document
+
+Ingestion splits .docx sources at their headings (see src/chunking.py) and
+tags every node with its chapter (Heading 1), section (Heading 2) and
+disorder category. After the index is built, a metadata index
+mapping each category and chapter to its node ids is saved next to it.
+
+At query time the retriever can be restricted to the nodes of one or more
+categories, chosen by the agent or by classify(), a keyword classifier that
+runs locally in microseconds. Restricting the search scores fewer vectors
+and keeps unrelated chapters out of the synthesized context.
+
+Rebuild the metadata index of an existing index:
+    python -m src.sections index
+    python -m src.sections classify "Tôi mất ngủ nhiều tuần nay"
+"""
+
+import os
+import re
+import sys
+import json
+import unicodedata
+from src.global_settings import INDEX_STORAGE
+
+METADATA_INDEX_FILE = "metadata_index.json"
+
+# Metadata index bucket of the nodes whose headings match no category
+UNCATEGORIZED = "uncategorized"
+
+# Disorder category -> (label, keywords); keywords are matched on lowercased,
+# NFC-normalized text at word boundaries. English keywords are stems that
+# also match longer words ("depress" matches "depression"); Vietnamese
+# keywords match whole words only ("nôn" does not match "nông")
+CATEGORIES = {
+    "mood": ("Rối loạn trầm cảm và lưỡng cực", [
+        "trầm cảm", "lưỡng cực", "khí sắc", "hưng cảm", "buồn bã", "tiền kinh nguyệt",
+        "depress", "bipolar", "mood", "mania", "dysphoric",
+    ]),
+    "anxiety": ("Rối loạn lo âu", [
+        "lo âu", "lo lắng", "hoảng sợ", "ám ảnh sợ", "sợ xã hội", "sợ khoảng trống",
+        "anxiety", "panic", "phobia", "agoraphobia",
+    ]),
+    "ocd": ("Rối loạn ám ảnh cưỡng chế", [
+        "ám ảnh cưỡng chế", "cưỡng chế", "cưỡng bức", "nhổ tóc", "tích trữ",
+        "obsessive", "compulsive", "hoarding",
+    ]),
+    "trauma": ("Rối loạn liên quan sang chấn và stress", [
+        "sang chấn", "chấn thương tâm lý", "stress", "căng thẳng", "thích ứng",
+        "trauma", "ptsd", "adjustment",
+    ]),
+    "sleep": ("Rối loạn giấc ngủ", [
+        "giấc ngủ", "mất ngủ", "ngủ", "ác mộng", "ngưng thở khi ngủ",
+        "sleep", "insomnia", "nightmare", "narcolepsy",
+    ]),
+    "psychotic": ("Tâm thần phân liệt và rối loạn loạn thần", [
+        "tâm thần phân liệt", "loạn thần", "hoang tưởng", "ảo giác",
+        "schizophrenia", "psychotic", "delusion", "hallucination",
+    ]),
+    "neurodevelopmental": ("Rối loạn phát triển thần kinh", [
+        "phát triển thần kinh", "tự kỷ", "tăng động", "giảm chú ý", "khuyết tật trí tuệ",
+        "autism", "adhd", "attention-deficit", "intellectual disability",
+    ]),
+    "eating": ("Rối loạn ăn uống", [
+        "ăn uống", "chán ăn", "ăn vô độ", "cuồng ăn", "nôn",
+        "eating", "anorexia", "bulimia", "binge",
+    ]),
+    "substance": ("Rối loạn liên quan chất và gây nghiện", [
+        "rượu", "nghiện", "ma túy", "chất kích thích", "cờ bạc", "thuốc lá",
+        "substance", "alcohol", "addict", "gambling",
+    ]),
+    "personality": ("Rối loạn nhân cách", [
+        "nhân cách", "personality", "borderline", "antisocial",
+    ]),
+    "neurocognitive": ("Rối loạn thần kinh nhận thức", [
+        "sa sút trí tuệ", "mê sảng", "suy giảm nhận thức", "alzheimer",
+        "neurocognitive", "dementia", "delirium",
+    ]),
+}
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_HEADING_RE = re.compile(r"heading\s*(\d)")
+
+
+def _normalize(text):
+    return unicodedata.normalize("NFC", text).lower()
+
+
+def _keyword_pattern(keyword):
+    keyword = _normalize(keyword)
+    end = r"\w*" if keyword.isascii() else ""
+    return len(keyword), re.compile(rf"(?<!\w){re.escape(keyword)}{end}(?!\w)")
+
+
+_KEYWORDS = {}
+
+
+def _keywords():
+    # Compiled on first use, so importing this module stays cheap
+    if not _KEYWORDS:
+        _KEYWORDS.update({
+            category: [_keyword_pattern(keyword) for keyword in keywords]
+            for category, (_, keywords) in CATEGORIES.items()
+        })
+    return _KEYWORDS
+
+
+def classify(text, max_categories=2):
+    """
+    Guess the disorder categories a text is about
+
+    Args:
+        text: Query or heading text
+        max_categories: Maximum number of categories returned
+
+    Returns:
+        list: Category keys, best match first (empty if nothing matched)
+    """
+    text = _normalize(text)
+    scores = {}
+    for category, keywords in _keywords().items():
+        # Longer keywords are more specific, so they weigh more
+        score = sum(length for length, pattern in keywords if pattern.search(text))
+        if score:
+            scores[category] = score
+    return sorted(scores, key=scores.get, reverse=True)[:max_categories]
+
+
+def _heading_styles(archive):
+    """Map paragraph style ids to heading levels using styles.xml"""
+    import xml.etree.ElementTree as ET
+
+    levels = {}
+    try:
+        root = ET.fromstring(archive.read("word/styles.xml"))
+    except KeyError:
+        return levels
+    for style in root.iter(f"{_W}style"):
+        name = style.find(f"{_W}name")
+        for value in (style.get(f"{_W}styleId", ""), name.get(f"{_W}val", "") if name is not None else ""):
+            match = _HEADING_RE.match(value.lower())
+            if match:
+                levels[style.get(f"{_W}styleId")] = int(match.group(1))
+                break
+    return levels
+
+
+def _paragraph_text(paragraph):
+    parts = []
+    for element in paragraph.iter():
+        if element.tag == f"{_W}t":
+            parts.append(element.text or "")
+        elif element.tag == f"{_W}tab":
+            parts.append("\t")
+        elif element.tag in (f"{_W}br", f"{_W}cr"):
+            parts.append("\n")
+    return "".join(parts)
+
+
+def iter_paragraphs(path):
+    """
+    Stream the paragraphs of a .docx file
+
+    document.xml is parsed incrementally and every paragraph is released
+    once yielded, so memory stays flat however long the document is.
+
+    Args:
+        path: Path to the .docx file
+
+    Yields:
+        tuple: (heading level or None, paragraph text)
+    """
+    import zipfile
+    import xml.etree.ElementTree as ET
+
+    with zipfile.ZipFile(path) as archive:
+        levels = _heading_styles(archive)
+        with archive.open("word/document.xml") as f:
+            body = None
+            depth = 0
+            for event, element in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    depth += 1
+                    if element.tag == f"{_W}body":
+                        body = element
+                    continue
+
+                depth -= 1
+                if element.tag == f"{_W}p":
+                    style = element.find(f"{_W}pPr/{_W}pStyle")
+                    level = levels.get(style.get(f"{_W}val")) if style is not None else None
+                    yield level, _paragraph_text(element)
+                    element.clear()
+                if depth == 2 and body is not None:
+                    # A paragraph or table of the body is done, drop it
+                    body.clear()
+
+
+def read_sections(path):
+    """
+    Split a .docx file at its Heading 1 / Heading 2 paragraphs
+
+    Args:
+        path: Path to the .docx file
+
+    Returns:
+        list: Dicts with chapter, section and text, in document order
+    """
+    sections = []
+    chapter, section, lines = "", "", []
+
+    def flush():
+        text = "\n".join(line for line in lines if line.strip())
+        if text:
+            sections.append({"chapter": chapter, "section": section, "text": text})
+
+    for level, text in iter_paragraphs(path):
+        if level in (1, 2) and text.strip():
+            flush()
+            lines = [text]
+            if level == 1:
+                chapter, section = text.strip(), ""
+            else:
+                section = text.strip()
+        else:
+            lines.append(text)
+    flush()
+    return sections
+
+
+def section_metadata(path, chapter, section):
+    """
+    Metadata of the nodes of one section
+
+    Returns:
+        dict: file_name, chapter, section and category
+    """
+    categories = classify(f"{chapter} {section}", max_categories=1)
+    return {
+        "file_name": os.path.basename(path),
+        "chapter": chapter,
+        "section": section,
+        "category": categories[0] if categories else "",
+    }
+
+
+def build_metadata_index(index, persist_dir=INDEX_STORAGE):
+    """
+    Save category and chapter -> node ids for an index
+
+    Nodes without a category are saved under UNCATEGORIZED.
+
+    Returns:
+        dict: The metadata index
+    """
+    metadata_index = {"categories": {UNCATEGORIZED: []}, "chapters": {}}
+    for node_id, node in index.docstore.docs.items():
+        category = node.metadata.get("category") or UNCATEGORIZED
+        chapter = node.metadata.get("chapter")
+        metadata_index["categories"].setdefault(category, []).append(node_id)
+        if chapter:
+            metadata_index["chapters"].setdefault(chapter, []).append(node_id)
+
+    os.makedirs(persist_dir, exist_ok=True)
+    with open(os.path.join(persist_dir, METADATA_INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(metadata_index, f, ensure_ascii=False)
+    return metadata_index
+
+
+def load_metadata_index(persist_dir=INDEX_STORAGE):
+    """
+    Load the metadata index saved next to an index
+
+    Returns:
+        dict: {"categories": {...}, "chapters": {...}}, empty if none was built
+    """
+    try:
+        with open(os.path.join(persist_dir, METADATA_INDEX_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"categories": {}, "chapters": {}}
+
+
+def node_ids_for(metadata_index, categories):
+    """
+    Node ids in the given categories, plus the uncategorized nodes
+
+    Returns:
+        list or None: Node ids, or None when no category is indexed (search
+        everything rather than nothing)
+    """
+    indexed = metadata_index["categories"]
+    if UNCATEGORIZED not in indexed:
+        # Built before uncategorized nodes were indexed, so they cannot be added
+        return None
+    ids = []
+    for category in categories:
+        if category != UNCATEGORIZED:
+            ids.extend(indexed.get(category, []))
+    return ids + indexed[UNCATEGORIZED] if ids else None
+
+
+def restricted_retriever(index, node_ids=None, **kwargs):
+    """
+    Vector retriever that only scores the given nodes
+
+    Args:
+        index: VectorStoreIndex
+        node_ids: Node ids to search (all nodes if None)
+        **kwargs: Passed to VectorIndexRetriever (similarity_top_k, ...)
+
+    Returns:
+        VectorIndexRetriever: The retriever
+    """
+    from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+
+    if node_ids is None:
+        return index.as_retriever(**kwargs)
+    # as_retriever() always passes every node id, so build the retriever directly
+    return VectorIndexRetriever(
+        index,
+        node_ids=node_ids,
+        callback_manager=index._callback_manager,
+        object_map=index._object_map,
+        **kwargs
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["index"]:
+        from src.index_builder import load_index
+
+        metadata_index = build_metadata_index(load_index())
+        for category, ids in sorted(metadata_index["categories"].items()):
+            print(f"{category:<20}{len(ids):>6} nodes")
+        print(f"✓ Metadata index saved to {os.path.join(INDEX_STORAGE, METADATA_INDEX_FILE)}")
+    elif sys.argv[1:2] == ["classify"] and len(sys.argv) > 2:
+        print(classify(" ".join(sys.argv[2:])) or "no category")
+    else:
+        print("Usage: python -m src.sections index | classify <text>")
+        sys.exit(1)
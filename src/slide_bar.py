@@ -2,7 +2,9 @@
 Sidebar configuration for Streamlit app
 """
 
+import os
 import streamlit as st
+from src import profiler
 
 
 def render_sidebar():
@@ -43,5 +45,90 @@ def render_sidebar():
                 for key in list(st.session_state.keys()):
                     del st.session_state[key]
                 st.rerun()
+
+            # Live rerun breakdown, when profiling is on
+            profiler.render_panel()
         else:
             st.info("Vui lòng đăng nhập để sử dụng hệ thống")
+
+
+def discard_export(state_key):
+    """Delete a prepared export file and forget it"""
+    export = st.session_state.pop(state_key, None)
+    if export and os.path.exists(export[0]):
+        os.remove(export[0])
+
+
+def _publish_export(path):
+    """
+    Move an export under EXPORT_LINK_DIR, in a directory of its own
+
+    The directory name is random, so the link cannot be guessed.
+
+    Returns:
+        str: New path of the file
+    """
+    import shutil
+    import secrets
+    from src.global_settings import EXPORT_LINK_DIR
+
+    directory = os.path.join(EXPORT_LINK_DIR, secrets.token_urlsafe(16))
+    os.makedirs(directory)
+    return shutil.move(path, os.path.join(directory, os.path.basename(path)))
+
+
+def render_export_download(state_key):
+    """
+    Render the download of an export prepared in session state
+
+    Exports up to EXPORT_INLINE_MAX_BYTES get a download button and are
+    removed once downloaded. Larger ones are not read into the session:
+    they are moved under EXPORT_LINK_DIR and linked, and Streamlit's static
+    file server streams them from disk. Files never downloaded are swept
+    by src.exporter after EXPORT_MAX_AGE.
+
+    Args:
+        state_key: Session state key holding (path, format, rows)
+    """
+    from src.exporter import EXPORT_FORMATS
+    from src.global_settings import EXPORT_INLINE_MAX_BYTES, EXPORT_LINK_DIR, EXPORT_LINK_MAX_BYTES
+
+    export = st.session_state.get(state_key)
+    if not export:
+        return
+
+    path, fmt, rows = export
+    if not os.path.exists(path):
+        st.session_state.pop(state_key)
+        return
+
+    label = f"📥 Tải xuống {fmt.upper()} ({rows:,} dòng)"
+    size = os.path.getsize(path)
+    if size > EXPORT_LINK_MAX_BYTES:
+        st.warning(
+            f"Tệp xuất quá lớn để tải qua trình duyệt ({size / 1024 / 1024:,.0f} MB). "
+            "Hãy dùng `python -m src.exporter` trên máy chủ."
+        )
+        return
+    if size > EXPORT_INLINE_MAX_BYTES:
+        if not path.startswith(EXPORT_LINK_DIR):
+            path = _publish_export(path)
+            st.session_state[state_key] = (path, fmt, rows)
+        url = "app/" + os.path.relpath(path).replace(os.sep, "/")
+        st.markdown(
+            f'<a href="{url}" download="{os.path.basename(path)}">{label}</a> '
+            f"({size / 1024 / 1024:,.1f} MB)",
+            unsafe_allow_html=True
+        )
+        return
+
+    with open(path, "rb") as f:
+        downloaded = st.download_button(
+            label=label,
+            data=f,
+            file_name=os.path.basename(path),
+            mime=EXPORT_FORMATS[fmt][0],
+            use_container_width=True
+        )
+    if downloaded:
+        discard_export(state_key)
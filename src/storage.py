@@ -0,0 +1,1285 @@
+"""
+Shared storage for users, chats, scores, caches and index snapshots
+
+Everything the app persists is addressed by the relative paths in
+global_settings and goes through one Storage, so several app replicas
+behind a load balancer see the same data. A Storage holds:
+
+- objects: documents read and written whole (a user's chat history and
+  statistics, the scores, long-term memories), each with a version. A
+  write can be made conditional on the version that was read, so replicas
+  updating the same object never lose each other's changes (update_json).
+- snapshots: files and directories built offline (the index, corpus
+  shards, the ingestion cache), published with push() after a build and
+  mirrored with pull() before they are loaded.
+- databases: tables of records that need indexed queries (users, token
+  usage), reached through connect() on SQLite or PostgreSQL alike.
+
+STORAGE_URL picks the backend:
+
+    ""                  LocalStorage: the local files themselves (one process)
+    "sqlite:///<path>"  SQLStorage: every object in one SQLite database on
+                        this host's local disk, shared by the app processes
+                        (replicas) running on the host
+    "postgresql+psycopg://<user>:<password>@<host>/<database>"
+                        PostgresStorage: the same in a PostgreSQL database,
+                        shared by replicas on any number of hosts (needs
+                        SQLAlchemy and psycopg)
+
+Both database backends are wrapped in CachedStorage. SQLStorage is
+single-host: it relies on SQLite's WAL mode, whose shared memory index does
+not work over a network filesystem (NFS, SMB), so the database must not sit
+on a volume mounted by several hosts; use PostgresStorage across hosts.
+
+Replicas on shared storage keep a read cache of objects
+(STORAGE_CACHE_BYTES) and follow the database's change log every
+STORAGE_POLL_INTERVAL seconds: cached objects changed by another replica
+are dropped, and callbacks registered with subscribe() are told, so
+in-memory state (agents, loaded indexes, memories) can be refreshed.
+
+Copy a single node's local data into the configured shared storage:
+    python -m src.storage migrate
+Publish or fetch snapshots by hand:
+    python -m src.storage push data/index_storage
+    python -m src.storage pull data/corpus
+"""
+
+import os
+import re
+import sys
+import copy
+import json
+import time
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from src.global_settings import (
+    STORAGE_URL,
+    STORAGE_CACHE_BYTES,
+    STORAGE_POLL_INTERVAL,
+    STORAGE_CHANGE_LOG_SIZE,
+    STORAGE_POOL_SIZE
+)
+
+# Version condition of an unconditional write
+ANY = object()
+
+# PostgreSQL advisory lock held while creating tables
+_SCHEMA_LOCK = 720_451_001
+
+_lock = threading.Lock()
+_init_lock = threading.Lock()
+_storage = None
+
+
+class VersionConflict(RuntimeError):
+    """An object changed since the version a conditional write expected"""
+
+
+def user_key(directory, username, suffix):
+    """Key of a per-user object, safe for any username"""
+    safe = re.sub(r"[^\w.-]", "_", username)
+    return f"{directory}/{safe}{suffix}"
+
+
+def _log_exception(message, *args):
+    """Log the exception being handled, with its traceback"""
+    # Imported here: logging alone costs more than the rest of this module
+    import logging
+
+    logging.getLogger(__name__).exception(message, *args)
+
+
+def _prefix(directory):
+    return directory.rstrip("/") + "/"
+
+
+def _local_files(path):
+    """Files of a local file or directory, oldest first, as keys"""
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            if not name.endswith(".tmp"):
+                full = os.path.join(root, name)
+                files.append((os.stat(full).st_mtime_ns, full.replace(os.sep, "/")))
+    # Builders write their manifest last, so it is also published last
+    return [key for _, key in sorted(files)]
+
+
+def _write_file(path, data, sync=False):
+    """Replace a local file atomically"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class _Row:
+    """A PostgreSQL row readable by position or column name, like sqlite3.Row"""
+
+    __slots__ = ("_values", "_columns")
+
+    def __init__(self, values, columns):
+        self._values = values
+        self._columns = columns
+
+    def __getitem__(self, key):
+        return self._values[self._columns[key] if isinstance(key, str) else key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._columns)
+
+
+def _row_factory(cursor):
+    columns = {column.name: i for i, column in enumerate(cursor.description or ())}
+    return lambda values: _Row(values, columns)
+
+
+class Database:
+    """
+    Connection to the tables of records of one database, SQLite or PostgreSQL
+
+    Statements are written once for both: ? placeholders, ON CONFLICT
+    clauses, rows read by column name or position. Connections are in
+    autocommit mode; group statements with transaction().
+    """
+
+    def __init__(self, conn, dialect):
+        self.conn = conn
+        self.dialect = dialect
+        if dialect == "sqlite":
+            import sqlite3
+            self.integrity_error = sqlite3.IntegrityError
+        else:
+            import psycopg
+            self.integrity_error = psycopg.IntegrityError
+
+    def _sql(self, sql):
+        return sql if self.dialect == "sqlite" else sql.replace("?", "%s")
+
+    def execute(self, sql, params=()):
+        """Run a statement, returning its cursor"""
+        return self.conn.execute(self._sql(sql), params)
+
+    def executemany(self, sql, rows):
+        """Run a statement for every row of parameters, returning its cursor"""
+        cursor = self.conn.cursor()
+        cursor.executemany(self._sql(sql), rows)
+        return cursor
+
+    def create_table(self, sql, without_rowid=False):
+        """
+        Run a CREATE TABLE IF NOT EXISTS statement
+
+        Args:
+            sql: The statement
+            without_rowid: Store the table in primary key order on SQLite
+        """
+        if self.dialect == "sqlite":
+            self.conn.execute(sql + (" WITHOUT ROWID" if without_rowid else ""))
+            return
+        with self.conn.transaction():
+            # Replicas starting together would race to create the table
+            self.conn.execute("SELECT pg_advisory_xact_lock(%s)", (_SCHEMA_LOCK,))
+            self.conn.execute(sql)
+
+    @contextmanager
+    def transaction(self):
+        """Run the statements of the with block in one transaction"""
+        if self.dialect != "sqlite":
+            with self.conn.transaction():
+                yield
+            return
+        # Take the write lock up front rather than fail on upgrading it
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def close(self):
+        self.conn.close()
+
+
+def _sqlite_database(path):
+    import sqlite3
+
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return Database(conn, "sqlite")
+
+
+class Storage(ABC):
+    """Objects, snapshots and databases shared by every replica"""
+
+    def __init__(self):
+        self._subscribers = []
+
+    @abstractmethod
+    def read(self, key):
+        """
+        Read an object
+
+        Returns:
+            tuple: (version, bytes), or (None, None) if it does not exist
+        """
+
+    @abstractmethod
+    def put(self, key, data, if_version=ANY, sync=False):
+        """
+        Write an object
+
+        Args:
+            key: Object key
+            data: Content (bytes)
+            if_version: Only write if the object is still at this version
+                (None: only if it does not exist)
+            sync: Make the write durable before returning
+
+        Returns:
+            The new version
+
+        Raises:
+            VersionConflict: If if_version no longer matches
+        """
+
+    @abstractmethod
+    def append(self, key, data, sync=False):
+        """
+        Append to an object, creating it if missing
+
+        Appends from several writers never conflict, so logs are appended
+        to instead of rewritten; read them back with read_tail().
+
+        Returns:
+            The new version
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        """Delete an object, if it exists"""
+
+    @abstractmethod
+    def list(self, directory):
+        """
+        Objects under a directory, at any depth
+
+        Returns:
+            dict: Versions keyed by object key
+        """
+
+    @abstractmethod
+    def push(self, path):
+        """Publish a local file or directory, replacing its previous snapshot"""
+
+    @abstractmethod
+    def pull(self, path):
+        """Mirror the published snapshot of a file or directory locally"""
+
+    @abstractmethod
+    def connect(self, name):
+        """
+        New connection to the database holding the tables of a local database file
+
+        Args:
+            name: Path of the database file used by a single node (USERS_DB...)
+
+        Returns:
+            Database: The connection, for the calling thread only
+        """
+
+    def get(self, key):
+        """Content of an object, or None"""
+        return self.read(key)[1]
+
+    def version(self, key):
+        """Version of an object, or None if it does not exist"""
+        return self.read(key)[0]
+
+    def read_tail(self, key, offset):
+        """
+        Read an object from a byte offset on
+
+        Returns:
+            tuple: (version, size in bytes, bytes past offset), or
+                (None, 0, None) if it does not exist
+        """
+        version, data = self.read(key)
+        if data is None:
+            return None, 0, None
+        return version, len(data), data[offset:]
+
+    def get_json(self, key, default=None):
+        """Object parsed as JSON, or default if missing or unreadable"""
+        data = self.get(key)
+        if data is None:
+            return default
+        try:
+            return json.loads(data)
+        except json.JSONDecodeError:
+            return default
+
+    def put_json(self, key, value, if_version=ANY, sync=False):
+        """Write an object as JSON"""
+        data = json.dumps(value, indent=4, ensure_ascii=False).encode("utf-8")
+        return self.put(key, data, if_version, sync)
+
+    def update(self, key, update, sync=False):
+        """
+        Read-modify-write an object, retried if another writer got there first
+
+        Args:
+            key: Object key
+            update: Function from the current content (None if missing)
+                to the new content
+
+        Returns:
+            bytes: The content written
+        """
+        while True:
+            version, data = self.read(key)
+            data = update(data)
+            try:
+                self.put(key, data, if_version=version, sync=sync)
+                return data
+            except VersionConflict:
+                continue
+
+    def update_json(self, key, update, default=None, sync=False):
+        """
+        Read-modify-write a JSON object, retried if another writer got there first
+
+        Args:
+            key: Object key
+            update: Function from the current value to the new one
+            default: Current value of a missing or unreadable object
+
+        Returns:
+            The value written
+        """
+        written = {}
+
+        def apply(data):
+            try:
+                value = json.loads(data) if data is not None else copy.deepcopy(default)
+            except json.JSONDecodeError:
+                value = copy.deepcopy(default)
+            written["value"] = update(value)
+            return json.dumps(written["value"], indent=4, ensure_ascii=False).encode("utf-8")
+
+        self.update(key, apply, sync)
+        return written["value"]
+
+    def subscribe(self, directory, callback):
+        """
+        Be told when another replica changes objects under a directory
+
+        Args:
+            directory: Directory (or object key) to watch
+            callback: Called with the changed key, from a background thread.
+                After a gap in the change log it is called with the watched
+                directory itself: anything under it may have changed.
+        """
+        self._subscribers.append((directory, callback))
+
+    def _notify(self, key):
+        for directory, callback in list(self._subscribers):
+            if key == directory or key.startswith(_prefix(directory)) or directory.startswith(_prefix(key)):
+                try:
+                    callback(key)
+                except Exception:
+                    _log_exception("Storage change callback failed for %s", key)
+
+
+class LocalStorage(Storage):
+    """
+    The local files themselves: keys are paths relative to the working directory
+
+    Snapshots already are where they are loaded from, so push() and pull()
+    have nothing to do, and no other replica sends change notifications.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._write_lock = threading.Lock()
+        self._directories = set()
+
+    @staticmethod
+    def _version(stat):
+        # A replaced file is a new inode, so this changes on every write
+        return f"{stat.st_ino}-{stat.st_mtime_ns}-{stat.st_size}"
+
+    def read(self, key):
+        try:
+            with open(key, "rb") as f:
+                return self._version(os.fstat(f.fileno())), f.read()
+        except FileNotFoundError:
+            return None, None
+
+    def put(self, key, data, if_version=ANY, sync=False):
+        with self._write_lock:
+            if if_version is not ANY:
+                try:
+                    current = self._version(os.stat(key))
+                except FileNotFoundError:
+                    current = None
+                if current != if_version:
+                    raise VersionConflict(key)
+            _write_file(key, data, sync)
+            return self._version(os.stat(key))
+
+    def append(self, key, data, sync=False):
+        with self._write_lock:
+            directory = os.path.dirname(key)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(key, "ab") as f:
+                f.write(data)
+                f.flush()
+                if sync:
+                    os.fsync(f.fileno())
+                return self._version(os.fstat(f.fileno()))
+
+    def read_tail(self, key, offset):
+        try:
+            with open(key, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size <= offset:
+                    return self._version(stat), stat.st_size, b""
+                f.seek(offset)
+                # Stop at the size seen, not in the middle of a later append
+                return self._version(stat), stat.st_size, f.read(stat.st_size - offset)
+        except FileNotFoundError:
+            return None, 0, None
+
+    def delete(self, key):
+        with self._write_lock:
+            try:
+                os.remove(key)
+            except FileNotFoundError:
+                pass
+
+    def list(self, directory):
+        if not os.path.isdir(directory):
+            return {}
+        return {key: self._version(os.stat(key)) for key in _local_files(directory)}
+
+    def push(self, path):
+        pass
+
+    def pull(self, path):
+        pass
+
+    def connect(self, name):
+        directory = os.path.dirname(name)
+        if directory not in self._directories:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+        return _sqlite_database(name)
+
+
+class _DatabaseStorage(Storage):
+    """
+    Storage in a database: objects versioned by the numbers of a change log
+
+    Snapshots are published as one object per file and mirrored back to the
+    local files, skipping files whose version was mirrored already.
+    """
+
+    def __init__(self, change_log_size=STORAGE_CHANGE_LOG_SIZE):
+        super().__init__()
+        self.change_log_size = change_log_size
+        # key -> version mirrored to the local file by pull() or push()
+        self._mirrored = {}
+        self._mirror_lock = threading.Lock()
+
+    @abstractmethod
+    def latest_change(self):
+        """Number of the last change made"""
+
+    @abstractmethod
+    def changes(self, cursor, limit=10000):
+        """
+        Changes made after a point of the change log
+
+        Args:
+            cursor: Number of the last change already seen
+
+        Returns:
+            tuple: (new cursor, list of (change number, key), whether the
+                log still covered everything since cursor)
+        """
+
+    def _snapshot(self, path):
+        """Published versions of a file or of the files of a directory"""
+        version = self.version(path)
+        return {path: version} if version is not None else self.list(path)
+
+    def push(self, path):
+        published = self._snapshot(path)
+        local = _local_files(path) if os.path.exists(path) else []
+        with self._mirror_lock:
+            for key in local:
+                with open(key, "rb") as f:
+                    self._mirrored[key] = self.put(key, f.read())
+            for key in published.keys() - set(local):
+                self.delete(key)
+                self._mirrored.pop(key, None)
+
+    def pull(self, path):
+        published = self._snapshot(path)
+        if not published:
+            # Nothing published yet: keep whatever is there locally
+            return
+        with self._mirror_lock:
+            for key, version in published.items():
+                if self._mirrored.get(key) == version and os.path.exists(key):
+                    continue
+                version, data = self.read(key)
+                if data is not None:
+                    _write_file(key, data)
+                    self._mirrored[key] = version
+            # Files of an older snapshot that are no longer published
+            for key in [k for k in self._mirrored if k not in published]:
+                if key == path or key.startswith(_prefix(path)):
+                    try:
+                        os.remove(key)
+                    except FileNotFoundError:
+                        pass
+                    del self._mirrored[key]
+
+
+class SQLStorage(_DatabaseStorage):
+    """
+    Objects in one SQLite database shared by the replicas of one host
+
+    The database must be on a local disk (see the module docstring).
+    Every write gets the next number of a change log, which is also the new
+    version of the object; replicas read the log to see what changed since
+    they last looked. The log keeps the last STORAGE_CHANGE_LOG_SIZE changes.
+
+    An object is its row in objects followed by the records appended to it
+    since it was last written whole, one row each in appends keyed by their
+    byte offset, so an append or a tail read touches only the new records.
+    """
+
+    def __init__(self, path, change_log_size=STORAGE_CHANGE_LOG_SIZE):
+        super().__init__(change_log_size)
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        """Get this thread's connection to the shared database"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+
+        import sqlite3
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with _init_lock:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS objects (
+                    key TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS appends (
+                    key TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (key, start)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL,
+                    deleted INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+        self._local.conn = conn
+        return conn
+
+    def read(self, key):
+        conn = self._connect()
+        # One read transaction, so the records match the object's version
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT version, data FROM objects WHERE key = ?", (key,)).fetchone()
+            appended = conn.execute(
+                "SELECT data FROM appends WHERE key = ? ORDER BY start", (key,)
+            ).fetchall() if row else []
+        finally:
+            conn.execute("COMMIT")
+        if row is None:
+            return None, None
+        return row[0], b"".join([bytes(row[1])] + [bytes(r[0]) for r in appended])
+
+    def _log_change(self, conn, key, deleted):
+        """Record a change in the log (inside a transaction), returning its number"""
+        seq = conn.execute(
+            "INSERT INTO changes (key, deleted) VALUES (?, ?)", (key, int(deleted))
+        ).lastrowid
+        if seq % 1000 == 0:
+            conn.execute("DELETE FROM changes WHERE seq <= ?", (seq - self.change_log_size,))
+        return seq
+
+    def _write(self, key, data, if_version):
+        """Write (data) or delete (None) an object and log the change"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT version FROM objects WHERE key = ?", (key,)).fetchone()
+            current = row[0] if row else None
+            if if_version is not ANY and current != if_version:
+                raise VersionConflict(key)
+            if data is None and current is None:
+                conn.execute("ROLLBACK")
+                return None
+
+            seq = self._log_change(conn, key, data is None)
+            conn.execute("DELETE FROM appends WHERE key = ?", (key,))
+            if data is None:
+                conn.execute("DELETE FROM objects WHERE key = ?", (key,))
+            else:
+                conn.execute(
+                    """
+                    INSERT INTO objects (key, version, data) VALUES (?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET version = excluded.version, data = excluded.data
+                    """,
+                    (key, seq, data)
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return seq
+
+    def put(self, key, data, if_version=ANY, sync=False):
+        return self._write(key, bytes(data), if_version)
+
+    def append(self, key, data, sync=False):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = self._log_change(conn, key, False)
+            row = conn.execute("SELECT length(data) FROM objects WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO objects (key, version, data) VALUES (?, ?, ?)", (key, seq, bytes(data))
+                )
+            else:
+                last = conn.execute(
+                    "SELECT start + length(data) FROM appends WHERE key = ? ORDER BY start DESC LIMIT 1",
+                    (key,)
+                ).fetchone()
+                conn.execute(
+                    "INSERT INTO appends (key, start, data) VALUES (?, ?, ?)",
+                    (key, last[0] if last else row[0], bytes(data))
+                )
+                conn.execute("UPDATE objects SET version = ? WHERE key = ?", (seq, key))
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return seq
+
+    def read_tail(self, key, offset):
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute(
+                "SELECT version, length(data), substr(data, ? + 1) FROM objects WHERE key = ?",
+                (offset, key)
+            ).fetchone()
+            if row is None:
+                return None, 0, None
+            # Records from the one holding the offset on
+            first = conn.execute(
+                "SELECT MAX(start) FROM appends WHERE key = ? AND start <= ?", (key, offset)
+            ).fetchone()[0]
+            appended = conn.execute(
+                "SELECT start, data FROM appends WHERE key = ? AND start >= ? ORDER BY start",
+                (key, first or 0)
+            ).fetchall()
+        finally:
+            conn.execute("COMMIT")
+
+        version, size, tail = row[0], row[1], [bytes(row[2] or b"")]
+        for start, data in appended:
+            tail.append(bytes(data)[max(0, offset - start):])
+            size = start + len(data)
+        return version, size, b"".join(tail)
+
+    def delete(self, key):
+        """Delete an object, returning the number of the change (None if there was none)"""
+        return self._write(key, None, ANY)
+
+    def list(self, directory):
+        prefix = _prefix(directory)
+        rows = self._connect().execute(
+            "SELECT key, version FROM objects WHERE key >= ? AND key < ? ORDER BY key",
+            (prefix, prefix + "\U0010ffff")
+        )
+        return dict(rows.fetchall())
+
+    def latest_change(self):
+        row = self._connect().execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'changes'"
+        ).fetchone()
+        return row[0] if row else 0
+
+    def changes(self, cursor, limit=10000):
+        rows = self._connect().execute(
+            "SELECT seq, key FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+            (cursor, limit)
+        ).fetchall()
+        complete = not rows or rows[0][0] == cursor + 1
+        if rows:
+            cursor = rows[-1][0]
+        return cursor, rows, complete
+
+    def connect(self, name):
+        # Every database's tables live in the shared database
+        self._connect()
+        return _sqlite_database(self.path)
+
+
+class PostgresStorage(_DatabaseStorage):
+    """
+    Objects in a PostgreSQL database shared by replicas on any number of hosts
+
+    Same tables and change log as SQLStorage. A write first takes the row
+    lock of change_head to get its change number, so writes are committed
+    one at a time in the order of their numbers: a replica reading the log
+    never passes a change that commits later with a smaller number.
+    """
+
+    def __init__(self, url, change_log_size=STORAGE_CHANGE_LOG_SIZE, pool_size=STORAGE_POOL_SIZE):
+        super().__init__(change_log_size)
+        from sqlalchemy import create_engine
+
+        self.url = url
+        self._engine = create_engine(url, pool_size=pool_size, max_overflow=pool_size, pool_pre_ping=True)
+        self._create_tables()
+
+    def _run(self, sql, params=None, conn=None):
+        """Run a statement, in a transaction of its own unless conn is given"""
+        from sqlalchemy import text
+
+        if conn is not None:
+            return conn.execute(text(sql), params or {})
+        with self._engine.begin() as conn:
+            return conn.execute(text(sql), params or {}).all()
+
+    def _create_tables(self):
+        with self._engine.begin() as conn:
+            # Replicas starting together would race to create the tables
+            self._run("SELECT pg_advisory_xact_lock(:lock)", {"lock": _SCHEMA_LOCK}, conn)
+            # Byte order collation, so that a directory's keys are one range
+            self._run("""
+                CREATE TABLE IF NOT EXISTS objects (
+                    key TEXT COLLATE "C" PRIMARY KEY,
+                    version BIGINT NOT NULL,
+                    data BYTEA NOT NULL
+                )
+            """, conn=conn)
+            self._run("""
+                CREATE TABLE IF NOT EXISTS appends (
+                    key TEXT COLLATE "C" NOT NULL,
+                    start BIGINT NOT NULL,
+                    data BYTEA NOT NULL,
+                    PRIMARY KEY (key, start)
+                )
+            """, conn=conn)
+            self._run("""
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq BIGINT PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    deleted BOOLEAN NOT NULL DEFAULT FALSE
+                )
+            """, conn=conn)
+            self._run("CREATE TABLE IF NOT EXISTS change_head (id INTEGER PRIMARY KEY, seq BIGINT NOT NULL)", conn=conn)
+            self._run("INSERT INTO change_head (id, seq) VALUES (1, 0) ON CONFLICT DO NOTHING", conn=conn)
+
+    def read(self, key):
+        # One statement sees one snapshot, so the records match the version
+        rows = self._run("""
+            SELECT version, data, (
+                SELECT string_agg(a.data, '' ORDER BY a.start) FROM appends a WHERE a.key = o.key
+            ) FROM objects o WHERE o.key = :key
+        """, {"key": key})
+        if not rows:
+            return None, None
+        version, data, appended = rows[0]
+        return version, bytes(data) + bytes(appended or b"")
+
+    def _log_change(self, conn, key, deleted):
+        """Record a change in the log (inside a transaction), returning its number"""
+        seq = self._run(
+            "UPDATE change_head SET seq = seq + 1 WHERE id = 1 RETURNING seq", conn=conn
+        ).scalar_one()
+        self._run(
+            "INSERT INTO changes (seq, key, deleted) VALUES (:seq, :key, :deleted)",
+            {"seq": seq, "key": key, "deleted": deleted}, conn
+        )
+        if seq % 1000 == 0:
+            self._run("DELETE FROM changes WHERE seq <= :seq", {"seq": seq - self.change_log_size}, conn)
+        return seq
+
+    def _write(self, key, data, if_version):
+        """Write (data) or delete (None) an object and log the change"""
+        with self._engine.connect() as conn:
+            with conn.begin() as transaction:
+                seq = self._log_change(conn, key, data is None)
+                current = self._run(
+                    "SELECT version FROM objects WHERE key = :key", {"key": key}, conn
+                ).scalar()
+                if if_version is not ANY and current != if_version:
+                    raise VersionConflict(key)
+                if data is None and current is None:
+                    transaction.rollback()
+                    return None
+
+                self._run("DELETE FROM appends WHERE key = :key", {"key": key}, conn)
+                if data is None:
+                    self._run("DELETE FROM objects WHERE key = :key", {"key": key}, conn)
+                else:
+                    self._run(
+                        """
+                        INSERT INTO objects (key, version, data) VALUES (:key, :seq, :data)
+                        ON CONFLICT (key) DO UPDATE SET version = excluded.version, data = excluded.data
+                        """,
+                        {"key": key, "seq": seq, "data": data}, conn
+                    )
+        return seq
+
+    def put(self, key, data, if_version=ANY, sync=False):
+        return self._write(key, bytes(data), if_version)
+
+    def append(self, key, data, sync=False):
+        with self._engine.begin() as conn:
+            seq = self._log_change(conn, key, False)
+            size = self._run("SELECT length(data) FROM objects WHERE key = :key", {"key": key}, conn).scalar()
+            if size is None:
+                self._run(
+                    "INSERT INTO objects (key, version, data) VALUES (:key, :seq, :data)",
+                    {"key": key, "seq": seq, "data": bytes(data)}, conn
+                )
+            else:
+                last = self._run(
+                    "SELECT start + length(data) FROM appends WHERE key = :key ORDER BY start DESC LIMIT 1",
+                    {"key": key}, conn
+                ).scalar()
+                self._run(
+                    "INSERT INTO appends (key, start, data) VALUES (:key, :start, :data)",
+                    {"key": key, "start": size if last is None else last, "data": bytes(data)}, conn
+                )
+                self._run("UPDATE objects SET version = :seq WHERE key = :key", {"seq": seq, "key": key}, conn)
+        return seq
+
+    def read_tail(self, key, offset):
+        # Records from the one holding the offset on, cut at the offset
+        rows = self._run("""
+            SELECT o.version,
+                   COALESCE((SELECT a.start + length(a.data) FROM appends a
+                             WHERE a.key = o.key ORDER BY a.start DESC LIMIT 1), length(o.data)),
+                   substring(o.data FROM CAST(:offset AS INTEGER) + 1),
+                   (SELECT string_agg(substring(a.data FROM CAST(GREATEST(:offset - a.start, 0) AS INTEGER) + 1), ''
+                                      ORDER BY a.start)
+                    FROM appends a
+                    WHERE a.key = o.key AND a.start >= COALESCE(
+                        (SELECT MAX(b.start) FROM appends b WHERE b.key = o.key AND b.start <= :offset), 0))
+            FROM objects o WHERE o.key = :key
+        """, {"key": key, "offset": offset})
+        if not rows:
+            return None, 0, None
+        version, size, tail, appended = rows[0]
+        return version, size, bytes(tail) + bytes(appended or b"")
+
+    def delete(self, key):
+        """Delete an object, returning the number of the change (None if there was none)"""
+        return self._write(key, None, ANY)
+
+    def list(self, directory):
+        prefix = _prefix(directory)
+        rows = self._run(
+            "SELECT key, version FROM objects WHERE key >= :low AND key < :high ORDER BY key",
+            {"low": prefix, "high": prefix + "\U0010ffff"}
+        )
+        return dict(rows)
+
+    def latest_change(self):
+        return self._run("SELECT seq FROM change_head WHERE id = 1")[0][0]
+
+    def changes(self, cursor, limit=10000):
+        rows = [tuple(row) for row in self._run(
+            "SELECT seq, key FROM changes WHERE seq > :cursor ORDER BY seq LIMIT :limit",
+            {"cursor": cursor, "limit": limit}
+        )]
+        complete = not rows or rows[0][0] == cursor + 1
+        if rows:
+            cursor = rows[-1][0]
+        return cursor, rows, complete
+
+    def connect(self, name):
+        # Every database's tables live in the shared database
+        import psycopg
+
+        url = self._engine.url.set(drivername="postgresql")
+        conn = psycopg.connect(url.render_as_string(hide_password=False), autocommit=True, row_factory=_row_factory)
+        return Database(conn, "postgresql")
+
+
+class CachedStorage(Storage):
+    """
+    Per-replica read cache of a shared storage, following its change log
+
+    Objects up to a sixteenth of max_bytes are cached, least recently used
+    first out. Objects this replica writes are cached as written; objects
+    other replicas change are dropped when the change log is next read (by
+    a read after poll_interval, or by a background thread once someone
+    subscribed), and subscribers are then told from that thread.
+    """
+
+    def __init__(self, backend, max_bytes=STORAGE_CACHE_BYTES, poll_interval=STORAGE_POLL_INTERVAL):
+        super().__init__()
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self._cache = OrderedDict()  # key -> (version, data)
+        self._bytes = 0
+        self._cache_lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._cursor = backend.latest_change()
+        self._next_poll = time.monotonic() + poll_interval
+        # Bumped whenever the change log drops cached objects
+        self._generation = 0
+        # Changes made by this replica that the log has not shown yet
+        self._own = set()
+        # Keys changed by other replicas, not yet announced to subscribers
+        self._pending = []
+        self._poller = None
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def _remember(self, key, version, data, generation=None):
+        size = len(data) if data is not None else 0
+        with self._cache_lock:
+            if generation is not None and generation != self._generation:
+                # The object may have changed while it was being read
+                return
+            self._forget(key)
+            if size > self.max_bytes // 16:
+                return
+            self._cache[key] = (version, data)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self._bytes -= len(evicted) if evicted is not None else 0
+
+    def _forget(self, key):
+        """Drop a cached object (call with _cache_lock held)"""
+        entry = self._cache.pop(key, None)
+        if entry is not None and entry[1] is not None:
+            self._bytes -= len(entry[1])
+
+    def read(self, key):
+        self.poll()
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+            self.stats["misses"] += 1
+            generation = self._generation
+        version, data = self.backend.read(key)
+        self._remember(key, version, data, generation)
+        return version, data
+
+    def put(self, key, data, if_version=ANY, sync=False):
+        data = bytes(data)
+        try:
+            version = self.backend.put(key, data, if_version, sync)
+        except VersionConflict:
+            with self._cache_lock:
+                self._forget(key)
+            raise
+        with self._cache_lock:
+            self._own.add(version)
+        self._remember(key, version, data)
+        return version
+
+    def append(self, key, data, sync=False):
+        version = self.backend.append(key, data, sync)
+        with self._cache_lock:
+            self._own.add(version)
+            self._forget(key)
+        return version
+
+    def read_tail(self, key, offset):
+        self.poll()
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                version, data = entry
+                if data is None:
+                    return None, 0, None
+                return version, len(data), data[offset:]
+        return self.backend.read_tail(key, offset)
+
+    def delete(self, key):
+        seq = self.backend.delete(key)
+        if seq is not None:
+            with self._cache_lock:
+                self._own.add(seq)
+        self._remember(key, None, None)
+
+    def list(self, directory):
+        return self.backend.list(directory)
+
+    def push(self, path):
+        self.backend.push(path)
+
+    def pull(self, path):
+        self.backend.pull(path)
+
+    def connect(self, name):
+        return self.backend.connect(name)
+
+    def poll(self, force=False):
+        """Read the change log if it is due, dropping objects other replicas changed"""
+        now = time.monotonic()
+        if not force and now < self._next_poll:
+            return
+        if not self._poll_lock.acquire(blocking=force):
+            # Another thread is already reading the log
+            return
+        try:
+            self._next_poll = now + self.poll_interval
+            cursor, changes, complete = self.backend.changes(self._cursor)
+            changed = []
+            with self._cache_lock:
+                if not complete:
+                    self._cache.clear()
+                    self._bytes = 0
+                for seq, key in changes:
+                    if seq in self._own:
+                        # Written by this replica and cached as written
+                        self._own.discard(seq)
+                        continue
+                    self._forget(key)
+                    changed.append(key)
+                self._own = {seq for seq in self._own if seq > cursor}
+                if changed or not complete:
+                    self._generation += 1
+                    self.stats["invalidations"] += len(changed)
+                if self._subscribers:
+                    if not complete:
+                        self._pending.extend(directory for directory, _ in self._subscribers)
+                    self._pending.extend(changed)
+            self._cursor = cursor
+        finally:
+            self._poll_lock.release()
+
+    def _announce(self):
+        """Tell subscribers about the changes found by poll()"""
+        with self._cache_lock:
+            pending, self._pending = self._pending, []
+        for key in dict.fromkeys(pending):
+            self._notify(key)
+
+    def _run_poller(self):
+        # Subscribers are only called from here, never from inside a read
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll(force=True)
+                self._announce()
+            except Exception:
+                _log_exception("Reading the storage change log failed")
+
+    def subscribe(self, directory, callback):
+        super().subscribe(directory, callback)
+        with self._poll_lock:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._run_poller, name="storage-poller", daemon=True)
+                self._poller.start()
+
+
+def open_storage(url):
+    """
+    Storage for a STORAGE_URL
+
+    Args:
+        url: "" for local files, "sqlite:///<path>" for a database shared
+            by the processes of this host, "postgresql+psycopg://..." for a
+            database server shared by several hosts
+
+    Returns:
+        Storage: The storage
+    """
+    if not url:
+        return LocalStorage()
+    if url.startswith("sqlite:///"):
+        return CachedStorage(SQLStorage(url[len("sqlite:///"):]))
+    if url.startswith("postgresql"):
+        return CachedStorage(PostgresStorage(url))
+    raise ValueError(f"Unsupported STORAGE_URL: {url}")
+
+
+def get_storage():
+    """The storage configured by STORAGE_URL, opened on first use"""
+    global _storage
+    with _lock:
+        if _storage is None:
+            _storage = open_storage(STORAGE_URL)
+        return _storage
+
+
+def set_storage(storage):
+    """Use another storage in this process (tools and benchmarks)"""
+    global _storage
+    with _lock:
+        _storage = storage
+
+
+def _copy_table(target, database, table, batch_size=10000):
+    """
+    Copy the rows of a local SQLite table into the target's database
+
+    Columns are matched by name, so tables whose columns were added in a
+    different order are copied correctly; columns the local table lacks
+    get their defaults. Rows whose key is already there are kept.
+    """
+    import sqlite3
+
+    source = sqlite3.connect(database)
+    conn = target.connect(database)
+    try:
+        local = source.execute(f'SELECT * FROM "{table}" LIMIT 0')
+        local = [column[0] for column in local.description]
+        shared = conn.execute(f'SELECT * FROM "{table}" LIMIT 0')
+        columns = [column[0] for column in shared.description if column[0] in local]
+        names = ", ".join(f'"{column}"' for column in columns)
+        insert = (f'INSERT INTO "{table}" ({names}) VALUES ({", ".join("?" * len(columns))}) '
+                  f'ON CONFLICT DO NOTHING')
+
+        rows = source.execute(f'SELECT {names} FROM "{table}"')
+        copied = 0
+        while True:
+            batch = rows.fetchmany(batch_size)
+            if not batch:
+                return copied
+            with conn.transaction():
+                copied += conn.executemany(insert, batch).rowcount
+    finally:
+        source.close()
+        conn.close()
+
+
+def migrate():
+    """
+    Copy this node's local data into the configured shared storage
+
+    Objects already in the shared storage are kept, so the migration can be
+    run on every node; snapshots are published from the local files.
+
+    Returns:
+        dict: Number of objects, snapshots and rows copied
+    """
+    from src.global_settings import (
+        SCORES_LOG, CHAT_DIR, STATS_DIR, USER_MEMORY_DIR,
+        INDEX_STORAGE, CORPUS_DIR, CACHE_FILE, USERS_DB, USAGE_DB
+    )
+    from src import conversation_engine, persistence, user_stats
+
+    target = get_storage()
+    source = LocalStorage()
+    copied = {"objects": 0, "snapshots": 0, "rows": 0}
+    if isinstance(target, LocalStorage):
+        return copied
+
+    # Legacy single-file chats, statistics and scores are converted first
+    conversation_engine.import_legacy_chats(source)
+    user_stats.import_legacy_stats(source)
+    persistence.import_legacy_scores(source)
+
+    keys = [SCORES_LOG]
+    for directory in (CHAT_DIR, STATS_DIR, USER_MEMORY_DIR):
+        keys.extend(source.list(directory))
+    for key in keys:
+        data = source.get(key)
+        if data is None:
+            continue
+        try:
+            target.put(key, data, if_version=None)
+            copied["objects"] += 1
+        except VersionConflict:
+            pass
+
+    for path in (INDEX_STORAGE, CORPUS_DIR, CACHE_FILE):
+        if os.path.exists(path):
+            target.push(path)
+            copied["snapshots"] += 1
+
+    # Create the tables in the target, then copy the rows across
+    from src import authenticate, metering
+    for database, table, connect in ((USERS_DB, "users", authenticate._connect),
+                                     (USAGE_DB, "usage", metering._connect)):
+        if os.path.exists(database):
+            connect()
+            copied["rows"] += _copy_table(target, database, table)
+    return copied
+
+
+if __name__ == "__main__":
+    command, paths = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ("", [])
+    storage = get_storage()
+
+    if command == "migrate":
+        copied = migrate()
+        print(f"✓ Copied {copied['objects']} objects, {copied['snapshots']} snapshots "
+              f"and {copied['rows']} rows into {STORAGE_URL or 'local files'}")
+    elif command in ("push", "pull") and paths:
+        for path in paths:
+            getattr(storage, command)(path)
+            print(f"✓ {command.capitalize()}ed {path}")
+    elif command == "ls" and paths:
+        for key, version in storage.list(paths[0]).items():
+            print(f"{version}  {key}")
+    else:
+        print("Usage: python -m src.storage migrate | push <path>... | pull <path>... | ls <directory>")
+        sys.exit(1)
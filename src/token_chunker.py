@@ -0,0 +1,167 @@
+"""
+Offset-based token chunker
+
+FastTokenTextSplitter produces exactly the chunks of TokenTextSplitter, but
+instead of re-tokenizing every word each time a chunk is merged or trimmed,
+it:
+
+- splits the text at spaces once and keeps each word's character offset
+- counts the tokens of each distinct word once, in one batch (tiktoken's
+  encode_batch when available)
+- finds all chunk boundaries with a cumulative sum and binary searches over
+  the token counts (NumPy), then slices the chunks out of the original text
+
+TokenTextSplitter sizes a chunk by the sum of its words' token counts, so
+words are counted individually here too; that is what keeps the output
+identical. Words longer than a chunk fall back to TokenTextSplitter's
+recursive newline/character splitting.
+
+split_documents() chunks many documents in a process pool. Check speed and
+equivalence with:
+    python -m benchmarks.chunking
+"""
+
+import os
+from typing import List
+
+import numpy as np
+from llama_index.core.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.node_parser import TokenTextSplitter
+from llama_index.core.node_parser.text.utils import split_text_keep_separator
+
+
+def token_counts(tokenizer, texts):
+    """
+    Token count of each text
+
+    Uses the tokenizer's batch encoder when it is a tiktoken encode method
+    (or a functools.partial of one, as Settings.tokenizer is).
+
+    Returns:
+        list: Number of tokens per text
+    """
+    func = getattr(tokenizer, "func", tokenizer)
+    owner = getattr(func, "__self__", None)
+    if getattr(func, "__name__", "") == "encode" and hasattr(owner, "encode_batch"):
+        keywords = getattr(tokenizer, "keywords", None) or {}
+        return [len(ids) for ids in owner.encode_batch(texts, **keywords)]
+    return [len(tokenizer(text)) for text in texts]
+
+
+class FastTokenTextSplitter(TokenTextSplitter):
+    """TokenTextSplitter with offset-based splitting and vectorized merging"""
+
+    @classmethod
+    def class_name(cls):
+        return "FastTokenTextSplitter"
+
+    def _split_text(self, text: str, chunk_size: int) -> List[str]:
+        if text == "":
+            return [text]
+        with self.callback_manager.event(
+            CBEventType.CHUNKING, payload={EventPayload.CHUNKS: [text]}
+        ) as event:
+            chunks = self._chunk(text, chunk_size)
+            event.on_end(payload={EventPayload.CHUNKS: chunks})
+        return chunks
+
+    def _splits(self, text, chunk_size):
+        """Words (with their leading space) and their token counts"""
+        splits = split_text_keep_separator(text, self.separator)
+        if len(splits) <= 1:
+            # No separator: let the recursive splitter handle it
+            splits = self._split(text, chunk_size)
+            return splits, token_counts(self._tokenizer, splits)
+
+        distinct = list(set(splits))
+        counts = dict(zip(distinct, token_counts(self._tokenizer, distinct)))
+        words, lengths = [], []
+        for split in splits:
+            if counts[split] <= chunk_size:
+                words.append(split)
+                lengths.append(counts[split])
+            else:
+                pieces = self._split(split, chunk_size)
+                words.extend(pieces)
+                lengths.extend(token_counts(self._tokenizer, pieces))
+        return words, lengths
+
+    def _chunk(self, text, chunk_size):
+        if len(self._tokenizer(text)) <= chunk_size:
+            chunk = text.strip()
+            return [chunk] if chunk else []
+
+        words, lengths = self._splits(text, chunk_size)
+        # The splits concatenate back to the text, so chunk i..j is a slice
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum([len(word) for word in words], out=offsets[1:])
+        tokens = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=tokens[1:])
+
+        chunks = []
+        count = len(words)
+        start = 0
+        while True:
+            # Longest run of splits from start that fits the chunk
+            end = int(np.searchsorted(tokens, tokens[start] + chunk_size, side="right")) - 1
+            if end >= count:
+                break
+            chunk = text[offsets[start]:offsets[end]].strip()
+            if chunk:
+                chunks.append(chunk)
+            # Drop leading splits until the rest fits the overlap and leaves
+            # room for split `end`
+            start = max(
+                start,
+                int(np.searchsorted(tokens, tokens[end] - self.chunk_overlap, side="left")),
+                int(np.searchsorted(tokens, tokens[end + 1] - chunk_size, side="left")),
+            )
+
+        chunk = text[offsets[start]:].strip()
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+
+def _split_batch(documents, chunk_size, chunk_overlap, tokenizer):
+    splitter = FastTokenTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        tokenizer=tokenizer
+    )
+    return splitter.get_nodes_from_documents(documents)
+
+
+def split_documents(documents, chunk_size, chunk_overlap, tokenizer=None, workers=None):
+    """
+    Chunk documents in a process pool
+
+    Args:
+        documents: Documents to split
+        chunk_size: Tokens per chunk
+        chunk_overlap: Tokens shared by consecutive chunks
+        tokenizer: Picklable tokenizer (Settings.tokenizer if omitted)
+        workers: Number of processes (CPU count if omitted, 1 = in-process)
+
+    Returns:
+        list: Nodes, in document order
+    """
+    workers = min(workers or os.cpu_count() or 1, len(documents))
+    if workers <= 1:
+        return _split_batch(documents, chunk_size, chunk_overlap, tokenizer)
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # A few batches per worker balances uneven documents without paying
+    # the pickling cost of one task per document
+    size = -(-len(documents) // (workers * 4))
+    batches = [documents[i:i + size] for i in range(0, len(documents), size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            _split_batch,
+            batches,
+            [chunk_size] * len(batches),
+            [chunk_overlap] * len(batches),
+            [tokenizer] * len(batches)
+        )
+        return [node for nodes in results for node in nodes]
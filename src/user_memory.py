@@ -0,0 +1,355 @@
+"""
+Per-user long-term memory of assessments and past conversations
+
+Every saved assessment and every summarized stretch of conversation is
+stored as an episode with its embedding, one append-only JSONL object per
+user under USER_MEMORY_DIR in storage (src/storage.py). The agent reaches them through the user_memory
+tool, which returns the USER_MEMORY_TOP_K episodes closest to its query, so
+the prompt holds a fixed amount of past context however long someone has
+used the app.
+
+The chat prompt keeps only the recent messages (ChatMemoryBuffer). Once a
+user's history grows past USER_MEMORY_WINDOW messages, the older ones are
+summarized by the LLM into a conversation episode. Embedding and
+summarizing run on a small pool of background threads (USER_MEMORY_WORKERS),
+so saving a score or a chat turn does not wait for them; each user's work
+runs in submission order, and a slow summary for one user does not hold up
+the others. New episodes are appended to the user's object, not rewritten
+with it. Summaries wait while the user is past the soft
+token budget (see src/metering.py).
+
+Episodes remember the embedding backend that produced them and are
+re-embedded when EMBEDDING_BACKEND changes. A memory loaded by this
+replica is dropped when another replica changes it.
+"""
+
+import json
+import threading
+from collections import deque
+from datetime import datetime
+from src.global_settings import (
+    USER_MEMORY_DIR,
+    USER_MEMORY_TOP_K,
+    USER_MEMORY_WINDOW,
+    USER_MEMORY_WORKERS
+)
+from src import storage
+
+KIND_LABELS = {
+    "assessment": "Đánh giá",
+    "conversation": "Trò chuyện",
+}
+
+SUMMARY_PROMPT = """\
+Dưới đây là một đoạn hội thoại giữa người dùng và chuyên gia tâm lý AI:
+{conversation}
+
+Hãy tóm tắt ngắn gọn (tối đa 5 câu) các triệu chứng, cảm xúc, sự kiện quan trọng \
+và lời khuyên đã đưa ra, để có thể nhắc lại trong những lần trò chuyện sau.
+
+Tóm tắt: """
+
+_lock = threading.Lock()
+# username -> {"signature", "archived", "episodes", "matrix"}
+_memories = {}
+# username -> lock held while that user's memory is loaded or changed, so
+# loading one user's history does not block the others
+_user_locks = {}
+# username -> number of times the user's memory was dropped; a load that
+# raced a change is not cached
+_generations = {}
+_executor = None
+# username -> memory work waiting to run, present while the user's work runs
+_work = {}
+# username -> future of the user's last submitted work, while any is queued
+_last = {}
+_watching = {"subscribed": False}
+
+
+def _path(username, suffix):
+    return storage.user_key(USER_MEMORY_DIR, username, suffix)
+
+
+def _user_lock(username):
+    with _lock:
+        return _user_locks.setdefault(username, threading.Lock())
+
+
+def _forget(key):
+    """Drop memories another replica changed, so they are loaded again"""
+    with _lock:
+        for username in set(_memories) | set(_user_locks):
+            if key in (_path(username, ".json"), _path(username, ".jsonl"), USER_MEMORY_DIR):
+                _memories.pop(username, None)
+                _generations[username] = _generations.get(username, 0) + 1
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(max_workers=USER_MEMORY_WORKERS, thread_name_prefix="user-memory")
+        return _executor
+
+
+def _submit(fn, username, *args):
+    """Queue memory work after the user's earlier work, metering its tokens to the user"""
+    from concurrent.futures import Future
+
+    future = Future()
+    with _lock:
+        queue = _work.get(username)
+        idle = queue is None
+        if idle:
+            queue = _work[username] = deque()
+        queue.append((future, fn, args))
+        _last[username] = future
+    if idle:
+        _get_executor().submit(_drain, username)
+    return future
+
+
+def _drain(username):
+    """Run a user's queued memory work, one item at a time"""
+    from src import metering
+
+    while True:
+        with _lock:
+            queue = _work[username]
+            if not queue:
+                # Everything submitted for the user is done
+                del _work[username]
+                del _last[username]
+                return
+            future, fn, args = queue.popleft()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            with metering.attribute(username=username, feature="memory"):
+                future.set_result(fn(username, *args))
+        except Exception as e:
+            future.set_exception(e)
+
+
+def _write_state(username, memory):
+    storage.get_storage().put_json(
+        _path(username, ".json"),
+        {"embedding": memory["signature"], "archived": memory["archived"]}
+    )
+
+
+def _episode_line(episode):
+    return (json.dumps(episode, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _rewrite_episodes(username, episodes):
+    storage.get_storage().put(_path(username, ".jsonl"), b"".join(_episode_line(e) for e in episodes))
+
+
+def _load(username):
+    """
+    A user's memory, loaded once and re-embedded if the backend changed
+
+    Must be called with the user's lock held (_user_lock); _lock is only
+    taken to look up and publish the memory, not while loading it.
+    """
+    with _lock:
+        memory = _memories.get(username)
+        generation = _generations.get(username, 0)
+        subscribe = not _watching["subscribed"]
+        _watching["subscribed"] = True
+    if memory is not None:
+        return memory
+
+    import numpy as np
+    from llama_index.core import Settings
+    from src.embeddings import embedding_signature
+
+    store = storage.get_storage()
+    if subscribe:
+        store.subscribe(USER_MEMORY_DIR, _forget)
+    state = store.get_json(_path(username, ".json"))
+    data = store.get(_path(username, ".jsonl")) or b""
+    episodes = [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()]
+
+    embed_model = Settings.embed_model
+    signature = embedding_signature(embed_model)
+    memory = {
+        "signature": signature,
+        "archived": state["archived"] if state else 0,
+        "episodes": episodes,
+    }
+
+    if state is None:
+        # First use: start from the assessments saved before memory existed
+        from src.health_analytics import load_user_scores
+
+        scores = load_user_scores(username)
+        texts = [_assessment_text(s["Score"], s["Content"], s["Total_guess"]) for s in scores]
+        embeddings = embed_model.get_text_embedding_batch(texts) if texts else []
+        episodes.extend(
+            {"kind": "assessment", "time": s["Time"], "text": text, "embedding": embedding}
+            for s, text, embedding in zip(scores, texts, embeddings)
+        )
+        _rewrite_episodes(username, episodes)
+        _write_state(username, memory)
+    elif state.get("embedding") != signature and episodes:
+        embeddings = embed_model.get_text_embedding_batch([e["text"] for e in episodes])
+        for episode, embedding in zip(episodes, embeddings):
+            episode["embedding"] = embedding
+        _rewrite_episodes(username, episodes)
+        _write_state(username, memory)
+
+    memory["matrix"] = (
+        np.array([e["embedding"] for e in episodes], dtype=np.float32)
+        if episodes else None
+    )
+    with _lock:
+        if _generations.get(username, 0) == generation:
+            _memories[username] = memory
+    return memory
+
+
+def _assessment_text(score, content, total_guess):
+    return f"Điểm sức khỏe tâm thần: {score}. {content} Tổng đoán: {total_guess}"
+
+
+def _append(username, kind, text, time):
+    """Embed and store one episode"""
+    import numpy as np
+    from llama_index.core import Settings
+
+    with _user_lock(username):
+        memory = _load(username)
+        # The first load may already have imported this assessment
+        if any(e["time"] == time and e["text"] == text for e in memory["episodes"]):
+            return
+
+    embedding = Settings.embed_model.get_text_embedding(text)
+    episode = {"kind": kind, "time": time, "text": text, "embedding": embedding}
+    with _user_lock(username):
+        memory["episodes"].append(episode)
+        row = np.array([embedding], dtype=np.float32)
+        memory["matrix"] = row if memory["matrix"] is None else np.vstack([memory["matrix"], row])
+        storage.get_storage().append(_path(username, ".jsonl"), _episode_line(episode))
+
+
+def remember_assessment(username, score, content, total_guess, time=None):
+    """
+    Queue a saved assessment for the user's memory
+
+    Returns:
+        Future: Completes once the episode is stored
+    """
+    time = time or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    text = _assessment_text(score, content, total_guess)
+    return _submit(_append, username, "assessment", text, time)
+
+
+def _summarize(username, messages):
+    """Summarize messages that left the prompt window into an episode"""
+    from llama_index.core import Settings
+
+    with _user_lock(username):
+        memory = _load(username)
+        archived = memory["archived"]
+    if len(messages) < archived:
+        # History was cleared: start counting again
+        archived = 0
+    cutoff = len(messages) - USER_MEMORY_WINDOW
+    if cutoff - archived < USER_MEMORY_WINDOW // 2:
+        # Summarize in batches rather than on every turn
+        if archived != memory["archived"]:
+            with _user_lock(username):
+                memory["archived"] = archived
+                _write_state(username, memory)
+        return
+
+    # Long histories from before memory existed only keep their latest part
+    start = max(archived, cutoff - 2 * USER_MEMORY_WINDOW)
+    conversation = "\n".join(
+        f"{m.role.value}: {m.content}"
+        for m in messages[start:cutoff]
+        if m.content and m.role.value in ("user", "assistant")
+    )
+    if conversation:
+        from src import metering
+
+        status, _ = metering.budget_status(username)
+        if status != metering.BUDGET_OK:
+            # Near the daily budget: summarize once it resets
+            return
+        summary = Settings.llm.complete(SUMMARY_PROMPT.format(conversation=conversation)).text.strip()
+        _append(username, "conversation", summary, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+    with _user_lock(username):
+        memory["archived"] = cutoff
+        _write_state(username, memory)
+
+
+def archive_messages(username, messages):
+    """
+    Queue summarizing of chat messages older than the prompt window
+
+    Returns:
+        Future: Completes once any summary is stored
+    """
+    return _submit(_summarize, username, list(messages))
+
+
+def recall(username, query, top_k=USER_MEMORY_TOP_K):
+    """
+    Episodes most relevant to a query
+
+    Args:
+        username: Username
+        query: What the agent wants to remember
+        top_k: Maximum number of episodes
+
+    Returns:
+        list: Episode dicts (kind, time, text, score), most relevant first
+    """
+    import numpy as np
+    from llama_index.core import Settings
+
+    with _user_lock(username):
+        memory = _load(username)
+        matrix = memory["matrix"]
+        episodes = list(memory["episodes"])
+    if matrix is None:
+        return []
+
+    query_embedding = np.array(Settings.embed_model.get_query_embedding(query), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query_embedding) or 1.0)
+    scores = matrix @ query_embedding / np.where(norms == 0, 1.0, norms)
+    best = np.argsort(-scores)[:top_k]
+    return [
+        {"kind": episodes[i]["kind"], "time": episodes[i]["time"],
+         "text": episodes[i]["text"], "score": float(scores[i])}
+        for i in best
+    ]
+
+
+def format_episodes(episodes):
+    """Episodes as text for the agent"""
+    if not episodes:
+        return "Chưa có thông tin nào từ những lần trò chuyện trước."
+    return "\n".join(
+        f"- [{e['time']}] ({KIND_LABELS.get(e['kind'], e['kind'])}) {e['text']}"
+        for e in sorted(episodes, key=lambda e: e["time"])
+    )
+
+
+def wait_until_idle(timeout=None):
+    """
+    Block until every queued memory update is stored
+
+    Returns:
+        bool: False if the timeout passed first
+    """
+    from concurrent.futures import wait
+
+    with _lock:
+        futures = list(_last.values())
+    return not wait(futures, timeout).not_done
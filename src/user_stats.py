@@ -0,0 +1,330 @@
+"""
+Materialized per-user statistics
+
+Counters are updated incrementally whenever chat history or scores are saved,
+so pages can show message and assessment counts without loading the whole
+chat store or scores log. Each user's counters are one object in storage
+(src/storage.py), updated with conditional writes so replicas do not lose
+each other's increments. Users with history saved before the counters
+existed are backfilled once, in one pass over the chat store and scores
+log; users without counters after that start from zero. Reads add the
+user's writes still queued in src/persistence.py instead of waiting for
+them.
+
+Rebuild the counters from the source files if they ever drift:
+    python -m src.user_stats rebuild
+"""
+
+import os
+import sys
+import json
+import threading
+from datetime import datetime, timedelta
+from src.global_settings import STATS_FILE, STATS_DIR, PERSIST_READ_TIMEOUT
+from src import persistence, storage
+
+# Number of days covered by the rolling counters
+RECENT_DAYS = 7
+
+# Written once legacy users have been backfilled
+BACKFILL_MARKER = f"{STATS_DIR}.backfilled"
+
+_lock = threading.Lock()
+_legacy_stats = {"imported": False}
+
+
+def _empty_stats():
+    """Counters for a user with no activity"""
+    return {
+        "messages": 0,
+        "assessments": 0,
+        "last_score": None,
+        "last_assessment": None,
+        "daily_messages": {},
+        "daily_assessments": {},
+    }
+
+
+def _window_start(now=None):
+    """First day (ISO date) inside the rolling window"""
+    now = now or datetime.now()
+    return (now - timedelta(days=RECENT_DAYS - 1)).strftime("%Y-%m-%d")
+
+
+def _prune(daily, now=None):
+    """Drop daily buckets that fell out of the rolling window"""
+    start = _window_start(now)
+    return {day: count for day, count in daily.items() if day >= start}
+
+
+def _stats_key(username):
+    return storage.user_key(STATS_DIR, username, ".json")
+
+
+def import_legacy_stats(store=None):
+    """
+    Split the legacy single statistics file into per-user objects
+
+    Users who already have counters in storage are left untouched; the
+    legacy file is renamed to <file>.imported afterwards.
+
+    Returns:
+        int: Number of users imported
+    """
+    if not os.path.exists(STATS_FILE):
+        return 0
+    store = store or storage.get_storage()
+    try:
+        with open(STATS_FILE, "r", encoding="utf-8") as f:
+            stats = json.load(f)
+    except json.JSONDecodeError:
+        stats = {}
+
+    imported = 0
+    for username, user_stats in stats.items():
+        try:
+            store.put_json(_stats_key(username), user_stats, if_version=None)
+            imported += 1
+        except storage.VersionConflict:
+            pass
+    os.replace(STATS_FILE, f"{STATS_FILE}.imported")
+    return imported
+
+
+def _import_legacy_once():
+    """
+    Import the legacy statistics file and backfill legacy users, once
+
+    Returns:
+        set: Usernames backfilled by this call
+    """
+    with _lock:
+        if _legacy_stats["imported"]:
+            return set()
+        import_legacy_stats()
+        backfilled = backfill_legacy_users()
+        _legacy_stats["imported"] = True
+        return backfilled
+
+
+def _add_assessments(user_stats, entries, now=None):
+    """Count score entries, oldest first, into a user's counters"""
+    start = _window_start(now)
+    for entry in sorted(entries, key=lambda s: s["Time"]):
+        user_stats["assessments"] += 1
+        user_stats["last_score"] = entry["Score"]
+        user_stats["last_assessment"] = entry["Time"]
+        day = entry["Time"][:10]
+        if day >= start:
+            daily = user_stats["daily_assessments"]
+            daily[day] = daily.get(day, 0) + 1
+
+
+def backfill_legacy_users(store=None):
+    """
+    Create counters for users whose history predates them
+
+    Runs once per storage (BACKFILL_MARKER records it): the chat histories
+    and assessments of users without counters are counted in one pass.
+
+    Returns:
+        set: Usernames whose counters were created
+    """
+    from src.conversation_engine import load_chat_store
+
+    store = store or storage.get_storage()
+    if store.get(BACKFILL_MARKER) is not None:
+        return set()
+
+    counted = store.list(STATS_DIR).keys()
+    stats = {}
+    chat_store = load_chat_store()
+    for username in chat_store.get_keys():
+        if _stats_key(username) not in counted:
+            stats.setdefault(username, _empty_stats())["messages"] = len(chat_store.get_messages(username))
+    by_user = {}
+    for entry in persistence.read_scores()[0]:
+        if _stats_key(entry["username"]) not in counted:
+            by_user.setdefault(entry["username"], []).append(entry)
+    for username, entries in by_user.items():
+        _add_assessments(stats.setdefault(username, _empty_stats()), entries)
+
+    backfilled = set()
+    for username, user_stats in stats.items():
+        try:
+            store.put_json(_stats_key(username), user_stats, if_version=None)
+            backfilled.add(username)
+        except storage.VersionConflict:
+            pass
+    store.put(BACKFILL_MARKER, datetime.now().strftime("%Y-%m-%d %H:%M:%S").encode("utf-8"))
+    return backfilled
+
+
+def load_user(username):
+    """
+    Load one user's statistics as stored
+
+    Returns:
+        dict: Counters, empty for a user with no activity
+    """
+    _import_legacy_once()
+    return storage.get_storage().get_json(_stats_key(username), {})
+
+
+def _update_user(username, update):
+    """Apply an update function to one user's counters and persist"""
+    def apply(stored):
+        user_stats = {**_empty_stats(), **stored}
+        update(user_stats)
+        user_stats["daily_messages"] = _prune(user_stats["daily_messages"])
+        user_stats["daily_assessments"] = _prune(user_stats["daily_assessments"])
+        return user_stats
+
+    # Chats and scores are stored before their counters are updated, so a
+    # backfill already counts the change being recorded
+    if username in _import_legacy_once():
+        return
+    storage.get_storage().update_json(_stats_key(username), apply, default={})
+
+
+def _load_current(username):
+    """A user's counters including their chat and score writes still queued"""
+    user_stats = {**_empty_stats(), **load_user(username)}
+    pending = persistence.pending_messages(username)
+    if pending is not None:
+        _count_messages(user_stats, len(pending))
+    # A score may be counted just before it stops being pending
+    counted_until = user_stats["last_assessment"] or ""
+    for entry in persistence.pending_scores(username):
+        if entry["Time"] > counted_until:
+            _count_assessment(user_stats, entry["Score"], entry["Time"])
+    return user_stats
+
+
+def get_user_stats(username):
+    """
+    Get statistics for a user
+
+    Args:
+        username: Username
+
+    Returns:
+        dict: messages, assessments, last_score, last_assessment,
+            messages_7d and assessments_7d
+    """
+    user_stats = _load_current(username)
+    start = _window_start()
+    user_stats["messages_7d"] = sum(
+        count for day, count in user_stats["daily_messages"].items() if day >= start
+    )
+    user_stats["assessments_7d"] = sum(
+        count for day, count in user_stats["daily_assessments"].items() if day >= start
+    )
+    return user_stats
+
+
+def get_score_version(username):
+    """
+    Version of a user's assessments, changing whenever a score is saved
+
+    Args:
+        username: Username
+
+    Returns:
+        tuple: (assessment count, last assessment time)
+    """
+    user_stats = _load_current(username)
+    return user_stats["assessments"], user_stats["last_assessment"]
+
+
+def _count_messages(user_stats, total):
+    """Set the message count, counting the added messages for today"""
+    added = total - user_stats["messages"]
+    if total == 0:
+        user_stats["daily_messages"] = {}
+    elif added > 0:
+        today = datetime.now().strftime("%Y-%m-%d")
+        daily = user_stats["daily_messages"]
+        daily[today] = daily.get(today, 0) + added
+    user_stats["messages"] = total
+
+
+def _count_assessment(user_stats, score, time_str):
+    """Count one assessment"""
+    day = time_str[:10]
+    daily = user_stats["daily_assessments"]
+    daily[day] = daily.get(day, 0) + 1
+    user_stats["assessments"] += 1
+    user_stats["last_score"] = score
+    user_stats["last_assessment"] = time_str
+
+
+def record_message_count(username, total):
+    """
+    Record the current number of chat messages for a user
+
+    Args:
+        username: Username
+        total: Number of messages now stored for the user
+    """
+    _update_user(username, lambda user_stats: _count_messages(user_stats, total))
+
+
+def record_assessment(username, score, time_str):
+    """
+    Record a newly saved assessment
+
+    Args:
+        username: Username
+        score: Score label of the assessment
+        time_str: Assessment time formatted as "%Y-%m-%d %H:%M:%S"
+    """
+    _update_user(username, lambda user_stats: _count_assessment(user_stats, score, time_str))
+
+
+def rebuild_stats():
+    """
+    Recompute every user's counters from the chat store and scores log
+
+    Daily message counters cannot be recovered because chat messages carry
+    no timestamp, so they restart from zero.
+
+    Returns:
+        dict: Rebuilt statistics keyed by username
+    """
+    from src.conversation_engine import load_chat_store
+
+    persistence.wait_until_flushed(PERSIST_READ_TIMEOUT)
+    _import_legacy_once()
+    stats = {}
+    chat_store = load_chat_store()
+    for username in chat_store.get_keys():
+        user_stats = stats.setdefault(username, _empty_stats())
+        user_stats["messages"] = len(chat_store.get_messages(username))
+
+    store = storage.get_storage()
+    by_user = {}
+    for entry in persistence.read_scores()[0]:
+        by_user.setdefault(entry["username"], []).append(entry)
+    for username, entries in by_user.items():
+        _add_assessments(stats.setdefault(username, _empty_stats()), entries)
+
+    keys = {_stats_key(username): user_stats for username, user_stats in stats.items()}
+    for key in store.list(STATS_DIR).keys() - keys.keys():
+        store.delete(key)
+    for key, user_stats in keys.items():
+        store.put_json(key, user_stats)
+    return stats
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if command == "rebuild":
+        stats = rebuild_stats()
+        print(f"✓ Rebuilt statistics for {len(stats)} users")
+    elif command == "show" and len(sys.argv) > 2:
+        print(json.dumps(get_user_stats(sys.argv[2]), indent=4, ensure_ascii=False))
+    else:
+        print("Usage: python -m src.user_stats rebuild | show <username>")
+        sys.exit(1)